@@ -3,7 +3,10 @@ import asyncio
 import time
 import json
 import random
-from datetime import datetime, timedelta, date
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from datetime import datetime, timedelta, date, timezone
 from config import beijing_tz
 from typing import Dict, Any, List, Optional, Union
 from config import Config, beijing_tz
@@ -12,8 +15,231 @@ from asyncpg.pool import Pool
 from fault_tolerance import with_deadlock_retry, db_circuit_breaker, Watchdog
 from asyncpg.exceptions import SerializationError, PostgresError
 
+# jsonb 编解码优先使用 ujson（requirements 已声明），未安装时退回标准库
+try:
+    import ujson as _fast_json
+except ImportError:
+    _fast_json = json
+
 logger = logging.getLogger("GroupCheckInBot")
 
+_ONE_DAY = timedelta(days=1)
+# 北京时间固定 UTC+8（1991 年后无夏令时）：C 实现的固定偏移，取当前时间无需走 pytz 的转换表查找
+_BEIJING_FIXED_TZ = timezone(timedelta(hours=8))
+
+
+def _tag_rowcount(result: str, command: str = "DELETE") -> int:
+    """解析 asyncpg 命令标签（如 'DELETE 42'）中的行数"""
+    if not result or not isinstance(result, str) or not result.startswith(command):
+        return 0
+    count = result.rpartition(" ")[2]
+    return int(count) if count.isdigit() else 0
+
+
+@lru_cache(maxsize=4096)
+def _format_seconds_to_hms(seconds: int) -> str:
+    """秒数格式化（按值缓存，参数须为 int）"""
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours > 0:
+        return f"{hours}小时{minutes}分{secs}秒"
+    elif minutes > 0:
+        return f"{minutes}分{secs}秒"
+    else:
+        return f"{secs}秒"
+
+# 热点查询的 SQL 文本统一为模块常量：相同文本才能命中 asyncpg 的预编译语句缓存
+_USER_ROW_SQL = """
+    SELECT user_id, nickname, current_activity, activity_start_time,
+           total_accumulated_time, total_activity_count, total_fines,
+           overtime_count, total_overtime_time, last_updated,
+           checkin_message_id, shift
+    FROM users
+    WHERE chat_id = $1 AND user_id = $2
+"""
+_GROUP_ROW_SQL = "SELECT * FROM groups WHERE chat_id = $1"
+
+# 上下班打卡（add_work_record）事务内的固定语句
+_WORK_RECORD_UPSERT_SQL = """
+    INSERT INTO work_records
+    (chat_id, user_id, record_date, checkin_type,
+     checkin_time, status, time_diff_minutes,
+     fine_amount, shift, shift_detail)
+    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
+    ON CONFLICT (chat_id, user_id, record_date, checkin_type, shift)
+    DO UPDATE SET
+        checkin_time = EXCLUDED.checkin_time,
+        status = EXCLUDED.status,
+        time_diff_minutes = EXCLUDED.time_diff_minutes,
+        fine_amount = EXCLUDED.fine_amount,
+        shift_detail = EXCLUDED.shift_detail,
+        created_at = CURRENT_TIMESTAMP
+"""
+_WORK_DAILY_AGG_SQL = """
+    SELECT 
+        COUNT(*) FILTER (WHERE checkin_type='work_start') AS work_start_count,
+        COUNT(*) FILTER (WHERE checkin_type='work_end') AS work_end_count,
+        COUNT(*) FILTER (WHERE checkin_type='work_start' AND time_diff_minutes>0) AS late_count,
+        COUNT(*) FILTER (WHERE checkin_type='work_end' AND time_diff_minutes<0) AS early_count,
+        COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type='work_start'), 0) AS work_start_fines,
+        COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type='work_end'), 0) AS work_end_fines,
+        COALESCE(
+            SUM(
+                CASE 
+                    WHEN checkin_type='work_start' THEN 0
+                    WHEN checkin_type='work_end' THEN
+                        EXTRACT(EPOCH FROM (
+                            TO_TIMESTAMP(checkin_time, 'HH24:MI') - 
+                            TO_TIMESTAMP((
+                                SELECT COALESCE(checkin_time, '00:00')
+                                FROM work_records ws
+                                WHERE ws.chat_id = work_records.chat_id
+                                  AND ws.user_id = work_records.user_id
+                                  AND ws.record_date = work_records.record_date
+                                  AND ws.shift = work_records.shift
+                                  AND ws.checkin_type = 'work_start'
+                                LIMIT 1
+                            ), 'HH24:MI')
+                        ))
+                END
+            ), 0
+        ) AS work_seconds
+    FROM work_records
+    WHERE chat_id = $1 
+      AND user_id = $2 
+      AND record_date = $3 
+      AND shift = $4
+"""
+_WORK_DAILY_UPSERT_SQL = """
+    INSERT INTO daily_statistics 
+    (chat_id, user_id, record_date, shift,
+     work_start_count, work_end_count, late_count, early_count,
+     work_start_fines, work_end_fines, work_hours, work_days, updated_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, 
+            CASE WHEN $5 > 0 OR $6 > 0 OR $11 > 0 THEN 1 ELSE 0 END,
+            CURRENT_TIMESTAMP)
+    ON CONFLICT (chat_id, user_id, record_date, shift) 
+    DO UPDATE SET
+        work_start_count = EXCLUDED.work_start_count,
+        work_end_count = EXCLUDED.work_end_count,
+        late_count = EXCLUDED.late_count,
+        early_count = EXCLUDED.early_count,
+        work_start_fines = EXCLUDED.work_start_fines,
+        work_end_fines = EXCLUDED.work_end_fines,
+        work_hours = EXCLUDED.work_hours,
+        work_days = CASE 
+            WHEN EXCLUDED.work_hours > 0 AND daily_statistics.work_hours = 0 
+            THEN daily_statistics.work_days + 1
+            WHEN EXCLUDED.work_hours = 0 AND daily_statistics.work_hours > 0
+            THEN daily_statistics.work_days
+            ELSE daily_statistics.work_days
+        END,
+        updated_at = CURRENT_TIMESTAMP
+"""
+_WORK_MONTHLY_UPSERT_SQL = """
+    INSERT INTO monthly_statistics 
+    (chat_id, user_id, statistic_date, shift,
+     work_start_fines, work_end_fines,
+     work_start_count, work_end_count, late_count, early_count,
+     work_hours, work_days, updated_at)
+    SELECT $1, $2, $3, $4,
+           CASE WHEN $5 = 'work_start' THEN $6 ELSE 0 END,
+           CASE WHEN $5 = 'work_start' THEN 0 ELSE $6 END,
+           COALESCE(SUM(work_start_count), 0),
+           COALESCE(SUM(work_end_count), 0),
+           COALESCE(SUM(late_count), 0),
+           COALESCE(SUM(early_count), 0),
+           COALESCE(SUM(work_hours), 0),
+           COALESCE(SUM(work_days), 0),
+           CURRENT_TIMESTAMP
+    FROM daily_statistics
+    WHERE chat_id = $1 
+      AND user_id = $2 
+      AND record_date >= $3
+      AND record_date < ($3::date + INTERVAL '1 month')
+      AND shift = $4
+    ON CONFLICT (chat_id, user_id, statistic_date, shift)
+    DO UPDATE SET
+        work_start_fines = monthly_statistics.work_start_fines + EXCLUDED.work_start_fines,
+        work_end_fines = monthly_statistics.work_end_fines + EXCLUDED.work_end_fines,
+        work_start_count = EXCLUDED.work_start_count,
+        work_end_count = EXCLUDED.work_end_count,
+        late_count = EXCLUDED.late_count,
+        early_count = EXCLUDED.early_count,
+        work_hours = EXCLUDED.work_hours,
+        work_days = EXCLUDED.work_days,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING (xmax = 0) AS inserted
+"""
+_WORK_USER_FINES_SQL = """
+    UPDATE users
+    SET total_fines = (
+        SELECT COALESCE(SUM(fine_amount), 0)
+        FROM work_records
+        WHERE chat_id = $1 AND user_id = $2
+    ),
+    updated_at = CURRENT_TIMESTAMP
+    WHERE chat_id = $1 AND user_id = $2
+"""
+
+# 活动结算：月统计 / 活动明细 / 用户罚款 合并为一条固定文本语句
+# 参数: chat_id, user_id, statistic_date, shift, elapsed, fine, has_overtime,
+#       overtime_seconds, activity_date, activity
+_MONTHLY_ACTIVITY_SQL = """
+    WITH m AS (
+        INSERT INTO monthly_statistics (
+            chat_id, user_id, statistic_date, shift,
+            activity_count, accumulated_time, fine_amount,
+            overtime_count, overtime_time
+        )
+        VALUES ($1, $2, $3, $4, 1, $5, $6, $7, $8)
+        ON CONFLICT (chat_id, user_id, statistic_date, shift)
+        DO UPDATE SET
+            activity_count = monthly_statistics.activity_count + 1,
+            accumulated_time = monthly_statistics.accumulated_time + $5,
+            fine_amount = monthly_statistics.fine_amount + $6,
+            overtime_count = monthly_statistics.overtime_count + $7,
+            overtime_time = monthly_statistics.overtime_time + $8,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING 1
+    ),
+    a AS (
+        INSERT INTO user_activities (
+            chat_id, user_id, activity_date, activity_name,
+            activity_count, accumulated_time, shift
+        )
+        VALUES ($1, $2, $9, $10, 1, $5, $4)
+        ON CONFLICT (chat_id, user_id, activity_date, activity_name, shift)
+        DO UPDATE SET
+            activity_count = user_activities.activity_count + 1,
+            accumulated_time = user_activities.accumulated_time + $5,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING 1
+    ),
+    u AS (
+        UPDATE users
+        SET total_fines = total_fines + $6,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE chat_id = $1 AND user_id = $2 AND $6 > 0
+        RETURNING 1
+    )
+    SELECT 1
+"""
+
+# 配置目录：活动限制 / 活动罚款 / 上下班罚款 三张小表一次读取
+_ACTIVITY_CATALOG_SQL = """
+    SELECT 'limit' AS kind, activity_name AS name, NULL::text AS time_segment,
+           max_times, time_limit, NULL::integer AS fine_amount
+    FROM activity_configs
+    UNION ALL
+    SELECT 'fine', activity_name, time_segment, NULL, NULL, fine_amount
+    FROM fine_configs
+    UNION ALL
+    SELECT 'work_fine', checkin_type, time_segment, NULL, NULL, fine_amount
+    FROM work_fine_configs
+"""
+
 
 class PostgreSQLDatabase:
     """PostgreSQL数据库管理器 - 纯双班模式"""
@@ -25,10 +251,16 @@ class PostgreSQLDatabase:
         self._initialized = False
 
         # 一级缓存 (L1 Cache) 属性
-        self._cache = {}
-        self._cache_ttl = {}
-        self._cache_max_size = 1000
-        self._cache_access_order = []
+        self._cache: "OrderedDict[Union[str, tuple], Any]" = OrderedDict()
+        self._cache_ttl: Dict[Union[str, tuple], float] = {}
+        self._cache_max_size = 10000
+        # 按群组的缓存键二级索引: chat_id -> {("user", chat_id, uid), ("group", chat_id), ...}
+        self._cache_by_chat: Dict[int, set] = {}
+
+        # 业务日期锚点缓存: chat_id -> (过期时间戳, 最早上班的当日分钟数)
+        self._business_anchor_cache: Dict[int, tuple] = {}
+        # 每日重置时刻缓存: chat_id -> (reset_hour, reset_minute)，改重置时间时失效
+        self._reset_cfg_cache: Dict[int, tuple] = {}
 
         # 并发控制：防击穿与命名锁
         self._pending_queries = {}  # 用于 Singleflight 模式
@@ -47,6 +279,7 @@ class PostgreSQLDatabase:
         # 指数退避重连机制
         self._last_connection_check = 0
         self._connection_check_interval = 30
+        self._last_healthy_ts = 0.0  # 最近一次探活成功的 monotonic 时间
         self._reconnect_attempts = 0
         self._max_reconnect_attempts = 5
         self._reconnect_base_delay = 1.0
@@ -100,6 +333,7 @@ class PostgreSQLDatabase:
 
             # ⚠️ 重要：先标记为未初始化，防止新请求进入
             self._initialized = False
+            self._last_healthy_ts = 0.0
 
             # 关闭旧连接池（如果有）
             if self.pool:
@@ -224,6 +458,9 @@ class PostgreSQLDatabase:
                     asyncpg.InterfaceError,
                     ConnectionError,
                 ) as e:
+                    # 连接类异常使探活缓存失效，下次健康检查必须真实探测
+                    self._last_healthy_ts = 0.0
+
                     if attempt == max_retries:
                         logger.error(
                             f"{operation_name} 数据库重试{max_retries}次后失败: {e}"
@@ -303,6 +540,7 @@ class PostgreSQLDatabase:
             except Exception as e:
                 logger.error(f"❌ 数据库连接异常: {e}")
                 self._last_connection_check = 0
+                self._last_healthy_ts = 0.0
                 return
 
             # ===== 2. 检查是否有死锁 =====
@@ -603,7 +841,7 @@ class PostgreSQLDatabase:
     # ========== 时区相关方法 ==========
     def get_beijing_time(self):
         """获取北京时间"""
-        return datetime.now(beijing_tz)
+        return datetime.now(_BEIJING_FIXED_TZ)
 
     def get_beijing_date(self):
         """获取北京日期"""
@@ -672,13 +910,20 @@ class PostgreSQLDatabase:
             max_size=Config.DB_MAX_CONNECTIONS,
             max_inactive_connection_lifetime=Config.DB_POOL_RECYCLE,
             command_timeout=Config.DB_CONNECTION_TIMEOUT,
+            # 每个连接按 SQL 文本缓存服务端预编译语句，固定文本的查询只 PARSE 一次
+            statement_cache_size=Config.DB_STATEMENT_CACHE_SIZE,
+            max_cached_statement_lifetime=0,
+            max_cacheable_statement_size=15 * 1024,
+            # 作为连接启动参数下发：每个连接生效，且不会被归还连接时的 RESET ALL 清掉。
+            # 不在此设置全局 statement_timeout：长查询（月报、导出、CONCURRENTLY 建索引）
+            # 由 command_timeout 与各调用点自行设置的超时控制
+            server_settings={
+                "application_name": "group_checkin_bot",
+            },
+            init=self._init_connection,
         )
         logger.info("PostgreSQL连接池创建成功")
 
-        async with self.pool.acquire() as conn:
-            await conn.execute("SET statement_timeout = 30000")
-            await conn.execute("SET idle_in_transaction_session_timeout = 60000")
-
         max_retries = 3
         for attempt in range(max_retries):
             try:
@@ -694,6 +939,23 @@ class PostgreSQLDatabase:
                     await self._force_recreate_tables()
                 await asyncio.sleep(1)
 
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection):
+        """新连接预热：注册 jsonb 编解码器，并以不存在的键执行热点读语句，使其预先进入该连接的语句缓存"""
+        # jsonb 结果（如活动明细聚合）在驱动层直接解码为 dict，调用方无需再逐行 json.loads
+        await conn.set_type_codec(
+            "jsonb",
+            encoder=_fast_json.dumps,
+            decoder=_fast_json.loads,
+            schema="pg_catalog",
+        )
+        try:
+            await conn.fetchrow(_USER_ROW_SQL, 0, 0)
+            await conn.fetchrow(_GROUP_ROW_SQL, 0)
+        except PostgresError as e:
+            # 首次启动时表尚未创建，跳过预热即可，首次真实调用时再预编译
+            logger.debug(f"连接预热跳过: {e}")
+
     async def _force_recreate_tables(self):
         """强制重新创建所有表"""
         logger.warning("🔄 强制重新创建数据库表...")
@@ -786,7 +1048,7 @@ class PostgreSQLDatabase:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(chat_id, user_id)
-                )
+                ) WITH (fillfactor = 85)
                 """,
                 # 3. user_activities表
                 """
@@ -802,7 +1064,7 @@ class PostgreSQLDatabase:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(chat_id, user_id, activity_date, activity_name, shift)
-                )
+                ) WITH (fillfactor = 85)
                 """,
                 # 4. work_records表
                 """
@@ -857,7 +1119,7 @@ class PostgreSQLDatabase:
                 """
                 CREATE TABLE IF NOT EXISTS push_settings (
                     setting_key TEXT PRIMARY KEY,
-                    setting_value INTEGER,
+                    setting_value BOOLEAN,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
                 """,
@@ -885,7 +1147,7 @@ class PostgreSQLDatabase:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(chat_id, user_id, statistic_date, shift) 
-                )
+                ) WITH (fillfactor = 85)
                 """,
                 # 10. activity_user_limits表
                 """
@@ -897,6 +1159,8 @@ class PostgreSQLDatabase:
                 )
                 """,
                 # 11. daily_statistics表
+                # 与 user_activities 粒度不同：此表按 (用户, 日期, 班次) 汇总全部活动与上下班数据，
+                # user_activities 按活动名称拆分明细，两者不能互相替代
                 """
                 CREATE TABLE IF NOT EXISTS daily_statistics(
                     id SERIAL PRIMARY KEY,
@@ -920,7 +1184,7 @@ class PostgreSQLDatabase:
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     UNIQUE(chat_id, user_id, record_date, shift)
-                )
+                ) WITH (fillfactor = 85)
                 """,
                 # 12. group_shift_state表
                 """
@@ -979,17 +1243,46 @@ class PostgreSQLDatabase:
                     UNIQUE(chat_id, reset_date)
                 )
                 """,
+                # 高频 UPDATE 的表预留页内空间，便于 HOT 更新（对已存在的表同样生效于新写入的页）
+                "ALTER TABLE users SET (fillfactor = 85)",
+                "ALTER TABLE user_activities SET (fillfactor = 85)",
+                "ALTER TABLE daily_statistics SET (fillfactor = 85)",
+                "ALTER TABLE monthly_statistics SET (fillfactor = 85)",
+                # 旧库的 push_settings.setting_value 为 0/1 整数，迁移为原生布尔
+                """
+                DO $$
+                BEGIN
+                    IF EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'push_settings'
+                          AND column_name = 'setting_value'
+                          AND data_type = 'integer'
+                    ) THEN
+                        ALTER TABLE push_settings
+                            ALTER COLUMN setting_value TYPE BOOLEAN
+                            USING setting_value <> 0;
+                    END IF;
+                END
+                $$
+                """,
             ]
 
-            for table_sql in tables:
-                try:
-                    await conn.execute(table_sql)
-                    table_name = self._extract_table_name(table_sql)
-                    logger.info(f"✅ 创建表: {table_name}")
-                except Exception as e:
-                    logger.error(f"❌ 创建表失败: {e}")
-                    logger.error(f"失败的SQL: {table_sql[:100]}...")
-                    raise
+            # 无参数的多语句文本走简单查询协议，一次往返完成全部建表
+            try:
+                await conn.execute(";\n".join(tables))
+                logger.info(f"✅ 建表语句批量执行完成（{len(tables)} 条）")
+            except Exception as e:
+                # 批量失败时逐条执行，便于定位具体失败的表
+                logger.warning(f"⚠️ 批量建表失败，改为逐条执行: {e}")
+                for table_sql in tables:
+                    try:
+                        await conn.execute(table_sql)
+                        table_name = self._extract_table_name(table_sql)
+                        logger.info(f"✅ 创建表: {table_name}")
+                    except Exception as e:
+                        logger.error(f"❌ 创建表失败: {e}")
+                        logger.error(f"失败的SQL: {table_sql[:100]}...")
+                        raise
 
             logger.info("🚀 数据库所有表及字段初始化完成")
 
@@ -998,73 +1291,111 @@ class PostgreSQLDatabase:
         async with self.pool.acquire() as conn:
             indexes = [
                 # 原有索引（核心业务路径）
-                "CREATE INDEX IF NOT EXISTS idx_users_primary ON users (chat_id, user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_users_current_activity ON users (chat_id, current_activity) WHERE current_activity IS NOT NULL",
-                "CREATE INDEX IF NOT EXISTS idx_users_checkin_message ON users (chat_id, checkin_message_id) WHERE checkin_message_id IS NOT NULL",
-                "CREATE INDEX IF NOT EXISTS idx_user_activities_main ON user_activities (chat_id, user_id, activity_date, shift)",
-                "CREATE INDEX IF NOT EXISTS idx_user_activities_cleanup ON user_activities (chat_id, created_at)",
-                "CREATE INDEX IF NOT EXISTS idx_work_records_main ON work_records (chat_id, user_id, record_date, shift)",
-                "CREATE INDEX IF NOT EXISTS idx_work_records_night ON work_records (chat_id, user_id, shift, created_at)",
-                "CREATE INDEX IF NOT EXISTS idx_work_records_cleanup ON work_records (chat_id, created_at)",
-                "CREATE INDEX IF NOT EXISTS idx_daily_stats_main ON daily_statistics (chat_id, record_date, user_id, shift)",
-                "CREATE INDEX IF NOT EXISTS idx_monthly_stats_main ON monthly_statistics (chat_id, statistic_date, user_id, shift)",
-                "CREATE INDEX IF NOT EXISTS idx_groups_config ON groups (chat_id, dual_mode, reset_hour, reset_minute)",
-                "CREATE INDEX IF NOT EXISTS idx_fine_configs_lookup ON fine_configs (activity_name, time_segment)",
-                "CREATE INDEX IF NOT EXISTS idx_shift_state ON group_shift_state (chat_id, shift, shift_start_time)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_primary ON users (chat_id, user_id)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_current_activity ON users (chat_id, current_activity) WHERE current_activity IS NOT NULL",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_checkin_message ON users (chat_id, checkin_message_id) WHERE checkin_message_id IS NOT NULL",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_activities_main ON user_activities (chat_id, user_id, activity_date, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_activities_cleanup ON user_activities (chat_id, created_at)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_main ON work_records (chat_id, user_id, record_date, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_night ON work_records (chat_id, user_id, shift, created_at)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_cleanup ON work_records (chat_id, created_at)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_daily_stats_main ON daily_statistics (chat_id, record_date, user_id, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_monthly_stats_main ON monthly_statistics (chat_id, statistic_date, user_id, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_groups_config ON groups (chat_id, dual_mode, reset_hour, reset_minute)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_fine_configs_lookup ON fine_configs (activity_name, time_segment)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_shift_state ON group_shift_state (chat_id, shift, shift_start_time)",
                 # ===== 新增索引：针对统计提速与日志清理 =====
                 # 优化 get_group_statistics 中的聚合计算
-                "CREATE INDEX IF NOT EXISTS idx_daily_stats_shift ON daily_statistics(chat_id, record_date, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_daily_stats_shift ON daily_statistics(chat_id, record_date, shift)",
                 # 优化 work_records 的批量范围查询
-                "CREATE INDEX IF NOT EXISTS idx_work_records_shift ON work_records(chat_id, record_date, shift)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_shift ON work_records(chat_id, record_date, shift)",
                 # 优化 cleanup_old_reset_logs 的删除性能
-                "CREATE INDEX IF NOT EXISTS idx_reset_logs_date ON reset_logs(chat_id, reset_date)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_reset_logs_date ON reset_logs(chat_id, reset_date)",
+                # 覆盖 get_activity_rankings / get_monthly_activity_ranking 的 (群, 日期, 活动) 过滤与聚合列，
+                # 日榜与月榜（日期范围）均可走 Index Only Scan
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_activities_rank ON user_activities (chat_id, activity_date, activity_name) INCLUDE (user_id, shift, accumulated_time, activity_count)",
+                # 覆盖月度上下班汇总（计数 / 罚款 / 迟到早退）所需列，按月范围聚合无需回表
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_month ON work_records (chat_id, record_date) INCLUDE (user_id, checkin_type, fine_amount, time_diff_minutes)",
+                # cleanup_old_data 按日期截止批量删除：日期随插入单调增长，与物理顺序高度相关，
+                # BRIN 只记录每段页的最小/最大值，体积极小、维护几乎无开销，可把扫描裁剪到过期页段
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_user_activities_date_brin ON user_activities USING BRIN (activity_date) WITH (pages_per_range = 32)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_work_records_date_brin ON work_records USING BRIN (record_date) WITH (pages_per_range = 32)",
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_daily_stats_date_brin ON daily_statistics USING BRIN (record_date) WITH (pages_per_range = 32)",
             ]
 
-            created_count = 0
-            for index_sql in indexes:
+            # 一次查询取回已有索引及其有效性，已存在且有效的索引无需再发送 DDL
+            index_names = {sql.split()[6]: sql for sql in indexes}
+            existing = await conn.fetch(
+                """
+                SELECT c.relname, i.indisvalid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = ANY($1::text[])
+                """,
+                list(index_names),
+            )
+            valid_names = {row["relname"] for row in existing if row["indisvalid"]}
+
+            # 之前中断的 CONCURRENTLY 构建会留下 INVALID 索引，需先删除再重建
+            for row in existing:
+                if not row["indisvalid"]:
+                    try:
+                        await conn.execute(
+                            f"DROP INDEX CONCURRENTLY IF EXISTS {row['relname']}"
+                        )
+                        logger.warning(f"🧹 已删除无效索引: {row['relname']}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ 删除无效索引失败 ({row['relname']}): {e}")
+
+            # CONCURRENTLY 不能在事务块（含多语句简单查询）中执行，只能逐条发送
+            created_count = len(valid_names)
+            for idx_name, index_sql in index_names.items():
+                if idx_name in valid_names:
+                    continue
                 try:
                     await conn.execute(index_sql)
                     created_count += 1
-                    # 动态解析索引名称用于日志记录
-                    parts = index_sql.split()
-                    idx_name = parts[5] if len(parts) > 5 else "unknown_idx"
                     logger.debug(f"✅ 检查/创建索引: {idx_name}")
                 except Exception as e:
-                    logger.warning(f"⚠️ 创建索引失败 ({index_sql[:30]}...): {e}")
+                    logger.warning(f"⚠️ 创建索引失败 ({idx_name}): {e}")
 
             logger.info(f"🚀 数据库索引优化完成，共处理 {created_count} 个索引项")
 
     async def _initialize_default_data(self):
-        """初始化默认数据"""
+        """初始化默认数据 - 每张表一次 executemany"""
+        activity_rows = [
+            (activity, limits["max_times"], limits["time_limit"])
+            for activity, limits in Config.DEFAULT_ACTIVITY_LIMITS.items()
+        ]
+        fine_rows = [
+            (activity, time_segment, amount)
+            for activity, fines in Config.DEFAULT_FINE_RATES.items()
+            for time_segment, amount in fines.items()
+        ]
+        push_rows = [
+            (key, bool(value))
+            for key, value in Config.AUTO_EXPORT_SETTINGS.items()
+        ]
+
         async with self.pool.acquire() as conn:
-            for activity, limits in Config.DEFAULT_ACTIVITY_LIMITS.items():
-                await conn.execute(
+            async with conn.transaction():
+                await conn.executemany(
                     "INSERT INTO activity_configs (activity_name, max_times, time_limit) VALUES ($1, $2, $3) ON CONFLICT (activity_name) DO NOTHING",
-                    activity,
-                    limits["max_times"],
-                    limits["time_limit"],
+                    activity_rows,
                 )
-                logger.info(f"✅ 初始化活动配置: {activity}")
-
-            for activity, fines in Config.DEFAULT_FINE_RATES.items():
-                for time_segment, amount in fines.items():
-                    await conn.execute(
-                        "INSERT INTO fine_configs (activity_name, time_segment, fine_amount) VALUES ($1, $2, $3) ON CONFLICT (activity_name, time_segment) DO NOTHING",
-                        activity,
-                        time_segment,
-                        amount,
-                    )
-                logger.info(f"✅ 初始化罚款配置: {activity}")
-
-            for key, value in Config.AUTO_EXPORT_SETTINGS.items():
-                await conn.execute(
+                await conn.executemany(
+                    "INSERT INTO fine_configs (activity_name, time_segment, fine_amount) VALUES ($1, $2, $3) ON CONFLICT (activity_name, time_segment) DO NOTHING",
+                    fine_rows,
+                )
+                await conn.executemany(
                     "INSERT INTO push_settings (setting_key, setting_value) VALUES ($1, $2) ON CONFLICT (setting_key) DO NOTHING",
-                    key,
-                    1 if value else 0,
+                    push_rows,
                 )
-                logger.info(f"✅ 初始化推送设置: {key}")
 
-            logger.info("默认数据初始化完成")
+            logger.info(
+                f"✅ 默认数据初始化完成: 活动配置 {len(activity_rows)} 项, "
+                f"罚款配置 {len(fine_rows)} 项, 推送设置 {len(push_rows)} 项"
+            )
 
     async def health_check(self) -> bool:
         """完整的数据库健康检查"""
@@ -1125,78 +1456,82 @@ class PostgreSQLDatabase:
             logger.debug("数据库连接状态已重置")
 
     # ========== 缓存管理 ==========
-    def _get_cached(self, key: str):
-        """增强的缓存获取 - 带访问计数"""
-        import time
-
-        current_time = time.time()
-
-        # 检查是否存在且未过期
-        if key in self._cache_ttl and current_time < self._cache_ttl[key]:
-            # 更新访问次数（用于LRU淘汰）
-            if hasattr(self, "_cache_access_count"):
-                self._cache_access_count[key] = self._cache_access_count.get(key, 0) + 1
-
-            # 更新最后访问时间
-            if hasattr(self, "_cache_last_access"):
-                self._cache_last_access[key] = current_time
-
-            return self._cache.get(key)
-
-        # 缓存过期或不存在
-        if key in self._cache:
-            del self._cache[key]
-        if key in self._cache_ttl:
-            del self._cache_ttl[key]
-        if hasattr(self, "_cache_access_count") and key in self._cache_access_count:
-            del self._cache_access_count[key]
-        if hasattr(self, "_cache_last_access") and key in self._cache_last_access:
-            del self._cache_last_access[key]
+    def _get_cached(self, key: Union[str, tuple]):
+        """缓存获取 - 命中时刷新LRU顺序（过期时间基于单调时钟）"""
+        expiry = self._cache_ttl.get(key)
+        if expiry is None:
+            return None
+        if time.monotonic() < expiry:
+            try:
+                self._cache.move_to_end(key)
+            except KeyError:
+                return None
+            return self._cache[key]
 
+        # 缓存过期
+        self._cache.pop(key, None)
+        self._cache_ttl.pop(key, None)
+        self._unindex_cache_key(key)
         return None
 
-    def _set_cached(self, key: str, value: Any, ttl: int = 30):
-        """增强的缓存设置 - 带大小限制"""
-        import time
-
-        current_time = time.time()
+    def _set_cached(self, key: Union[str, tuple], value: Any, ttl: int = 30):
+        """缓存设置 - 超出容量时淘汰最久未使用项"""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        self._cache_ttl[key] = time.monotonic() + ttl
 
-        # 初始化缓存统计属性
-        if not hasattr(self, "_cache_access_count"):
-            self._cache_access_count = {}
-        if not hasattr(self, "_cache_last_access"):
-            self._cache_last_access = {}
+        # (类型, chat_id, ...) 形式的键登记到群组索引
+        if type(key) is tuple and len(key) > 1:
+            bucket = self._cache_by_chat.get(key[1])
+            if bucket is None:
+                bucket = self._cache_by_chat[key[1]] = set()
+            bucket.add(key)
 
-        # 检查缓存大小，如果过大则执行LRU淘汰
-        max_cache_size = 1000  # 最多缓存1000个用户
-        if len(self._cache) >= max_cache_size:
+        while len(self._cache) > self._cache_max_size:
             self._evict_lru_cache()
 
-        self._cache[key] = value
-        self._cache_ttl[key] = current_time + ttl
-        self._cache_last_access[key] = current_time
-        self._cache_access_count[key] = 1
-
-    def _evict_lru_cache(self):
-        """LRU缓存淘汰 - 移除最久未使用的10%"""
-        if not hasattr(self, "_cache_last_access") or not self._cache_last_access:
-            return
-
-        # 按最后访问时间排序
-        sorted_items = sorted(self._cache_last_access.items(), key=lambda x: x[1])
+    def _unindex_cache_key(self, key: Union[str, tuple]):
+        """从群组索引中移除缓存键"""
+        if type(key) is tuple and len(key) > 1:
+            bucket = self._cache_by_chat.get(key[1])
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._cache_by_chat[key[1]]
+
+    def _pop_cached(self, key: Union[str, tuple]):
+        """移除单个缓存项，同时维护群组索引"""
+        self._cache.pop(key, None)
+        self._cache_ttl.pop(key, None)
+        self._unindex_cache_key(key)
+
+    def _invalidate_chat_cache(self, chat_id: int, kind: str = None) -> int:
+        """清除某群组的缓存项（kind 指定时仅清除该类型），只遍历该群组的索引桶"""
+        bucket = self._cache_by_chat.get(chat_id)
+        if not bucket:
+            return 0
 
-        # 淘汰最旧的20%
-        evict_count = max(1, len(sorted_items) // 5)
-        keys_to_evict = [item[0] for item in sorted_items[:evict_count]]
+        if kind is None:
+            keys = bucket
+            del self._cache_by_chat[chat_id]
+        else:
+            keys = [key for key in bucket if key[0] == kind]
+            bucket.difference_update(keys)
+            if not bucket:
+                del self._cache_by_chat[chat_id]
 
-        for key in keys_to_evict:
+        for key in keys:
             self._cache.pop(key, None)
             self._cache_ttl.pop(key, None)
-            self._cache_last_access.pop(key, None)
-            if hasattr(self, "_cache_access_count"):
-                self._cache_access_count.pop(key, None)
+        return len(keys)
 
-        logger.debug(f"LRU淘汰: 移除了 {evict_count} 个缓存项")
+    def _evict_lru_cache(self):
+        """LRU缓存淘汰 - 移除最久未使用的一项"""
+        if not self._cache:
+            return
+        key, _ = self._cache.popitem(last=False)
+        self._cache_ttl.pop(key, None)
+        self._unindex_cache_key(key)
 
     async def preload_user_cache(self, chat_id: int, user_ids: List[int]):
         """预加载用户缓存 - 批量预热"""
@@ -1220,7 +1555,7 @@ class PostgreSQLDatabase:
                 )
 
                 for row in rows:
-                    cache_key = f"user:{chat_id}:{row['user_id']}"
+                    cache_key = ("user", chat_id, row["user_id"])
                     result = dict(row)
                     self._set_cached(cache_key, result, 30)
 
@@ -1230,8 +1565,8 @@ class PostgreSQLDatabase:
             logger.error(f"预加载用户缓存失败: {e}")
 
     async def cleanup_cache(self):
-        """增强的缓存清理"""
-        current_time = time.time()
+        """清理过期缓存（容量由 _set_cached 的LRU淘汰保证）"""
+        current_time = time.monotonic()
         expired_keys = [
             key for key, expiry in self._cache_ttl.items() if current_time >= expiry
         ]
@@ -1239,18 +1574,7 @@ class PostgreSQLDatabase:
         for key in expired_keys:
             self._cache.pop(key, None)
             self._cache_ttl.pop(key, None)
-            if key in self._cache_access_order:
-                self._cache_access_order.remove(key)
-
-        if len(self._cache) > self._cache_max_size * 0.8:
-            excess = len(self._cache) - int(self._cache_max_size * 0.7)
-            if excess > 0 and self._cache_access_order:
-                keys_to_remove = self._cache_access_order[:excess]
-                for key in keys_to_remove:
-                    self._cache.pop(key, None)
-                    self._cache_ttl.pop(key, None)
-                self._cache_access_order = self._cache_access_order[excess:]
-                logger.info(f"LRU强制清理: 移除了 {len(keys_to_remove)} 个旧缓存")
+            self._unindex_cache_key(key)
 
         if expired_keys:
             logger.debug(
@@ -1259,12 +1583,15 @@ class PostgreSQLDatabase:
 
     async def force_refresh_activity_cache(self):
         """强制刷新活动配置缓存"""
-        cache_keys_to_remove = ["activity_limits", "push_settings", "fine_rates"]
+        cache_keys_to_remove = [
+            "activity_limits",
+            "activity_catalog",
+            "push_settings",
+            "fine_rates",
+        ]
         for key in cache_keys_to_remove:
-            self._cache.pop(key, None)
-            self._cache_ttl.pop(key, None)
-        await self.get_activity_limits()
-        await self.get_fine_rates()
+            self._pop_cached(key)
+        await self.get_activity_catalog()
         logger.info("活动配置缓存已强制刷新")
 
     # ========== 锁管理 ==========
@@ -1306,34 +1633,36 @@ class PostgreSQLDatabase:
     # ========== 群组相关操作 ==========
     async def init_group(self, chat_id: int):
         """初始化群组 - 默认开启双班模式"""
-        await self.execute_with_retry(
+        result = await self.execute_with_retry(
             "初始化群组",
             "INSERT INTO groups (chat_id, dual_mode) VALUES ($1, TRUE) ON CONFLICT (chat_id) DO NOTHING",
             chat_id,
         )
-        self._cache.pop(f"group:{chat_id}", None)
+        self._pop_cached(("group", chat_id))
+        self._business_anchor_cache.pop(chat_id, None)
+        self._reset_cfg_cache.pop(chat_id, None)
+        # 仅在真正新增群组时让群组列表缓存失效
+        if _tag_rowcount(result, "INSERT"):
+            self._pop_cached("all_groups")
 
     async def get_group(self, chat_id: int) -> Optional[Dict]:
         """获取群组配置"""
-        cache_key = f"group:{chat_id}"
+        cache_key = ("group", chat_id)
         cached = self._get_cached(cache_key)
         if cached is not None:
             return cached
 
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT * FROM groups WHERE chat_id = $1", chat_id
-            )
-            if row:
-                result = dict(row)
-                self._set_cached(cache_key, result, 300)
-                return result
-            return None
+        row = await self.pool.fetchrow(_GROUP_ROW_SQL, chat_id)
+        if row:
+            # asyncpg Record 只读且支持 .get/[]，直接缓存，省去 dict 拷贝
+            self._set_cached(cache_key, row, 300)
+            return row
+        return None
 
     async def get_group_cached(self, chat_id: int) -> Optional[Dict]:
-        """带缓存的获取群组配置 - 加强版"""
-        cache_key = f"group:{chat_id}"
+        """带缓存的获取群组配置 - 加强版（返回只读 asyncpg Record）"""
+        cache_key = ("group", chat_id)
 
         # 1. 一级缓存：内存缓存（LRU/TTL 机制）
         cached = self._get_cached(cache_key)
@@ -1344,7 +1673,7 @@ class PostgreSQLDatabase:
             return cached
 
         # 2. 二级缓存：检查是否有正在进行的相同查询（Singleflight 模式）
-        pending_key = f"pending_group:{chat_id}"
+        pending_key = ("group", chat_id)
         if hasattr(self, "_pending_queries") and pending_key in self._pending_queries:
             try:
                 # 共享已有的异步查询任务，避免并发击穿数据库
@@ -1364,13 +1693,12 @@ class PostgreSQLDatabase:
 
                 # 从连接池获取连接并执行查询
                 async with self.pool.acquire() as conn:
-                    row = await conn.fetchrow(
-                        "SELECT * FROM groups WHERE chat_id = $1", chat_id
-                    )
+                    row = await conn.fetchrow(_GROUP_ROW_SQL, chat_id)
 
                     # 明确处理查询结果
                     if row:
-                        result = dict(row)
+                        # 缓存只读 Record，调用方只通过 .get/[] 读取配置
+                        result = row
                         logger.debug(f"✅ 获取群组 {chat_id} 配置成功")
                     else:
                         result = None
@@ -1419,7 +1747,7 @@ class PostgreSQLDatabase:
                 channel_id,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
 
     async def update_group_notification(self, chat_id: int, group_id: int):
         """更新群组通知群组ID"""
@@ -1430,7 +1758,7 @@ class PostgreSQLDatabase:
                 group_id,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
 
     async def update_group_reset_time(self, chat_id: int, hour: int, minute: int):
         """更新群组重置时间"""
@@ -1442,7 +1770,29 @@ class PostgreSQLDatabase:
                 minute,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
+            self._reset_cfg_cache.pop(chat_id, None)
+
+    async def get_reset_config(self, chat_id: int) -> Optional[tuple]:
+        """获取群组每日重置时刻 (reset_hour, reset_minute)，群组不存在时返回 None"""
+        cfg = self._reset_cfg_cache.get(chat_id)
+        if cfg is not None:
+            return cfg
+
+        self._ensure_pool_initialized()
+        row = await self.pool.fetchrow(
+            "SELECT reset_hour, reset_minute FROM groups WHERE chat_id = $1", chat_id
+        )
+        if row is None:
+            return None
+
+        hour, minute = row["reset_hour"], row["reset_minute"]
+        cfg = (
+            Config.DAILY_RESET_HOUR if hour is None else hour,
+            Config.DAILY_RESET_MINUTE if minute is None else minute,
+        )
+        self._reset_cfg_cache[chat_id] = cfg
+        return cfg
 
     async def update_group_work_time(
         self, chat_id: int, work_start: str, work_end: str
@@ -1456,7 +1806,10 @@ class PostgreSQLDatabase:
                 work_end,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
+            self._pop_cached(("work_time", chat_id))
+            self._pop_cached(("work_hours_enabled", chat_id))
+            self._business_anchor_cache.pop(chat_id, None)
 
     async def update_group_extra_work_group(
         self, chat_id: int, extra_work_group_id: int
@@ -1474,7 +1827,7 @@ class PostgreSQLDatabase:
                 extra_work_group_id,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
 
     async def get_extra_work_group(self, chat_id: int) -> Optional[int]:
         """获取额外的上下班通知群组ID"""
@@ -1494,24 +1847,26 @@ class PostgreSQLDatabase:
                 """,
                 chat_id,
             )
-            self._cache.pop(f"group:{chat_id}", None)
+            self._pop_cached(("group", chat_id))
 
     async def get_group_work_time(self, chat_id: int) -> Dict[str, str]:
         """获取群组上下班时间 - 带缓存"""
-        cache_key = f"work_time:{chat_id}"
+        cache_key = ("work_time", chat_id)
 
         # 1. 一级缓存校验
         cached = self._get_cached(cache_key)
         if cached is not None:
             return cached
 
-        # 2. 执行带重试的数据库查询
-        row = await self.execute_with_retry(
-            "获取工作时间",
-            "SELECT work_start_time, work_end_time FROM groups WHERE chat_id = $1",
-            chat_id,
-            fetchrow=True,
-        )
+        # 2. 群组整行已在缓存中时直接复用，否则执行带重试的数据库查询
+        row = self._get_cached(("group", chat_id))
+        if row is None:
+            row = await self.execute_with_retry(
+                "获取工作时间",
+                "SELECT work_start_time, work_end_time FROM groups WHERE chat_id = $1",
+                chat_id,
+                fetchrow=True,
+            )
 
         # 3. 结果解析与兜底策略
         result = {}
@@ -1529,17 +1884,35 @@ class PostgreSQLDatabase:
         return result
 
     async def has_work_hours_enabled(self, chat_id: int) -> bool:
-        """检查是否启用了上下班功能"""
+        """检查是否启用了上下班功能（结果缓存，修改上下班时间时失效）"""
+        # 键盘与活动校验每条消息都会调用，布尔结果单独缓存，命中时免去与默认值的逐项比较
+        cache_key = ("work_hours_enabled", chat_id)
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
         work_hours = await self.get_group_work_time(chat_id)
-        return (
+        enabled = (
             work_hours["work_start"] != Config.DEFAULT_WORK_HOURS["work_start"]
             or work_hours["work_end"] != Config.DEFAULT_WORK_HOURS["work_end"]
         )
+        self._set_cached(cache_key, enabled, 300)
+        return enabled
 
     # ========== 用户相关操作 ==========
     async def init_user(self, chat_id: int, user_id: int, nickname: str = None):
         """初始化用户"""
         today = await self.get_business_date(chat_id)
+
+        # 缓存中已是今日且昵称无变化时，UPSERT 不会改变任何业务字段，直接跳过
+        cached = self._get_cached(("user", chat_id, user_id))
+        if (
+            cached is not None
+            and cached.get("last_updated") == today
+            and (nickname is None or nickname == cached.get("nickname"))
+        ):
+            return
+
         await self.execute_with_retry(
             "初始化用户",
             """
@@ -1556,26 +1929,33 @@ class PostgreSQLDatabase:
             nickname,
             today,
         )
-        self._cache.pop(f"user:{chat_id}:{user_id}", None)
+        self._pop_cached(("user", chat_id, user_id))
 
     async def update_user_last_updated(
         self, chat_id: int, user_id: int, update_date: date
     ):
-        """更新用户最后更新时间"""
+        """更新用户最后更新时间（值未变化时不写，也不失效缓存）"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE users SET last_updated = $1 WHERE chat_id = $2 AND user_id = $3",
-                update_date,
-                chat_id,
-                user_id,
-            )
+        # 重置流程里 reset_user_daily_data 通常已写过同一日期，
+        # IS DISTINCT FROM 让这类重复调用不产生新的行版本
+        result = await self.pool.execute(
+            """
+            UPDATE users SET last_updated = $1
+            WHERE chat_id = $2 AND user_id = $3
+              AND last_updated IS DISTINCT FROM $1
+            """,
+            update_date,
+            chat_id,
+            user_id,
+        )
+        if _tag_rowcount(result, "UPDATE"):
+            self._pop_cached(("user", chat_id, user_id))
 
     async def get_user(self, chat_id: int, user_id: int) -> Optional[Dict]:
         """高性能获取用户数据 - 带二级缓存和查询优化"""
 
         # ===== 1. 一级缓存：内存缓存（最快） =====
-        cache_key = f"user:{chat_id}:{user_id}"
+        cache_key = ("user", chat_id, user_id)
         cached = self._get_cached(cache_key)
         if cached is not None:
             # 缓存命中，记录统计
@@ -1584,7 +1964,7 @@ class PostgreSQLDatabase:
             return cached
 
         # ===== 2. 二级缓存：检查是否有正在进行的查询（防止缓存击穿） =====
-        pending_key = f"pending:{chat_id}:{user_id}"
+        pending_key = ("user", chat_id, user_id)
         if hasattr(self, "_pending_queries") and pending_key in self._pending_queries:
             try:
                 # 等待正在进行的查询结果
@@ -1598,24 +1978,7 @@ class PostgreSQLDatabase:
                 # 使用更精确的字段选择（只选需要的）
                 row = await self.execute_with_retry(
                     "获取用户数据",
-                    """
-                    SELECT 
-                        user_id, 
-                        nickname, 
-                        current_activity, 
-                        activity_start_time, 
-                        total_accumulated_time, 
-                        total_activity_count, 
-                        total_fines,
-                        overtime_count, 
-                        total_overtime_time, 
-                        last_updated,
-                        checkin_message_id, 
-                        shift
-                    FROM users 
-                    WHERE chat_id = $1 AND user_id = $2
-                    LIMIT 1
-                    """,
+                    _USER_ROW_SQL,
                     chat_id,
                     user_id,
                     fetchrow=True,
@@ -1792,21 +2155,14 @@ class PostgreSQLDatabase:
 
     async def get_user_cached(self, chat_id: int, user_id: int) -> Optional[Dict]:
         """带缓存的获取用户数据"""
-        cache_key = f"user:{chat_id}:{user_id}"
+        cache_key = ("user", chat_id, user_id)
         cached = self._get_cached(cache_key)
         if cached is not None:
             return cached
 
         row = await self.execute_with_retry(
             "获取用户数据",
-            """
-            SELECT user_id, nickname, current_activity, activity_start_time, 
-                   total_accumulated_time, total_activity_count, total_fines,
-                   overtime_count, total_overtime_time, last_updated, 
-                   checkin_message_id, shift
-            FROM users 
-            WHERE chat_id = $1 AND user_id = $2
-            """,
+            _USER_ROW_SQL,
             chat_id,
             user_id,
             fetchrow=True,
@@ -1823,6 +2179,51 @@ class PostgreSQLDatabase:
             return result
         return None
 
+    async def get_users_bulk(self, pairs: List[tuple]) -> List[Optional[Dict]]:
+        """批量获取用户数据 - 缓存未命中的 (chat_id, user_id) 合并为一次查询"""
+        results: List[Optional[Dict]] = [None] * len(pairs)
+        misses: Dict[tuple, List[int]] = {}
+
+        for index, (chat_id, user_id) in enumerate(pairs):
+            cached = self._get_cached(("user", chat_id, user_id))
+            if cached is not None:
+                results[index] = cached
+            else:
+                misses.setdefault((chat_id, user_id), []).append(index)
+
+        if not misses:
+            return results
+
+        rows = await self.execute_with_retry(
+            "批量获取用户数据",
+            """
+            SELECT u.chat_id, u.user_id, u.nickname, u.current_activity,
+                   u.activity_start_time, u.total_accumulated_time,
+                   u.total_activity_count, u.total_fines, u.overtime_count,
+                   u.total_overtime_time, u.last_updated,
+                   u.checkin_message_id, u.shift
+            FROM users u
+            JOIN unnest($1::bigint[], $2::bigint[]) AS k(chat_id, user_id)
+              ON u.chat_id = k.chat_id AND u.user_id = k.user_id
+            """,
+            [key[0] for key in misses],
+            [key[1] for key in misses],
+            fetch=True,
+        )
+
+        for row in rows or []:
+            result = dict(row)
+            chat_id = result.pop("chat_id")
+            if result.get("shift") is None:
+                result["shift"] = "day"
+
+            self._set_cached(("user", chat_id, result["user_id"]), result, 30)
+            for index in misses.get((chat_id, result["user_id"]), []):
+                results[index] = result
+
+        logger.debug(f"批量获取用户: 共 {len(pairs)} 个, 查询 {len(misses)} 个")
+        return results
+
     async def update_user_activity(
         self,
         chat_id: int,
@@ -1869,37 +2270,23 @@ class PostgreSQLDatabase:
                 f"💾 保存活动时间: 用户{user_id}, 活动{activity}, 标准化时间: {start_time_str}, 班次: {shift}"
             )
 
-            if nickname:
-                await self.execute_with_retry(
-                    "更新用户活动",
-                    """
-                    UPDATE users 
-                    SET current_activity = $1, activity_start_time = $2, nickname = $3, shift = $4, updated_at = CURRENT_TIMESTAMP 
-                    WHERE chat_id = $5 AND user_id = $6
-                    """,
-                    activity,
-                    start_time_str,
-                    nickname,
-                    shift,
-                    chat_id,
-                    user_id,
-                )
-            else:
-                await self.execute_with_retry(
-                    "更新用户活动",
-                    """
-                    UPDATE users 
-                    SET current_activity = $1, activity_start_time = $2, shift = $3, updated_at = CURRENT_TIMESTAMP 
-                    WHERE chat_id = $4 AND user_id = $5
-                    """,
-                    activity,
-                    start_time_str,
-                    shift,
-                    chat_id,
-                    user_id,
-                )
+            # 昵称为空时 COALESCE 保留原值，单一语句文本保证预编译缓存命中
+            await self.execute_with_retry(
+                "更新用户活动",
+                """
+                UPDATE users 
+                SET current_activity = $1, activity_start_time = $2, nickname = COALESCE($3, nickname), shift = $4, updated_at = CURRENT_TIMESTAMP 
+                WHERE chat_id = $5 AND user_id = $6
+                """,
+                activity,
+                start_time_str,
+                nickname or None,
+                shift,
+                chat_id,
+                user_id,
+            )
 
-            self._cache.pop(f"user:{chat_id}:{user_id}", None)
+            self._pop_cached(("user", chat_id, user_id))
 
             logger.debug(
                 f"✅ 用户活动更新成功: {chat_id}-{user_id} -> {activity}（班次: {shift}）"
@@ -1928,9 +2315,8 @@ class PostgreSQLDatabase:
                 chat_id,
                 user_id,
             )
-        cache_key = f"user:{chat_id}:{user_id}"
-        self._cache.pop(cache_key, None)
-        self._cache_ttl.pop(cache_key, None)
+        cache_key = ("user", chat_id, user_id)
+        self._pop_cached(cache_key)
         logger.info(f"✅ 已更新用户 {user_id} 的打卡消息ID为 {message_id}，并清除缓存")
 
     async def get_user_checkin_message_id(
@@ -1953,7 +2339,7 @@ class PostgreSQLDatabase:
                 chat_id,
                 user_id,
             )
-        self._cache.pop(f"user:{chat_id}:{user_id}", None)
+        self._pop_cached(("user", chat_id, user_id))
 
     async def update_pending_reply_message(
         self, chat_id: int, user_id: int, message_id: int
@@ -1971,9 +2357,8 @@ class PostgreSQLDatabase:
                 chat_id,
                 user_id,
             )
-        cache_key = f"user:{chat_id}:{user_id}"
-        self._cache.pop(cache_key, None)
-        self._cache_ttl.pop(cache_key, None)
+        cache_key = ("user", chat_id, user_id)
+        self._pop_cached(cache_key)
         logger.debug(f"✅ 已更新用户 {user_id} 的待回复消息ID为 {message_id}")
 
     async def get_pending_reply_message(
@@ -1996,9 +2381,8 @@ class PostgreSQLDatabase:
                 chat_id,
                 user_id,
             )
-        cache_key = f"user:{chat_id}:{user_id}"
-        self._cache.pop(cache_key, None)
-        self._cache_ttl.pop(cache_key, None)
+        cache_key = ("user", chat_id, user_id)
+        self._pop_cached(cache_key)
 
     # ====== 核心业务方法 ======
     async def complete_user_activity(
@@ -2037,47 +2421,19 @@ class PostgreSQLDatabase:
         # 4. 确保连接池
         self._ensure_pool_initialized()
 
-        # 5. 准备参数
-        user_params = (
-            chat_id,
-            user_id,
-            target_date,
-            elapsed_time,
-            fine_amount,
-            1 if is_overtime else 0,
-            overtime_seconds,
-        )
-
-        daily_params = (
+        # 5. 准备参数（单条语句一次往返，参数只传一次）
+        params = (
             chat_id,
             user_id,
             target_date,
-            shift,
-            elapsed_time,
-            fine_amount,
-            1 if is_overtime else 0,
-            overtime_seconds,
-        )
-
-        monthly_params = (
-            chat_id,
-            user_id,
             statistic_date,
             shift,
+            activity,
             elapsed_time,
             fine_amount,
             1 if is_overtime else 0,
             overtime_seconds,
-        )
-
-        activity_params = (
-            chat_id,
-            user_id,
-            target_date,
-            activity,
-            1,  # activity_count
-            elapsed_time,
-            shift,
+            f"用户{user_id}",
         )
 
         # 6. 重试事务
@@ -2087,101 +2443,85 @@ class PostgreSQLDatabase:
                 async with asyncio.timeout(transaction_timeout):
                     async with self.pool.acquire() as conn:
                         async with conn.transaction():
-
-                            # 6.1 确保用户存在
-                            await conn.execute(
-                                """
-                                INSERT INTO users (chat_id, user_id, nickname, last_updated)
-                                VALUES ($1, $2, $3, $4)
-                                ON CONFLICT (chat_id, user_id) DO NOTHING
-                                """,
-                                chat_id,
-                                user_id,
-                                f"用户{user_id}",
-                                target_date,
-                            )
-
-                            # 6.2 更新用户统计
-                            await conn.execute(
-                                """
-                                UPDATE users SET
-                                    total_accumulated_time = total_accumulated_time + $4,
-                                    total_activity_count = total_activity_count + 1,
-                                    total_fines = total_fines + $5,
-                                    overtime_count = overtime_count + $6,
-                                    total_overtime_time = total_overtime_time + $7,
-                                    current_activity = NULL,
-                                    activity_start_time = NULL,
-                                    checkin_message_id = NULL,
-                                    last_updated = $3,
-                                    updated_at = CURRENT_TIMESTAMP
-                                WHERE chat_id = $1 AND user_id = $2
-                                """,
-                                *user_params,
-                            )
-
-                            # 6.3 更新日统计
-                            await conn.execute(
-                                """
-                                INSERT INTO daily_statistics (
-                                    chat_id, user_id, record_date, shift,
-                                    activity_count, accumulated_time, fine_amount,
-                                    overtime_count, overtime_time
-                                )
-                                VALUES ($1, $2, $3, $4, 1, $5, $6, $7, $8)
-                                ON CONFLICT (chat_id, user_id, record_date, shift)
-                                DO UPDATE SET
-                                    activity_count = daily_statistics.activity_count + 1,
-                                    accumulated_time = daily_statistics.accumulated_time + $5,
-                                    fine_amount = daily_statistics.fine_amount + $6,
-                                    overtime_count = daily_statistics.overtime_count + $7,
-                                    overtime_time = daily_statistics.overtime_time + $8,
-                                    updated_at = CURRENT_TIMESTAMP
-                                """,
-                                *daily_params,
-                            )
-
-                            # 6.4 更新月统计
-                            await conn.execute(
-                                """
-                                INSERT INTO monthly_statistics (
-                                    chat_id, user_id, statistic_date, shift,
-                                    activity_count, accumulated_time, fine_amount,
-                                    overtime_count, overtime_time
-                                )
-                                VALUES ($1, $2, $3, $4, 1, $5, $6, $7, $8)
-                                ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                                DO UPDATE SET
-                                    activity_count = monthly_statistics.activity_count + 1,
-                                    accumulated_time = monthly_statistics.accumulated_time + $5,
-                                    fine_amount = monthly_statistics.fine_amount + $6,
-                                    overtime_count = monthly_statistics.overtime_count + $7,
-                                    overtime_time = monthly_statistics.overtime_time + $8,
-                                    updated_at = CURRENT_TIMESTAMP
-                                """,
-                                *monthly_params,
-                            )
-                            # 6.5 更新user_activities 表
+                            # 用户统计 / 日统计 / 月统计 / 活动明细 合并为一条 CTE
                             await conn.execute(
                                 """
-                                INSERT INTO user_activities (
-                                    chat_id, user_id, activity_date, activity_name,
-                                    activity_count, accumulated_time, shift
+                                WITH u AS (
+                                    INSERT INTO users (
+                                        chat_id, user_id, nickname, last_updated,
+                                        total_accumulated_time, total_activity_count,
+                                        total_fines, overtime_count, total_overtime_time
+                                    )
+                                    VALUES ($1, $2, $11, $3, $7, 1, $8, $9, $10)
+                                    ON CONFLICT (chat_id, user_id)
+                                    DO UPDATE SET
+                                        total_accumulated_time = users.total_accumulated_time + $7,
+                                        total_activity_count = users.total_activity_count + 1,
+                                        total_fines = users.total_fines + $8,
+                                        overtime_count = users.overtime_count + $9,
+                                        total_overtime_time = users.total_overtime_time + $10,
+                                        current_activity = NULL,
+                                        activity_start_time = NULL,
+                                        checkin_message_id = NULL,
+                                        last_updated = $3,
+                                        updated_at = CURRENT_TIMESTAMP
+                                    RETURNING 1
+                                ),
+                                d AS (
+                                    INSERT INTO daily_statistics (
+                                        chat_id, user_id, record_date, shift,
+                                        activity_count, accumulated_time, fine_amount,
+                                        overtime_count, overtime_time
+                                    )
+                                    VALUES ($1, $2, $3, $5, 1, $7, $8, $9, $10)
+                                    ON CONFLICT (chat_id, user_id, record_date, shift)
+                                    DO UPDATE SET
+                                        activity_count = daily_statistics.activity_count + 1,
+                                        accumulated_time = daily_statistics.accumulated_time + $7,
+                                        fine_amount = daily_statistics.fine_amount + $8,
+                                        overtime_count = daily_statistics.overtime_count + $9,
+                                        overtime_time = daily_statistics.overtime_time + $10,
+                                        updated_at = CURRENT_TIMESTAMP
+                                    RETURNING 1
+                                ),
+                                m AS (
+                                    INSERT INTO monthly_statistics (
+                                        chat_id, user_id, statistic_date, shift,
+                                        activity_count, accumulated_time, fine_amount,
+                                        overtime_count, overtime_time
+                                    )
+                                    VALUES ($1, $2, $4, $5, 1, $7, $8, $9, $10)
+                                    ON CONFLICT (chat_id, user_id, statistic_date, shift)
+                                    DO UPDATE SET
+                                        activity_count = monthly_statistics.activity_count + 1,
+                                        accumulated_time = monthly_statistics.accumulated_time + $7,
+                                        fine_amount = monthly_statistics.fine_amount + $8,
+                                        overtime_count = monthly_statistics.overtime_count + $9,
+                                        overtime_time = monthly_statistics.overtime_time + $10,
+                                        updated_at = CURRENT_TIMESTAMP
+                                    RETURNING 1
+                                ),
+                                a AS (
+                                    INSERT INTO user_activities (
+                                        chat_id, user_id, activity_date, activity_name,
+                                        activity_count, accumulated_time, shift
+                                    )
+                                    VALUES ($1, $2, $3, $6, 1, $7, $5)
+                                    ON CONFLICT (chat_id, user_id, activity_date, activity_name, shift)
+                                    DO UPDATE SET
+                                        activity_count = user_activities.activity_count + EXCLUDED.activity_count,
+                                        accumulated_time = user_activities.accumulated_time + EXCLUDED.accumulated_time,
+                                        updated_at = CURRENT_TIMESTAMP
+                                    RETURNING 1
                                 )
-                                VALUES ($1, $2, $3, $4, $5, $6, $7)
-                                ON CONFLICT (chat_id, user_id, activity_date, activity_name, shift)
-                                DO UPDATE SET
-                                    activity_count = user_activities.activity_count + EXCLUDED.activity_count,
-                                    accumulated_time = user_activities.accumulated_time + EXCLUDED.accumulated_time,
-                                    updated_at = CURRENT_TIMESTAMP
+                                SELECT 1
                                 """,
-                                *activity_params,
+                                *params,
                             )
 
                 # 7. 清理缓存
-                cache_key = f"user:{chat_id}:{user_id}"
-                self._cache.pop(cache_key, None)
-                self._cache_ttl.pop(cache_key, None)
+                cache_key = ("user", chat_id, user_id)
+                self._pop_cached(cache_key)
 
                 # 8. 日志记录
                 logger.info(
@@ -2222,6 +2562,9 @@ class PostgreSQLDatabase:
             completed_count = 0
             total_fines = 0
 
+            # 活动时间限制在取连接前读取，缓存未命中时不占用事务连接
+            activity_limits = await self.get_activity_limits()
+
             self._ensure_pool_initialized()
             async with self.pool.acquire() as conn:
                 async with conn.transaction():
@@ -2240,7 +2583,9 @@ class PostgreSQLDatabase:
                         return {"completed_count": 0, "total_fines": 0, "details": []}
 
                     completion_details = []
+                    settlement_rows = []
                     statistic_date = reset_time.date().replace(day=1)
+                    reset_ts = reset_time.timestamp()
 
                     for user in active_users:
                         user_id = user["user_id"]
@@ -2251,10 +2596,14 @@ class PostgreSQLDatabase:
 
                         try:
                             start_time = datetime.fromisoformat(start_time_str)
-                            elapsed = int((reset_time - start_time).total_seconds())
+                            if start_time.tzinfo is None:
+                                start_time = start_time.replace(tzinfo=_BEIJING_FIXED_TZ)
+                            elapsed = int(reset_ts - start_time.timestamp())
 
                             # 获取活动时间限制
-                            time_limit = await self.get_activity_time_limit(activity)
+                            time_limit = activity_limits.get(activity, {}).get(
+                                "time_limit", 0
+                            )
                             time_limit_seconds = time_limit * 60
                             is_overtime = elapsed > time_limit_seconds
                             overtime_seconds = max(0, elapsed - time_limit_seconds)
@@ -2263,23 +2612,29 @@ class PostgreSQLDatabase:
                             # 计算罚款
                             fine_amount = 0
                             if is_overtime and overtime_seconds > 0:
-                                fine_amount = await self.calculate_fine_for_activity(
-                                    activity, overtime_minutes
+                                # 复用当前连接读取罚款分段，避免事务内再向连接池借连接
+                                schedule = await self.get_fine_schedule_for_activity(
+                                    activity, conn=conn
+                                )
+                                fine_amount = self.lookup_fine(
+                                    schedule, overtime_minutes
                                 )
 
-                            # ✅ 修复：传入 activity_date 和 shift
-                            await self._update_monthly_statistics_for_activity(
-                                conn=conn,
-                                chat_id=chat_id,
-                                user_id=user_id,
-                                statistic_date=statistic_date,
-                                activity=activity,
-                                elapsed=elapsed,
-                                fine_amount=fine_amount,
-                                is_overtime=is_overtime,
-                                overtime_seconds=overtime_seconds,
-                                shift=shift,  # ✅ 传入班次
-                                activity_date=start_time.date(),  # ✅ 传入实际活动日期
+                            # 先暂存每个用户的结算参数，循环结束后 executemany 一次写入
+                            elapsed = max(0, elapsed)
+                            settlement_rows.append(
+                                (
+                                    chat_id,
+                                    user_id,
+                                    statistic_date,
+                                    shift,
+                                    elapsed,
+                                    max(0, fine_amount),
+                                    1 if (is_overtime and overtime_seconds > 0) else 0,
+                                    overtime_seconds,
+                                    start_time.date(),  # 实际活动日期
+                                    activity,
+                                )
                             )
 
                             completed_count += 1
@@ -2296,14 +2651,19 @@ class PostgreSQLDatabase:
                                 }
                             )
 
-                            logger.info(
-                                f"重置前结束活动: {chat_id}-{user_id} - {activity} "
-                                f"(时长: {elapsed}秒, 罚款: {fine_amount}元, 班次: {shift})"
-                            )
-
                         except Exception as e:
                             logger.error(f"结束用户活动失败 {chat_id}-{user_id}: {e}")
 
+                    # 批量写入 月统计 / 活动明细 / 用户罚款
+                    if settlement_rows:
+                        await conn.executemany(_MONTHLY_ACTIVITY_SQL, settlement_rows)
+
+                    for detail, row in zip(completion_details, settlement_rows):
+                        logger.info(
+                            f"重置前结束活动: {chat_id}-{detail['user_id']} - {detail['activity']} "
+                            f"(时长: {detail['elapsed_time']}秒, 罚款: {detail['fine_amount']}元, 班次: {row[3]})"
+                        )
+
                     # 清理用户活动状态
                     await conn.execute(
                         """
@@ -2428,24 +2788,10 @@ class PostgreSQLDatabase:
 
         # ===== 5. 开始事务操作 =====
         try:
-            # ===== 5.1 更新 monthly_statistics（宽表版本）=====
+            # ===== 5.1 月统计 / 活动明细 / 用户罚款 合并为一条固定文本语句 =====
+            # 罚款为 0 时由 SQL 条件跳过 users 更新，语句文本不随参数变化，可命中预编译缓存
             await conn.execute(
-                """
-                INSERT INTO monthly_statistics (
-                    chat_id, user_id, statistic_date, shift,
-                    activity_count, accumulated_time, fine_amount,
-                    overtime_count, overtime_time
-                )
-                VALUES ($1, $2, $3, $4, 1, $5, $6, $7, $8)
-                ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                DO UPDATE SET
-                    activity_count = monthly_statistics.activity_count + 1,
-                    accumulated_time = monthly_statistics.accumulated_time + $5,
-                    fine_amount = monthly_statistics.fine_amount + $6,
-                    overtime_count = monthly_statistics.overtime_count + $7,
-                    overtime_time = monthly_statistics.overtime_time + $8,
-                    updated_at = CURRENT_TIMESTAMP
-                """,
+                _MONTHLY_ACTIVITY_SQL,
                 chat_id,
                 user_id,
                 statistic_date,
@@ -2454,44 +2800,10 @@ class PostgreSQLDatabase:
                 fine_amount,  # fine_amount
                 has_overtime,  # overtime_count
                 overtime_seconds,  # overtime_time
+                activity_date,  # 使用实际的活动日期
+                activity,
             )
 
-            # ===== 5.2 更新 user_activities 表（详细记录）=====
-            await conn.execute(
-                """
-                INSERT INTO user_activities (
-                    chat_id, user_id, activity_date, activity_name,
-                    activity_count, accumulated_time, shift
-                )
-                VALUES ($1, $2, $3, $4, 1, $5, $6)
-                ON CONFLICT (chat_id, user_id, activity_date, activity_name, shift)
-                DO UPDATE SET
-                    activity_count = user_activities.activity_count + 1,
-                    accumulated_time = user_activities.accumulated_time + $5,
-                    updated_at = CURRENT_TIMESTAMP
-                """,
-                chat_id,
-                user_id,
-                activity_date,  # 使用实际的活动日期
-                activity,
-                elapsed,
-                shift,
-            )
-
-            # ===== 5.3 如果有罚款，更新用户总罚款 =====
-            if fine_amount > 0:
-                await conn.execute(
-                    """
-                    UPDATE users
-                    SET total_fines = total_fines + $1,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE chat_id = $2 AND user_id = $3
-                    """,
-                    fine_amount,
-                    chat_id,
-                    user_id,
-                )
-
             logger.debug(
                 f"✅ [_update_monthly_statistics_for_activity] 成功\n"
                 f"   ├─ monthly_statistics 更新: +1次, +{elapsed}秒\n"
@@ -2560,16 +2872,13 @@ class PostgreSQLDatabase:
         try:
             # ===== 0. 确定业务日期 =====
             if target_date is None:
-                target_date = await self.get_business_date(chat_id)
+                target_date = business_date = await self.get_business_date(chat_id)
             elif not isinstance(target_date, date):
                 raise ValueError(
                     f"target_date必须是date类型，得到: {type(target_date)}"
                 )
-
-            # ===== 1. 并行获取用户状态与业务日期 =====
-            user_before, business_date = await asyncio.gather(
-                self.get_user(chat_id, user_id), self.get_business_date(chat_id)
-            )
+            else:
+                business_date = await self.get_business_date(chat_id)
 
             cross_day = {"activity": None, "duration": 0, "fine": 0}
             new_date = max(target_date, business_date)
@@ -2577,70 +2886,65 @@ class PostgreSQLDatabase:
             async with self.pool.acquire() as conn:
                 async with conn.transaction():
 
-                    # ===== 2. 获取当天 daily_statistics =====
-                    stats_row = await conn.fetchrow(
+                    # ===== 1. 同一连接内锁定并读取用户当前状态（不走缓存，避免漏结算进行中的活动） =====
+                    user_before = await conn.fetchrow(
+                        """
+                        SELECT current_activity, activity_start_time, shift
+                        FROM users
+                        WHERE chat_id = $1 AND user_id = $2
+                        FOR UPDATE
+                        """,
+                        chat_id,
+                        user_id,
+                    )
+
+                    # ===== 2-3. 日统计（所有班次）一条 INSERT ... SELECT 转入月统计 =====
+                    await conn.execute(
                         """
-                        SELECT * FROM daily_statistics
+                        INSERT INTO monthly_statistics
+                        (chat_id, user_id, statistic_date, shift,
+                         activity_count, accumulated_time, fine_amount,
+                         overtime_count, overtime_time,
+                         work_days, work_hours,
+                         work_start_count, work_end_count,
+                         work_start_fines, work_end_fines,
+                         late_count, early_count)
+                        SELECT
+                            chat_id, user_id, $4::date, COALESCE(shift, 'day'),
+                            COALESCE(activity_count, 0), COALESCE(accumulated_time, 0),
+                            COALESCE(fine_amount, 0), COALESCE(overtime_count, 0),
+                            COALESCE(overtime_time, 0),
+                            COALESCE(work_days, 0), COALESCE(work_hours, 0),
+                            COALESCE(work_start_count, 0), COALESCE(work_end_count, 0),
+                            COALESCE(work_start_fines, 0), COALESCE(work_end_fines, 0),
+                            COALESCE(late_count, 0), COALESCE(early_count, 0)
+                        FROM daily_statistics
                         WHERE chat_id=$1 AND user_id=$2 AND record_date=$3
+                        ON CONFLICT (chat_id,user_id,statistic_date,shift)
+                        DO UPDATE SET
+                            activity_count = monthly_statistics.activity_count + EXCLUDED.activity_count,
+                            accumulated_time = monthly_statistics.accumulated_time + EXCLUDED.accumulated_time,
+                            fine_amount = monthly_statistics.fine_amount + EXCLUDED.fine_amount,
+                            overtime_count = monthly_statistics.overtime_count + EXCLUDED.overtime_count,
+                            overtime_time = monthly_statistics.overtime_time + EXCLUDED.overtime_time,
+                            work_days = monthly_statistics.work_days + EXCLUDED.work_days,
+                            work_hours = monthly_statistics.work_hours + EXCLUDED.work_hours,
+                            work_start_count = monthly_statistics.work_start_count + EXCLUDED.work_start_count,
+                            work_end_count = monthly_statistics.work_end_count + EXCLUDED.work_end_count,
+                            work_start_fines = monthly_statistics.work_start_fines + EXCLUDED.work_start_fines,
+                            work_end_fines = monthly_statistics.work_end_fines + EXCLUDED.work_end_fines,
+                            late_count = monthly_statistics.late_count + EXCLUDED.late_count,
+                            early_count = monthly_statistics.early_count + EXCLUDED.early_count,
+                            updated_at = CURRENT_TIMESTAMP
                         """,
                         chat_id,
                         user_id,
                         target_date,
+                        target_date.replace(day=1),
                     )
 
-                    # ===== 3. 日统计转入月统计（完整字段）=====
-                    if stats_row:
-                        statistic_date = target_date.replace(day=1)
-                        shift = stats_row.get("shift", "day")
-
-                        await conn.execute(
-                            """
-                            INSERT INTO monthly_statistics
-                            (chat_id, user_id, statistic_date, shift,
-                             activity_count, accumulated_time, fine_amount,
-                             overtime_count, overtime_time,
-                             work_days, work_hours,
-                             work_start_count, work_end_count,
-                             work_start_fines, work_end_fines,
-                             late_count, early_count)
-                            VALUES ($1,$2,$3,$4, $5,$6,$7,$8,$9, $10,$11, $12,$13, $14,$15, $16,$17)
-                            ON CONFLICT (chat_id,user_id,statistic_date,shift)
-                            DO UPDATE SET
-                                activity_count = monthly_statistics.activity_count + EXCLUDED.activity_count,
-                                accumulated_time = monthly_statistics.accumulated_time + EXCLUDED.accumulated_time,
-                                fine_amount = monthly_statistics.fine_amount + EXCLUDED.fine_amount,
-                                overtime_count = monthly_statistics.overtime_count + EXCLUDED.overtime_count,
-                                overtime_time = monthly_statistics.overtime_time + EXCLUDED.overtime_time,
-                                work_days = monthly_statistics.work_days + EXCLUDED.work_days,
-                                work_hours = monthly_statistics.work_hours + EXCLUDED.work_hours,
-                                work_start_count = monthly_statistics.work_start_count + EXCLUDED.work_start_count,
-                                work_end_count = monthly_statistics.work_end_count + EXCLUDED.work_end_count,
-                                work_start_fines = monthly_statistics.work_start_fines + EXCLUDED.work_start_fines,
-                                work_end_fines = monthly_statistics.work_end_fines + EXCLUDED.work_end_fines,
-                                late_count = monthly_statistics.late_count + EXCLUDED.late_count,
-                                early_count = monthly_statistics.early_count + EXCLUDED.early_count,
-                                updated_at = CURRENT_TIMESTAMP
-                            """,
-                            chat_id,
-                            user_id,
-                            statistic_date,
-                            shift,
-                            stats_row["activity_count"] or 0,
-                            stats_row["accumulated_time"] or 0,
-                            stats_row["fine_amount"] or 0,
-                            stats_row["overtime_count"] or 0,
-                            stats_row["overtime_time"] or 0,
-                            stats_row["work_days"] or 0,
-                            stats_row["work_hours"] or 0,
-                            stats_row["work_start_count"] or 0,
-                            stats_row["work_end_count"] or 0,
-                            stats_row["work_start_fines"] or 0,
-                            stats_row["work_end_fines"] or 0,
-                            stats_row["late_count"] or 0,
-                            stats_row["early_count"] or 0,
-                        )
-
-                    # ===== 4. 处理跨天活动 =====
+                    # ===== 4. 处理跨天活动（此处只计算，写入与第 5-6 步同一条语句）=====
+                    settlement = (None,) * 6
                     if user_before and user_before.get("current_activity"):
                         act = user_before["current_activity"]
                         start_str = user_before.get("activity_start_time")
@@ -2648,83 +2952,37 @@ class PostgreSQLDatabase:
                         if start_str:
                             try:
                                 start_dt = datetime.fromisoformat(start_str)
-                                now_dt = self.get_beijing_time()
-                                elapsed_sec = int((now_dt - start_dt).total_seconds())
+                                if start_dt.tzinfo is None:
+                                    start_dt = start_dt.replace(tzinfo=_BEIJING_FIXED_TZ)
+                                # 直接用 epoch 秒相减，无需再构造带时区的当前时间
+                                elapsed_sec = int(time.time() - start_dt.timestamp())
 
-                                # 并行获取活动时间限制 & 罚款规则
-                                limit_min, fine_rates = await asyncio.gather(
-                                    self.get_activity_time_limit(act),
-                                    self.get_fine_rates_for_activity(act),
-                                )
+                                # 活动时间限制走缓存；只有超时才需要罚款分段（未命中缓存时复用当前连接查询）
+                                limit_min = await self.get_activity_time_limit(act)
 
                                 overtime_sec = max(0, elapsed_sec - limit_min * 60)
                                 fine_amount = 0
-                                if overtime_sec > 0 and fine_rates:
-                                    overtime_min = overtime_sec / 60
-                                    segments = sorted(
-                                        [
-                                            int(str(k).lower().replace("min", ""))
-                                            for k in fine_rates.keys()
-                                            if str(k)
-                                            .lower()
-                                            .replace("min", "")
-                                            .isdigit()
-                                        ]
-                                    )
-                                    for s in segments:
-                                        if overtime_min <= s:
-                                            fine_amount = fine_rates.get(
-                                                str(s), fine_rates.get(f"{s}min", 0)
-                                            )
-                                            break
-                                    if fine_amount == 0 and segments:
-                                        s = segments[-1]
-                                        fine_amount = fine_rates.get(
-                                            str(s), fine_rates.get(f"{s}min", 0)
+                                if overtime_sec > 0:
+                                    fine_schedule = (
+                                        await self.get_fine_schedule_for_activity(
+                                            act, conn=conn
                                         )
+                                    )
+                                    fine_amount = self.lookup_fine(
+                                        fine_schedule, overtime_sec / 60
+                                    )
 
-                                activity_month = start_dt.date().replace(day=1)
-                                shift = user_before.get("shift", "day")
-
-                                # 使用 UPSERT 更新月度统计
-                                await conn.execute(
-                                    """
-                                    INSERT INTO monthly_statistics
-                                    (chat_id, user_id, statistic_date, shift,
-                                     activity_count, accumulated_time, fine_amount,
-                                     overtime_count, overtime_time)
-                                    VALUES ($1,$2,$3,$4, 1, $5, $6, $7, $8)
-                                    ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                                    DO UPDATE SET
-                                        activity_count = monthly_statistics.activity_count + 1,
-                                        accumulated_time = monthly_statistics.accumulated_time + $5,
-                                        fine_amount = monthly_statistics.fine_amount + $6,
-                                        overtime_count = monthly_statistics.overtime_count + $7,
-                                        overtime_time = monthly_statistics.overtime_time + $8,
-                                        updated_at = CURRENT_TIMESTAMP
-                                    """,
-                                    chat_id,
-                                    user_id,
-                                    activity_month,
-                                    shift,
+                                # 月度统计写入并入下方删除/重置语句，不单独往返
+                                settlement = (
+                                    start_dt.date().replace(day=1),
+                                    user_before.get("shift") or "day",
                                     elapsed_sec,
                                     fine_amount,
                                     1 if overtime_sec > 0 else 0,
                                     overtime_sec,
                                 )
 
-                                if fine_amount > 0:
-                                    await conn.execute(
-                                        """
-                                        UPDATE users
-                                        SET total_fines = total_fines + $1
-                                        WHERE chat_id=$2 AND user_id=$3
-                                        """,
-                                        fine_amount,
-                                        chat_id,
-                                        user_id,
-                                    )
-
+                                # 用户累计罚款会在下方重置用户表时清零，无需单独 UPDATE
                                 cross_day.update(
                                     {
                                         "activity": act,
@@ -2736,78 +2994,99 @@ class PostgreSQLDatabase:
                             except Exception as e:
                                 logger.error(f"❌ 跨天活动结算失败: {e}")
 
-                    # ===== 5. 删除当日数据（并行执行，捕获返回值）=====
-                    daily_deleted, act_deleted, work_deleted = await asyncio.gather(
-                        conn.execute(
-                            "DELETE FROM daily_statistics WHERE chat_id=$1 AND user_id=$2 AND record_date=$3",
-                            chat_id,
-                            user_id,
-                            target_date,
+                    # ===== 5-6. 跨天结算入月统计 + 删除当日数据 + 重置用户表（单条 CTE，一次往返）=====
+                    # 同一连接上不能并发执行多条语句，合并为一条语句既安全又省往返
+                    deleted = await conn.fetchrow(
+                        """
+                        WITH s AS (
+                            INSERT INTO monthly_statistics
+                            (chat_id, user_id, statistic_date, shift,
+                             activity_count, accumulated_time, fine_amount,
+                             overtime_count, overtime_time)
+                            SELECT $1, $2, $5::date, $6::text, 1,
+                                   $7::integer, $8::integer, $9::integer, $10::integer
+                            WHERE $6::text IS NOT NULL
+                            ON CONFLICT (chat_id, user_id, statistic_date, shift)
+                            DO UPDATE SET
+                                activity_count = monthly_statistics.activity_count + 1,
+                                accumulated_time = monthly_statistics.accumulated_time + EXCLUDED.accumulated_time,
+                                fine_amount = monthly_statistics.fine_amount + EXCLUDED.fine_amount,
+                                overtime_count = monthly_statistics.overtime_count + EXCLUDED.overtime_count,
+                                overtime_time = monthly_statistics.overtime_time + EXCLUDED.overtime_time,
+                                updated_at = CURRENT_TIMESTAMP
+                            RETURNING 1
                         ),
-                        conn.execute(
-                            "DELETE FROM user_activities WHERE chat_id=$1 AND user_id=$2 AND activity_date=$3",
-                            chat_id,
-                            user_id,
-                            target_date,
+                        d1 AS (
+                            DELETE FROM daily_statistics
+                            WHERE chat_id=$1 AND user_id=$2 AND record_date=$3
+                            RETURNING 1
                         ),
-                        conn.execute(
-                            "DELETE FROM work_records WHERE chat_id=$1 AND user_id=$2 AND record_date=$3",
-                            chat_id,
-                            user_id,
-                            target_date,
+                        d2 AS (
+                            DELETE FROM user_activities
+                            WHERE chat_id=$1 AND user_id=$2 AND activity_date=$3
+                            RETURNING 1
                         ),
-                    )
-
-                    # ===== 6. 重置用户表 =====
-                    await conn.execute(
-                        """
-                        UPDATE users
-                        SET
-                            total_activity_count = 0,
-                            total_accumulated_time = 0,
-                            total_fines = 0,
-                            total_overtime_time = 0,
-                            overtime_count = 0,
-                            current_activity = NULL,
-                            activity_start_time = NULL,
-                            checkin_message_id = NULL,
-                            last_updated = $3,
-                            updated_at = CURRENT_TIMESTAMP
-                        WHERE chat_id=$1 AND user_id=$2
+                        d3 AS (
+                            DELETE FROM work_records
+                            WHERE chat_id=$1 AND user_id=$2 AND record_date=$3
+                            RETURNING 1
+                        ),
+                        u AS (
+                            UPDATE users
+                            SET
+                                total_activity_count = 0,
+                                total_accumulated_time = 0,
+                                total_fines = 0,
+                                total_overtime_time = 0,
+                                overtime_count = 0,
+                                current_activity = NULL,
+                                activity_start_time = NULL,
+                                checkin_message_id = NULL,
+                                last_updated = $4,
+                                updated_at = CURRENT_TIMESTAMP
+                            WHERE chat_id=$1 AND user_id=$2
+                              -- 已是重置状态则跳过写入（重复重置不产生新行版本）
+                              AND (
+                                  total_activity_count IS DISTINCT FROM 0
+                                  OR total_accumulated_time IS DISTINCT FROM 0
+                                  OR total_fines IS DISTINCT FROM 0
+                                  OR total_overtime_time IS DISTINCT FROM 0
+                                  OR overtime_count IS DISTINCT FROM 0
+                                  OR current_activity IS NOT NULL
+                                  OR activity_start_time IS NOT NULL
+                                  OR checkin_message_id IS NOT NULL
+                                  OR last_updated IS DISTINCT FROM $4
+                              )
+                            RETURNING 1
+                        )
+                        SELECT
+                            (SELECT COUNT(*) FROM d1) AS daily_deleted,
+                            (SELECT COUNT(*) FROM d2) AS act_deleted,
+                            (SELECT COUNT(*) FROM d3) AS work_deleted,
+                            (SELECT COUNT(*) FROM u) AS user_reset,
+                            (SELECT COUNT(*) FROM s) AS settled
                         """,
                         chat_id,
                         user_id,
+                        target_date,
                         new_date,
+                        *settlement,
                     )
 
             # ===== 7. 缓存清理 =====
-            cache_keys = [
-                f"user:{chat_id}:{user_id}",
-                f"group:{chat_id}",
-                "activity_limits",
-            ]
-            for key in cache_keys:
-                self._cache.pop(key, None)
-                self._cache_ttl.pop(key, None)
+            # 重置只改动该用户的数据；群组配置与活动配置未变，保留缓存，
+            # 避免整群重置时每个用户都把它们逐出、让后续请求集中回源
+            cache_key = ("user", chat_id, user_id)
+            self._pop_cached(cache_key)
 
-            # ===== 8. 解析删除数量用于日志 =====
-            def parse_deleted(result):
-                try:
-                    return (
-                        int(result.split()[-1])
-                        if result and result.startswith("DELETE")
-                        else 0
-                    )
-                except:
-                    return 0
-
-            # ===== 9. 详细日志输出 =====
+            # ===== 8. 详细日志输出 =====
             log = (
                 f"✅ [宽表重置完成] 用户:{user_id} 群:{chat_id}\n"
                 f"📅 日期:{new_date}\n"
-                f"🗑️ 删除: daily={parse_deleted(daily_deleted)}, "
-                f"activities={parse_deleted(act_deleted)}, "
-                f"work={parse_deleted(work_deleted)}\n"
+                f"🗑️ 删除: daily={deleted['daily_deleted']}, "
+                f"activities={deleted['act_deleted']}, "
+                f"work={deleted['work_deleted']}"
+                f"{'' if deleted['user_reset'] else '（用户行已是重置状态）'}\n"
             )
             if cross_day["activity"]:
                 log += f"🌙 跨天结算: {cross_day['activity']} {self.format_seconds_to_hms(cross_day['duration'])}"
@@ -2830,25 +3109,54 @@ class PostgreSQLDatabase:
             target_date = await self.get_business_date(chat_id)
 
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT activity_name, activity_count, accumulated_time 
-                FROM user_activities 
-                WHERE chat_id = $1 AND user_id = $2 AND activity_date = $3
-                """,
-                chat_id,
-                user_id,
-                target_date,
-            )
+        # 列别名与返回结构的键一致，直接以 Record 作为值（支持 ["count"] / ["time"] 访问）
+        rows = await self.pool.fetch(
+            """
+            SELECT activity_name, activity_count AS count, accumulated_time AS time
+            FROM user_activities 
+            WHERE chat_id = $1 AND user_id = $2 AND activity_date = $3
+            """,
+            chat_id,
+            user_id,
+            target_date,
+        )
 
-            activities = {}
-            for row in rows:
-                activities[row["activity_name"]] = {
-                    "count": row["activity_count"],
-                    "time": row["accumulated_time"],
-                }
-            return activities
+        return {row["activity_name"]: row for row in rows}
+
+    async def fetch_my_record(
+        self,
+        chat_id: int,
+        user_id: int,
+        query_date: date,
+        shift: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """我的记录：活动明细与当日罚款一次查询取回（shift 为 None 时统计全部班次）"""
+        self._ensure_pool_initialized()
+        rows = await self.pool.fetch(
+            """
+            SELECT ua.activity_name, ua.activity_count, ua.accumulated_time,
+                   ua.shift, f.fine_total
+            FROM (
+                SELECT COALESCE(SUM(fine_amount), 0) AS fine_total
+                FROM daily_statistics
+                WHERE chat_id = $1 AND user_id = $2 AND record_date = $3
+                  AND ($4::text IS NULL OR shift = $4)
+            ) f
+            LEFT JOIN user_activities ua
+                ON ua.chat_id = $1 AND ua.user_id = $2
+               AND ua.activity_date = $3
+               AND ($4::text IS NULL OR ua.shift = $4)
+            """,
+            chat_id,
+            user_id,
+            query_date,
+            shift,
+        )
+
+        return {
+            "activities": [row for row in rows if row["activity_name"] is not None],
+            "fine_total": rows[0]["fine_total"] if rows else 0,
+        }
 
     async def add_work_record(
         self,
@@ -2901,21 +3209,7 @@ class PostgreSQLDatabase:
 
                         # ===== 3. work_records UPSERT =====
                         await conn.execute(
-                            """
-                            INSERT INTO work_records
-                            (chat_id, user_id, record_date, checkin_type,
-                             checkin_time, status, time_diff_minutes,
-                             fine_amount, shift, shift_detail)
-                            VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10)
-                            ON CONFLICT (chat_id, user_id, record_date, checkin_type, shift)
-                            DO UPDATE SET
-                                checkin_time = EXCLUDED.checkin_time,
-                                status = EXCLUDED.status,
-                                time_diff_minutes = EXCLUDED.time_diff_minutes,
-                                fine_amount = EXCLUDED.fine_amount,
-                                shift_detail = EXCLUDED.shift_detail,
-                                created_at = CURRENT_TIMESTAMP
-                            """,
+                            _WORK_RECORD_UPSERT_SQL,
                             chat_id,
                             user_id,
                             business_date,  # 使用传入的 record_date
@@ -2930,41 +3224,7 @@ class PostgreSQLDatabase:
 
                         # ===== 4. 重新计算当日统计 =====
                         daily_row = await conn.fetchrow(
-                            """
-                            SELECT 
-                                COUNT(*) FILTER (WHERE checkin_type='work_start') AS work_start_count,
-                                COUNT(*) FILTER (WHERE checkin_type='work_end') AS work_end_count,
-                                COUNT(CASE WHEN checkin_type='work_start' AND time_diff_minutes>0 THEN 1 END) AS late_count,
-                                COUNT(CASE WHEN checkin_type='work_end' AND time_diff_minutes<0 THEN 1 END) AS early_count,
-                                COALESCE(SUM(CASE WHEN checkin_type='work_start' THEN fine_amount ELSE 0 END), 0) AS work_start_fines,
-                                COALESCE(SUM(CASE WHEN checkin_type='work_end' THEN fine_amount ELSE 0 END), 0) AS work_end_fines,
-                                COALESCE(
-                                    SUM(
-                                        CASE 
-                                            WHEN checkin_type='work_start' THEN 0
-                                            WHEN checkin_type='work_end' THEN
-                                                EXTRACT(EPOCH FROM (
-                                                    TO_TIMESTAMP(checkin_time, 'HH24:MI') - 
-                                                    TO_TIMESTAMP((
-                                                        SELECT COALESCE(checkin_time, '00:00')
-                                                        FROM work_records ws
-                                                        WHERE ws.chat_id = work_records.chat_id
-                                                          AND ws.user_id = work_records.user_id
-                                                          AND ws.record_date = work_records.record_date
-                                                          AND ws.shift = work_records.shift
-                                                          AND ws.checkin_type = 'work_start'
-                                                        LIMIT 1
-                                                    ), 'HH24:MI')
-                                                ))
-                                        END
-                                    ), 0
-                                ) AS work_seconds
-                            FROM work_records
-                            WHERE chat_id = $1 
-                              AND user_id = $2 
-                              AND record_date = $3 
-                              AND shift = $4
-                            """,
+                            _WORK_DAILY_AGG_SQL,
                             chat_id,
                             user_id,
                             business_date,
@@ -2973,32 +3233,7 @@ class PostgreSQLDatabase:
 
                         # ===== 5. 插入或更新 daily_statistics =====
                         await conn.execute(
-                            """
-                            INSERT INTO daily_statistics 
-                            (chat_id, user_id, record_date, shift,
-                             work_start_count, work_end_count, late_count, early_count,
-                             work_start_fines, work_end_fines, work_hours, work_days, updated_at)
-                            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, 
-                                    CASE WHEN $5 > 0 OR $6 > 0 OR $11 > 0 THEN 1 ELSE 0 END,
-                                    CURRENT_TIMESTAMP)
-                            ON CONFLICT (chat_id, user_id, record_date, shift) 
-                            DO UPDATE SET
-                                work_start_count = EXCLUDED.work_start_count,
-                                work_end_count = EXCLUDED.work_end_count,
-                                late_count = EXCLUDED.late_count,
-                                early_count = EXCLUDED.early_count,
-                                work_start_fines = EXCLUDED.work_start_fines,
-                                work_end_fines = EXCLUDED.work_end_fines,
-                                work_hours = EXCLUDED.work_hours,
-                                work_days = CASE 
-                                    WHEN EXCLUDED.work_hours > 0 AND daily_statistics.work_hours = 0 
-                                    THEN daily_statistics.work_days + 1
-                                    WHEN EXCLUDED.work_hours = 0 AND daily_statistics.work_hours > 0
-                                    THEN daily_statistics.work_days
-                                    ELSE daily_statistics.work_days
-                                END,
-                                updated_at = CURRENT_TIMESTAMP
-                            """,
+                            _WORK_DAILY_UPSERT_SQL,
                             chat_id,
                             user_id,
                             business_date,
@@ -3012,118 +3247,29 @@ class PostgreSQLDatabase:
                             int(daily_row["work_seconds"] or 0),
                         )
 
-                        # ===== 6. 更新月度统计（按罚款类型分开）=====
-                        if fine_amount > 0:
-                            if checkin_type == "work_start":
-                                # 上班罚款
-                                await conn.execute(
-                                    """
-                                    INSERT INTO monthly_statistics 
-                                    (chat_id, user_id, statistic_date, shift, work_start_fines, updated_at)
-                                    VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
-                                    ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                                    DO UPDATE SET
-                                        work_start_fines = monthly_statistics.work_start_fines + $5,
-                                        updated_at = CURRENT_TIMESTAMP
-                                    """,
-                                    chat_id,
-                                    user_id,
-                                    statistic_date,
-                                    shift,
-                                    fine_amount,
-                                )
-                            else:  # work_end
-                                # 下班罚款
-                                await conn.execute(
-                                    """
-                                    INSERT INTO monthly_statistics 
-                                    (chat_id, user_id, statistic_date, shift, work_end_fines, updated_at)
-                                    VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
-                                    ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                                    DO UPDATE SET
-                                        work_end_fines = monthly_statistics.work_end_fines + $5,
-                                        updated_at = CURRENT_TIMESTAMP
-                                    """,
-                                    chat_id,
-                                    user_id,
-                                    statistic_date,
-                                    shift,
-                                    fine_amount,
-                                )
-
-                        # 更新月度统计的其他字段（次数等）
-                        monthly_row = await conn.fetchrow(
-                            """
-                            SELECT 
-                                COALESCE(SUM(work_start_count), 0) AS work_start_count,
-                                COALESCE(SUM(work_end_count), 0) AS work_end_count,
-                                COALESCE(SUM(late_count), 0) AS late_count,
-                                COALESCE(SUM(early_count), 0) AS early_count,
-                                COALESCE(SUM(work_hours), 0) AS work_hours,
-                                COALESCE(SUM(work_days), 0) AS work_days
-                            FROM daily_statistics
-                            WHERE chat_id = $1 
-                              AND user_id = $2 
-                              AND DATE_TRUNC('month', record_date) = $3
-                              AND shift = $4
-                            """,
+                        # ===== 6. 月度统计：罚款累加 + 次数/工时汇总 一条语句完成 =====
+                        # 罚款按类型在 ON CONFLICT 中原子累加，次数类字段直接取当月 daily_statistics 汇总，
+                        # 避免先读后写的竞争窗口
+                        monthly_inserted = await conn.fetchval(
+                            _WORK_MONTHLY_UPSERT_SQL,
                             chat_id,
                             user_id,
                             statistic_date,
                             shift,
+                            checkin_type,
+                            fine_amount if fine_amount > 0 else 0,
                         )
 
-                        # 更新月度统计的总计字段
-                        if monthly_row:
-                            await conn.execute(
-                                """
-                                INSERT INTO monthly_statistics 
-                                (chat_id, user_id, statistic_date, shift,
-                                 work_start_count, work_end_count, late_count, early_count,
-                                 work_hours, work_days, updated_at)
-                                VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, CURRENT_TIMESTAMP)
-                                ON CONFLICT (chat_id, user_id, statistic_date, shift)
-                                DO UPDATE SET
-                                    work_start_count = EXCLUDED.work_start_count,
-                                    work_end_count = EXCLUDED.work_end_count,
-                                    late_count = EXCLUDED.late_count,
-                                    early_count = EXCLUDED.early_count,
-                                    work_hours = EXCLUDED.work_hours,
-                                    work_days = EXCLUDED.work_days,
-                                    updated_at = CURRENT_TIMESTAMP
-                                """,
-                                chat_id,
-                                user_id,
-                                statistic_date,
-                                shift,
-                                monthly_row["work_start_count"],
-                                monthly_row["work_end_count"],
-                                monthly_row["late_count"],
-                                monthly_row["early_count"],
-                                monthly_row["work_hours"],
-                                monthly_row["work_days"],
-                            )
-
                         # ===== 7. 更新用户总罚款 =====
                         await conn.execute(
-                            """
-                            UPDATE users
-                            SET total_fines = (
-                                SELECT COALESCE(SUM(fine_amount), 0)
-                                FROM work_records
-                                WHERE chat_id = $1 AND user_id = $2
-                            ),
-                            updated_at = CURRENT_TIMESTAMP
-                            WHERE chat_id = $1 AND user_id = $2
-                            """,
+                            _WORK_USER_FINES_SQL,
                             chat_id,
                             user_id,
                         )
 
                         # ===== 8. 清理缓存 =====
-                        cache_key = f"user:{chat_id}:{user_id}"
-                        self._cache.pop(cache_key, None)
-                        self._cache_ttl.pop(cache_key, None)
+                        cache_key = ("user", chat_id, user_id)
+                        self._pop_cached(cache_key)
 
                         logger.info(
                             f"✅ [工作记录完成] 用户:{user_id} | "
@@ -3132,6 +3278,7 @@ class PostgreSQLDatabase:
                             f"罚款:{fine_amount} | "
                             f"上班次数:{daily_row['work_start_count']} | "
                             f"下班次数:{daily_row['work_end_count']}"
+                            f"{' | 新建月度记录' if monthly_inserted else ''}"
                         )
 
                     break  # 成功退出重试循环
@@ -3217,9 +3364,10 @@ class PostgreSQLDatabase:
     ) -> Dict[str, Dict]:
         """获取用户今天的上下班记录"""
         try:
-            group_data = await self.get_group_cached(chat_id)
-            reset_hour = group_data.get("reset_hour", Config.DAILY_RESET_HOUR)
-            reset_minute = group_data.get("reset_minute", Config.DAILY_RESET_MINUTE)
+            reset_hour, reset_minute = await self.get_reset_config(chat_id) or (
+                Config.DAILY_RESET_HOUR,
+                Config.DAILY_RESET_MINUTE,
+            )
 
             now = self.get_beijing_time()
 
@@ -3232,36 +3380,34 @@ class PostgreSQLDatabase:
             else:
                 period_start = reset_time_today
 
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(
-                    """
-                    SELECT * FROM work_records 
-                    WHERE chat_id = $1 
-                    AND user_id = $2 
-                    AND record_date >= $3
-                    AND record_date <= $4
-                    ORDER BY record_date DESC, checkin_type
-                    """,
-                    chat_id,
-                    user_id,
-                    period_start.date(),
-                    now.date(),
-                )
+            rows = await self.pool.fetch(
+                """
+                SELECT * FROM work_records 
+                WHERE chat_id = $1 
+                AND user_id = $2 
+                AND record_date >= $3
+                AND record_date <= $4
+                ORDER BY record_date DESC, checkin_type
+                """,
+                chat_id,
+                user_id,
+                period_start.date(),
+                now.date(),
+            )
 
-                records = {}
-                for row in rows:
-                    record_key = f"{row['record_date']}_{row['checkin_type']}"
-                    if (
-                        row["checkin_type"] not in records
-                        or row["record_date"]
-                        > records[row["checkin_type"]]["record_date"]
-                    ):
-                        records[row["checkin_type"]] = dict(row)
+            records = {}
+            for row in rows:
+                if (
+                    row["checkin_type"] not in records
+                    or row["record_date"]
+                    > records[row["checkin_type"]]["record_date"]
+                ):
+                    records[row["checkin_type"]] = row
 
-                logger.debug(
-                    f"工作记录查询: {chat_id}-{user_id}, 重置周期: {period_start.date()}, 记录数: {len(records)}"
-                )
-                return records
+            logger.debug(
+                f"工作记录查询: {chat_id}-{user_id}, 重置周期: {period_start.date()}, 记录数: {len(records)}"
+            )
+            return records
 
         except Exception as e:
             logger.error(f"获取工作记录失败 {chat_id}-{user_id}: {e}")
@@ -3298,17 +3444,14 @@ class PostgreSQLDatabase:
             logger.error(f"获取活动配置失败: {e}，返回默认配置")
             return Config.DEFAULT_ACTIVITY_LIMITS.copy()
 
-    async def get_activity_limits_cached(self) -> Dict:
-        """带缓存的获取活动限制"""
-        try:
-            return await self.get_activity_limits()
-        except Exception as e:
-            logger.error(f"获取活动配置缓存失败: {e}，返回默认配置")
-            return Config.DEFAULT_ACTIVITY_LIMITS.copy()
+    # get_activity_limits 自带缓存与默认配置兜底，旧名称直接指向同一方法
+    get_activity_limits_cached = get_activity_limits
 
     async def get_activity_time_limit(self, activity: str) -> int:
         """获取活动时间限制"""
-        limits = await self.get_activity_limits()
+        limits = self._get_cached("activity_limits")
+        if limits is None:
+            limits = await self.get_activity_limits()
         return limits.get(activity, {}).get("time_limit", 0)
 
     async def get_activity_max_times(self, activity: str) -> int:
@@ -3323,12 +3466,21 @@ class PostgreSQLDatabase:
         if cached is not None:
             return activity in cached
 
+        # 未命中时直接查库并顺带预热缓存；不走 get_activity_limits 的默认配置兜底，
+        # 数据库异常照常抛出，避免管理命令把“查询失败”误判为“活动不存在”
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT 1 FROM activity_configs WHERE activity_name = $1", activity
-            )
-            return row is not None
+        rows = await self.pool.fetch(
+            "SELECT activity_name, max_times, time_limit FROM activity_configs"
+        )
+        limits = {
+            row["activity_name"]: {
+                "max_times": row["max_times"],
+                "time_limit": row["time_limit"],
+            }
+            for row in rows
+        }
+        self._set_cached(cache_key, limits, 600)
+        return activity in limits
 
     async def update_activity_config(
         self, activity: str, max_times: int, time_limit: int
@@ -3350,154 +3502,201 @@ class PostgreSQLDatabase:
                 max_times,
                 time_limit,
             )
-        self._cache.pop("activity_limits", None)
+        self._pop_cached("activity_limits")
+        self._pop_cached("activity_catalog")
 
     async def delete_activity_config(self, activity: str):
         """删除活动配置"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "DELETE FROM activity_configs WHERE activity_name = $1", activity
-            )
-            await conn.execute(
-                "DELETE FROM fine_configs WHERE activity_name = $1", activity
+        # 单条语句删除活动配置及其罚款配置，原子且只需一次往返
+        await self.pool.execute(
+            """
+            WITH a AS (
+                DELETE FROM activity_configs WHERE activity_name = $1
             )
-        self._cache.pop("activity_limits", None)
+            DELETE FROM fine_configs WHERE activity_name = $1
+            """,
+            activity,
+        )
+        self._pop_cached("activity_limits")
+        self._pop_cached("activity_catalog")
 
     # ========== 罚款配置操作 ==========
+    async def get_activity_catalog(self, conn=None) -> Dict:
+        """获取配置目录 {"limits", "fines", "fine_schedules", "work_fines"}（带缓存，传入 conn 时复用调用方连接）"""
+        cache_key = "activity_catalog"
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
+        if conn is not None:
+            rows = await conn.fetch(_ACTIVITY_CATALOG_SQL)
+        else:
+            self._ensure_pool_initialized()
+            rows = await self.pool.fetch(_ACTIVITY_CATALOG_SQL)
+
+        # 按列位置解包，省去 Record 的按名查找
+        limits, fines, work_fines = {}, defaultdict(dict), defaultdict(dict)
+        for kind, name, time_segment, max_times, time_limit, fine_amount in rows:
+            if kind == "limit":
+                limits[name] = {"max_times": max_times, "time_limit": time_limit}
+            elif kind == "fine":
+                fines[name][time_segment] = fine_amount
+            else:
+                work_fines[name][time_segment] = fine_amount
+
+        # 缓存中存普通 dict，避免读取方误用下标时悄悄插入空项
+        catalog = {
+            "limits": limits,
+            "fines": dict(fines),
+            # 规范化后的罚款分段随目录一起缓存、一起失效
+            "fine_schedules": {
+                name: self.normalize_fine_rates(rates) for name, rates in fines.items()
+            },
+            "work_fines": dict(work_fines),
+        }
+        self._set_cached(cache_key, catalog, 300)
+        # 顺带预热活动限制缓存
+        self._set_cached("activity_limits", limits, 600)
+        return catalog
+
     async def get_fine_rates(self) -> Dict:
         """获取所有罚款费率"""
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT * FROM fine_configs")
-            fines = {}
-            for row in rows:
-                activity = row["activity_name"]
-                if activity not in fines:
-                    fines[activity] = {}
-                fines[activity][row["time_segment"]] = row["fine_amount"]
-            return fines
-
-    async def get_fine_rates_for_activity(self, activity: str) -> Dict:
-        """获取指定活动的罚款费率"""
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT time_segment, fine_amount FROM fine_configs WHERE activity_name = $1",
-                activity,
-            )
-            return {row["time_segment"]: row["fine_amount"] for row in rows}
-
-    async def update_fine_config(
-        self, activity: str, time_segment: str, fine_amount: int
-    ):
-        """更新罚款配置"""
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO fine_configs (activity_name, time_segment, fine_amount)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (activity_name, time_segment) 
-                DO UPDATE SET 
-                    fine_amount = EXCLUDED.fine_amount,
-                    created_at = CURRENT_TIMESTAMP
-                """,
-                activity,
-                time_segment,
-                fine_amount,
-            )
+        catalog = await self.get_activity_catalog()
+        return {activity: dict(rates) for activity, rates in catalog["fines"].items()}
 
-    async def calculate_fine_for_activity(
-        self, activity: str, overtime_minutes: float
-    ) -> int:
-        """计算活动罚款金额"""
-        fine_rates = await self.get_fine_rates_for_activity(activity)
-        if not fine_rates:
-            return 0
+    async def get_fine_rates_for_activity(self, activity: str, conn=None) -> Dict:
+        """获取指定活动的罚款费率（传入 conn 时复用调用方连接）"""
+        catalog = await self.get_activity_catalog(conn=conn)
+        return dict(catalog["fines"].get(activity, {}))
 
-        segments = []
+    @staticmethod
+    def normalize_fine_rates(fine_rates: Dict) -> tuple:
+        """罚款费率规范化为 (升序分段分钟数, 对应罚款) 两个元组"""
+        by_segment = {}
         for time_key in fine_rates.keys():
             try:
                 if isinstance(time_key, str) and "min" in time_key.lower():
-                    time_value = int(time_key.lower().replace("min", "").strip())
+                    segment = int(time_key.lower().replace("min", "").strip())
                 else:
-                    time_value = int(time_key)
-                segments.append(time_value)
+                    segment = int(time_key)
             except (ValueError, TypeError):
                 continue
+            if segment not in by_segment:
+                by_segment[segment] = fine_rates.get(
+                    str(segment), fine_rates.get(f"{segment}min", 0)
+                )
 
+        segments = tuple(sorted(by_segment))
+        return segments, tuple(by_segment[s] for s in segments)
+
+    @staticmethod
+    def lookup_fine(schedule: tuple, overtime_minutes: float) -> int:
+        """按规范化分段查罚款：取第一个 >= 超时分钟数的分段，未命中或为0时取最高分段"""
+        segments, fines = schedule
         if not segments:
             return 0
+        idx = bisect_left(segments, overtime_minutes)
+        fine = fines[idx] if idx < len(fines) else 0
+        return fine or fines[-1]
 
-        segments.sort()
+    async def get_fine_schedule_for_activity(self, activity: str, conn=None) -> tuple:
+        """获取指定活动规范化后的罚款分段（取自配置目录缓存）"""
+        catalog = await self.get_activity_catalog(conn=conn)
+        return catalog["fine_schedules"].get(activity, ((), ()))
 
-        applicable_fine = 0
-        for segment in segments:
-            if overtime_minutes <= segment:
-                original_key = str(segment)
-                if original_key not in fine_rates:
-                    original_key = f"{segment}min"
-                applicable_fine = fine_rates.get(original_key, 0)
-                break
+    async def update_fine_config(
+        self, activity: str, time_segment: str, fine_amount: int
+    ):
+        """更新罚款配置"""
+        self._ensure_pool_initialized()
+        await self.pool.execute(
+            """
+            INSERT INTO fine_configs (activity_name, time_segment, fine_amount)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (activity_name, time_segment) 
+            DO UPDATE SET 
+                fine_amount = EXCLUDED.fine_amount,
+                created_at = CURRENT_TIMESTAMP
+            """,
+            activity,
+            time_segment,
+            fine_amount,
+        )
+        self._pop_cached("activity_catalog")
+
+    async def update_fine_configs_bulk(self, activities: List[str], segments: Dict):
+        """批量更新罚款配置：活动 × 分段 一条 unnest 语句写入"""
+        rows = [
+            (activity, str(time_segment), amount)
+            for activity in activities
+            for time_segment, amount in segments.items()
+        ]
+        if not rows:
+            return
 
-        if applicable_fine == 0 and segments:
-            max_segment = segments[-1]
-            original_key = str(max_segment)
-            if original_key not in fine_rates:
-                original_key = f"{max_segment}min"
-            applicable_fine = fine_rates.get(original_key, 0)
+        names, time_segments, amounts = map(list, zip(*rows))
+        self._ensure_pool_initialized()
+        await self.pool.execute(
+            """
+            INSERT INTO fine_configs (activity_name, time_segment, fine_amount)
+            SELECT * FROM unnest($1::text[], $2::text[], $3::integer[])
+            ON CONFLICT (activity_name, time_segment) 
+            DO UPDATE SET 
+                fine_amount = EXCLUDED.fine_amount,
+                created_at = CURRENT_TIMESTAMP
+            """,
+            names,
+            time_segments,
+            amounts,
+        )
+        self._pop_cached("activity_catalog")
 
-        return applicable_fine
+    async def calculate_fine_for_activity(
+        self, activity: str, overtime_minutes: float
+    ) -> int:
+        """计算活动罚款金额"""
+        schedule = await self.get_fine_schedule_for_activity(activity)
+        return self.lookup_fine(schedule, overtime_minutes)
 
     async def get_work_fine_rates(self) -> Dict:
         """获取上下班罚款费率"""
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT * FROM work_fine_configs")
-            fines = {}
-            for row in rows:
-                checkin_type = row["checkin_type"]
-                if checkin_type not in fines:
-                    fines[checkin_type] = {}
-                fines[checkin_type][row["time_segment"]] = row["fine_amount"]
-            return fines
+        catalog = await self.get_activity_catalog()
+        return {
+            checkin_type: dict(rates)
+            for checkin_type, rates in catalog["work_fines"].items()
+        }
 
     async def get_work_fine_rates_for_type(self, checkin_type: str) -> Dict:
         """获取指定类型的上下班罚款费率"""
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT time_segment, fine_amount FROM work_fine_configs WHERE checkin_type = $1",
-                checkin_type,
-            )
-            return {row["time_segment"]: row["fine_amount"] for row in rows}
+        catalog = await self.get_activity_catalog()
+        return dict(catalog["work_fines"].get(checkin_type, {}))
 
     async def update_work_fine_rate(
         self, checkin_type: str, time_segment: str, fine_amount: int
     ):
         """更新上下班罚款费率"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO work_fine_configs (checkin_type, time_segment, fine_amount)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (checkin_type, time_segment)
-                DO UPDATE SET fine_amount = EXCLUDED.fine_amount
-                """,
-                checkin_type,
-                time_segment,
-                fine_amount,
-            )
+        await self.pool.execute(
+            """
+            INSERT INTO work_fine_configs (checkin_type, time_segment, fine_amount)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (checkin_type, time_segment)
+            DO UPDATE SET fine_amount = EXCLUDED.fine_amount
+            """,
+            checkin_type,
+            time_segment,
+            fine_amount,
+        )
+        self._pop_cached("activity_catalog")
 
     async def clear_work_fine_rates(self, checkin_type: str):
         """清空上下班罚款配置"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                "DELETE FROM work_fine_configs WHERE checkin_type = $1", checkin_type
-            )
+        await self.pool.execute(
+            "DELETE FROM work_fine_configs WHERE checkin_type = $1", checkin_type
+        )
+        self._pop_cached("activity_catalog")
 
     # ========== 推送设置操作 ==========
     async def get_push_settings(self) -> Dict:
@@ -3508,29 +3707,27 @@ class PostgreSQLDatabase:
             return cached
 
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT * FROM push_settings")
-            settings = {row["setting_key"]: bool(row["setting_value"]) for row in rows}
-            self._set_cached(cache_key, settings, 300)
-            return settings
+        rows = await self.pool.fetch("SELECT setting_key, setting_value FROM push_settings")
+        settings = {row["setting_key"]: row["setting_value"] for row in rows}
+        self._set_cached(cache_key, settings, 300)
+        return settings
 
     async def update_push_setting(self, key: str, value: bool):
         """更新推送设置"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            await conn.execute(
-                """
-                INSERT INTO push_settings (setting_key, setting_value)
-                VALUES ($1, $2)
-                ON CONFLICT (setting_key) 
-                DO UPDATE SET 
-                    setting_value = EXCLUDED.setting_value,
-                    created_at = CURRENT_TIMESTAMP
-                """,
-                key,
-                1 if value else 0,
-            )
-        self._cache.pop("push_settings", None)
+        await self.pool.execute(
+            """
+            INSERT INTO push_settings (setting_key, setting_value)
+            VALUES ($1, $2)
+            ON CONFLICT (setting_key) 
+            DO UPDATE SET 
+                setting_value = EXCLUDED.setting_value,
+                created_at = CURRENT_TIMESTAMP
+            """,
+            key,
+            bool(value),
+        )
+        self._pop_cached("push_settings")
 
     # ========== 统计和导出相关 ==========
     async def get_group_statistics(
@@ -3539,17 +3736,24 @@ class PostgreSQLDatabase:
         """获取群组统计信息 - 企业级最终优化版"""
         start_time = time.time()
 
+        # 业务日期与群组配置互不依赖，需要计算业务日期时并发读取
         if target_date is None:
-            target_date = await self.get_business_date(chat_id)
+            target_date, group_data = await asyncio.gather(
+                self.get_business_date(chat_id), self.get_group_cached(chat_id)
+            )
+            group_loaded = True
+        else:
+            group_data, group_loaded = None, False
 
-        cache_key = f"stats:{chat_id}:{target_date}"
+        cache_key = ("stats", chat_id, target_date)
         cached = self._get_cached(cache_key)
         if cached is not None:
             logger.debug(f"✅ 命中统计缓存: {cache_key}")
             return cached
 
         # 获取群组配置（用于判断双班模式）
-        group_data = await self.get_group_cached(chat_id)
+        if not group_loaded:
+            group_data = await self.get_group_cached(chat_id)
         has_dual_mode = group_data.get("dual_mode", True) if group_data else True
         all_shifts = ["day", "night"] if has_dual_mode else ["day"]
 
@@ -3568,53 +3772,50 @@ class PostgreSQLDatabase:
                 async with self.pool.acquire() as conn:
                     t0 = time.time()
 
-                    # ✅ 修复：修正 GROUP BY 子句
+                    # 活动明细先按 (用户, 班次) 预聚合，再与日统计逐行关联，
+                    # 避免以日统计的全部列作为 GROUP BY 键
                     rows = await conn.fetch(
                         """
-                        WITH stats AS (
+                        WITH ua AS (
                             SELECT 
-                                u.user_id,
-                                u.nickname,
-                                COALESCE(ds.shift, 'day') AS shift,
-                                COALESCE(ds.activity_count, 0) AS total_activity_count,
-                                COALESCE(ds.accumulated_time, 0) AS total_accumulated_time,
-                                COALESCE(ds.fine_amount, 0) AS total_fines,
-                                COALESCE(ds.overtime_count, 0) AS overtime_count,
-                                COALESCE(ds.overtime_time, 0) AS total_overtime_time,
-                                COALESCE(ds.work_days, 0) AS work_days,
-                                COALESCE(ds.work_hours, 0) AS work_hours,
-                                COALESCE(ds.work_start_count, 0) AS work_start_count,
-                                COALESCE(ds.work_end_count, 0) AS work_end_count,
-                                COALESCE(ds.work_start_fines, 0) AS work_start_fines,
-                                COALESCE(ds.work_end_fines, 0) AS work_end_fines,
-                                COALESCE(ds.late_count, 0) AS late_count,
-                                COALESCE(ds.early_count, 0) AS early_count,
-                                COALESCE(
-                                    jsonb_object_agg(
-                                        ua.activity_name, 
-                                        jsonb_build_object('count', ua.activity_count, 'time', ua.accumulated_time)
-                                    ) FILTER (WHERE ua.activity_name IS NOT NULL),
-                                    '{}'::jsonb
+                                user_id,
+                                shift,
+                                jsonb_object_agg(
+                                    activity_name, 
+                                    jsonb_build_object('count', activity_count, 'time', accumulated_time)
                                 ) AS activities
-                            FROM users u
-                            LEFT JOIN daily_statistics ds
-                                ON u.chat_id = ds.chat_id 
-                                AND u.user_id = ds.user_id 
-                                AND ds.record_date = $1
-                            LEFT JOIN user_activities ua
-                                ON u.chat_id = ua.chat_id 
-                                AND u.user_id = ua.user_id 
-                                AND ua.activity_date = $1 
-                                AND ua.shift = ds.shift
-                            WHERE u.chat_id = $2
-                            GROUP BY u.user_id, u.nickname, ds.shift, 
-                                     ds.activity_count, ds.accumulated_time, ds.fine_amount,
-                                     ds.overtime_count, ds.overtime_time, ds.work_days, ds.work_hours,
-                                     ds.work_start_count, ds.work_end_count, ds.work_start_fines,
-                                     ds.work_end_fines, ds.late_count, ds.early_count
+                            FROM user_activities
+                            WHERE chat_id = $2 AND activity_date = $1
+                            GROUP BY user_id, shift
                         )
-                        SELECT * FROM stats
-                        ORDER BY user_id, shift
+                        SELECT 
+                            u.user_id,
+                            u.nickname,
+                            COALESCE(ds.shift, 'day') AS shift,
+                            COALESCE(ds.activity_count, 0) AS total_activity_count,
+                            COALESCE(ds.accumulated_time, 0) AS total_accumulated_time,
+                            COALESCE(ds.fine_amount, 0) AS total_fines,
+                            COALESCE(ds.overtime_count, 0) AS overtime_count,
+                            COALESCE(ds.overtime_time, 0) AS total_overtime_time,
+                            COALESCE(ds.work_days, 0) AS work_days,
+                            COALESCE(ds.work_hours, 0) AS work_hours,
+                            COALESCE(ds.work_start_count, 0) AS work_start_count,
+                            COALESCE(ds.work_end_count, 0) AS work_end_count,
+                            COALESCE(ds.work_start_fines, 0) AS work_start_fines,
+                            COALESCE(ds.work_end_fines, 0) AS work_end_fines,
+                            COALESCE(ds.late_count, 0) AS late_count,
+                            COALESCE(ds.early_count, 0) AS early_count,
+                            COALESCE(ua.activities, '{}'::jsonb) AS activities
+                        FROM users u
+                        LEFT JOIN daily_statistics ds
+                            ON u.chat_id = ds.chat_id 
+                            AND u.user_id = ds.user_id 
+                            AND ds.record_date = $1
+                        LEFT JOIN ua
+                            ON ua.user_id = u.user_id 
+                            AND ua.shift = ds.shift
+                        WHERE u.chat_id = $2
+                        ORDER BY u.user_id, shift
                         """,
                         target_date,
                         chat_id,
@@ -3623,16 +3824,15 @@ class PostgreSQLDatabase:
                     t1 = time.time()
                     logger.debug(f"📊 聚合查询完成，耗时 {(t1-t0)*1000:.1f}ms")
 
-                    # 构建用户数据映射
+                    # 构建用户数据映射（直接保存 Record，昵称每个用户只解析一次）
                     user_data_map = {}
                     user_nicknames = {}
 
                     for row in rows:
-                        key = (row["user_id"], row["shift"])
-                        user_data_map[key] = dict(row)
-                        user_nicknames[row["user_id"]] = (
-                            row["nickname"] or f"用户{row['user_id']}"
-                        )
+                        user_id = row["user_id"]
+                        user_data_map[(user_id, row["shift"])] = row
+                        if user_id not in user_nicknames:
+                            user_nicknames[user_id] = row["nickname"] or f"用户{user_id}"
 
                     # 填充所有可能的班次
                     result = []
@@ -3677,9 +3877,7 @@ class PostgreSQLDatabase:
                                 }
                             )
 
-                    # 按用户ID排序
-                    result.sort(key=lambda x: (x["user_id"], x["shift"]))
-
+                    # 查询已按 user_id 排序、班次按 all_shifts 顺序展开，结果无需再排序
                     # 写入缓存
                     self._set_cached(cache_key, result, 300)
 
@@ -3703,36 +3901,121 @@ class PostgreSQLDatabase:
             return []
 
     async def get_all_groups(self) -> List[int]:
-        """获取所有群组ID"""
+        """获取所有群组ID（带缓存，新增群组时失效）"""
+        cache_key = "all_groups"
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT chat_id FROM groups")
-            return [row["chat_id"] for row in rows]
+        rows = await self.pool.fetch("SELECT chat_id FROM groups")
+        chat_ids = [row["chat_id"] for row in rows]
+        self._set_cached(cache_key, chat_ids, 60)
+        return chat_ids
+
+    async def get_group_members(
+        self, chat_id: int, active_only: bool = False
+    ) -> List[Dict]:
+        """获取群组成员（直接返回 Record，支持 [] 与 .get 访问）
 
-    async def get_group_members(self, chat_id: int) -> List[Dict]:
-        """获取群组成员"""
+        active_only=True 时只返回有进行中活动的成员，走 idx_users_current_activity 部分索引
+        """
         today = await self.get_business_date(chat_id)
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
+        if active_only:
+            return await self.pool.fetch(
                 """
-                SELECT 
-                    user_id, 
-                    nickname, 
-                    current_activity, 
-                    activity_start_time, 
-                    total_accumulated_time, 
-                    total_activity_count, 
-                    total_fines, 
-                    overtime_count, 
-                    total_overtime_time 
+                SELECT user_id, nickname, current_activity, activity_start_time
                 FROM users 
-                WHERE chat_id = $1 AND last_updated = $2
+                WHERE chat_id = $1 
+                  AND current_activity IS NOT NULL 
+                  AND last_updated = $2
                 """,
                 chat_id,
                 today,
             )
-            return [dict(row) for row in rows]
+        return await self.pool.fetch(
+            """
+            SELECT 
+                user_id, 
+                nickname, 
+                current_activity, 
+                activity_start_time, 
+                total_accumulated_time, 
+                total_activity_count, 
+                total_fines, 
+                overtime_count, 
+                total_overtime_time 
+            FROM users 
+            WHERE chat_id = $1 AND last_updated = $2
+            """,
+            chat_id,
+            today,
+        )
+
+    async def get_activity_rankings(
+        self,
+        chat_id: int,
+        query_date: date,
+        activities: List[str],
+        shift: Optional[str] = None,
+        limit: int = 10,
+    ) -> Dict[str, List]:
+        """获取当日各活动排行榜 - 所有活动一次查询，按活动分区取前 N 名
+
+        指定班次时进行中的用户排在前面，否则按累计时长排序。
+        """
+        if not activities:
+            return {}
+
+        rows = await self.execute_with_retry(
+            "获取活动排行榜",
+            """
+            WITH agg AS (
+                SELECT activity_name, user_id,
+                       SUM(accumulated_time) AS total_time,
+                       SUM(activity_count) AS total_count
+                FROM user_activities
+                WHERE chat_id = $1
+                  AND activity_date = $2
+                  AND activity_name = ANY($3::text[])
+                  AND ($4::text IS NULL OR shift = $4)
+                GROUP BY activity_name, user_id
+            ),
+            ranked AS (
+                SELECT agg.activity_name, agg.user_id, u.nickname,
+                       agg.total_time, agg.total_count,
+                       COALESCE(u.current_activity = agg.activity_name, FALSE) AS is_active
+                FROM agg
+                LEFT JOIN users u ON u.chat_id = $1 AND u.user_id = agg.user_id
+                WHERE agg.total_time > 0 OR u.current_activity = agg.activity_name
+            ),
+            numbered AS (
+                SELECT ranked.*,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY activity_name
+                           ORDER BY ($4::text IS NOT NULL AND is_active) DESC,
+                                    total_time DESC
+                       ) AS rn
+                FROM ranked
+            )
+            SELECT activity_name, user_id, nickname, total_time, total_count, is_active
+            FROM numbered
+            WHERE rn <= $5
+            ORDER BY activity_name, rn
+            """,
+            chat_id,
+            query_date,
+            list(activities),
+            shift,
+            limit,
+            fetch=True,
+        )
+
+        rankings: Dict[str, List] = {}
+        for row in rows:
+            rankings.setdefault(row["activity_name"], []).append(row)
+        return rankings
 
     # ========== 月度统计 ==========
     async def get_monthly_statistics(
@@ -3755,18 +4038,15 @@ class PostgreSQLDatabase:
 
         month_start = date(year, month, 1)
         month_end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
-        month_start_dt = beijing_tz.localize(
-            datetime.combine(month_start, datetime.min.time())
-        )
-        month_end_dt = beijing_tz.localize(
-            datetime.combine(month_end, datetime.min.time())
-        )
 
         self._ensure_pool_initialized()
 
         try:
             async with asyncio.timeout(timeout):
                 async with self.pool.acquire() as conn:
+                    # 以下各查询均为固定 SQL 文本，参数全部走 $n 绑定：
+                    # 同一连接上第二次起直接命中 statement_cache_size 的预编译缓存，只发 Bind/Execute。
+                    # 不要改成 conn.prepare()——它绕过该缓存，每次调用都会重新 Parse
 
                     # ===== 1. 获取所有活跃用户 =====
                     users = await conn.fetch(
@@ -3811,19 +4091,19 @@ class PostgreSQLDatabase:
                         SELECT
                             ds.user_id,
                             ds.shift,
-                            SUM(ds.activity_count) as total_activity_count,
-                            SUM(ds.accumulated_time) as total_accumulated_time,
-                            SUM(ds.fine_amount) as total_fines,
-                            SUM(ds.overtime_count) as total_overtime_count,
-                            SUM(ds.overtime_time) as total_overtime_time,
-                            SUM(ds.work_days) as work_days,
-                            SUM(ds.work_hours) as work_hours,
-                            SUM(ds.work_start_count) as work_start_count,
-                            SUM(ds.work_end_count) as work_end_count,
-                            SUM(ds.work_start_fines) as work_start_fines,
-                            SUM(ds.work_end_fines) as work_end_fines,
-                            SUM(ds.late_count) as late_count,
-                            SUM(ds.early_count) as early_count
+                            COALESCE(SUM(ds.activity_count), 0) AS total_activity_count,
+                            COALESCE(SUM(ds.accumulated_time), 0) AS total_accumulated_time,
+                            COALESCE(SUM(ds.fine_amount), 0) AS total_fines,
+                            COALESCE(SUM(ds.overtime_count), 0) AS total_overtime_count,
+                            COALESCE(SUM(ds.overtime_time), 0) AS total_overtime_time,
+                            COALESCE(SUM(ds.work_days), 0) AS work_days,
+                            COALESCE(SUM(ds.work_hours), 0) AS work_hours,
+                            COALESCE(SUM(ds.work_start_count), 0) AS work_start_count,
+                            COALESCE(SUM(ds.work_end_count), 0) AS work_end_count,
+                            COALESCE(SUM(ds.work_start_fines), 0) AS work_start_fines,
+                            COALESCE(SUM(ds.work_end_fines), 0) AS work_end_fines,
+                            COALESCE(SUM(ds.late_count), 0) AS late_count,
+                            COALESCE(SUM(ds.early_count), 0) AS early_count
                         FROM daily_statistics ds
                         WHERE ds.chat_id = $1 
                           AND ds.user_id = ANY($2::bigint[]) 
@@ -3837,229 +4117,233 @@ class PostgreSQLDatabase:
                         month_end,
                     )
 
-                    # 构建按用户+班次索引的统计数据
-                    stats_by_user_shift = {}
-                    for row in stats_rows:
-                        key = (row["user_id"], row["shift"])
-                        stats_by_user_shift[key] = dict(row)
+                    # 构建按用户+班次索引的统计数据（SUM 已在库内 COALESCE，直接保留 Record 不再拷贝）
+                    stats_by_user_shift = {
+                        (row["user_id"], row["shift"]): row for row in stats_rows
+                    }
 
-                    # ===== 4. 用户活动明细 JSON 聚合 =====
-                    activity_rows = await conn.fetch(
-                        """
+                # 4~6 三个聚合只依赖 user_ids，互不依赖：先归还上面的连接，再各自从池中取连接
+                # 重叠执行，只付一次往返等待；持有连接时再去池里取连接，并发报表下会把池耗尽而互相等死
+
+                # ===== 4. 用户活动明细 JSON 聚合 =====
+                # 先按 (用户, 活动) 求和，再逐用户聚合为 JSON（聚合函数不能直接嵌套）
+                activity_query = self.pool.fetch(
+                    """
+                    SELECT 
+                        user_id, 
+                        jsonb_object_agg(
+                            activity_name, 
+                            jsonb_build_object('count', total_count, 'time', total_time)
+                        ) as activities
+                    FROM (
                         SELECT 
-                            user_id, 
-                            jsonb_object_agg(
-                                activity_name, 
-                                jsonb_build_object('count', SUM(activity_count), 'time', SUM(accumulated_time))
-                            ) as activities
+                            user_id,
+                            activity_name,
+                            SUM(activity_count) AS total_count,
+                            SUM(accumulated_time) AS total_time
                         FROM user_activities
                         WHERE chat_id = $1 
                           AND user_id = ANY($2::bigint[]) 
                           AND activity_date >= $3 
                           AND activity_date < $4
-                        GROUP BY user_id
-                        """,
-                        chat_id,
-                        user_ids,
-                        month_start,
-                        month_end,
-                    )
+                        GROUP BY user_id, activity_name
+                    ) per_activity
+                    GROUP BY user_id
+                    """,
+                    chat_id,
+                    user_ids,
+                    month_start,
+                    month_end,
+                )
 
-                    user_activities = {}
-                    for row in activity_rows:
-                        uid = row["user_id"]
-                        activities = row["activities"]
-                        if isinstance(activities, str):
-                            try:
-                                activities = json.loads(activities)
-                            except:
-                                activities = {}
-                        user_activities[uid] = activities or {}
+                # ===== 5. 上下班计数 + 迟到早退 =====
+                work_counts_query = self.pool.fetch(
+                    """
+                    SELECT
+                        user_id,
+                        COUNT(*) FILTER (WHERE checkin_type='work_start') AS work_start_count,
+                        COUNT(*) FILTER (WHERE checkin_type='work_end') AS work_end_count,
+                        COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type='work_start'), 0) AS work_start_fines,
+                        COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type='work_end'), 0) AS work_end_fines,
+                        COUNT(*) FILTER (WHERE checkin_type='work_start' AND time_diff_minutes>0) AS late_count,
+                        COUNT(*) FILTER (WHERE checkin_type='work_end' AND time_diff_minutes<0) AS early_count
+                    FROM work_records
+                    WHERE chat_id=$1 
+                      AND user_id=ANY($2::bigint[]) 
+                      AND record_date >= $3 
+                      AND record_date < $4
+                    GROUP BY user_id
+                    """,
+                    chat_id,
+                    user_ids,
+                    month_start,
+                    month_end,
+                )
 
-                    # ===== 5. 上下班计数 + 迟到早退 =====
-                    work_counts_rows = await conn.fetch(
-                        """
-                        SELECT
-                            user_id,
-                            COUNT(CASE WHEN checkin_type='work_start' THEN 1 END) as work_start_count,
-                            COUNT(CASE WHEN checkin_type='work_end' THEN 1 END) as work_end_count,
-                            SUM(CASE WHEN checkin_type='work_start' THEN fine_amount ELSE 0 END) as work_start_fines,
-                            SUM(CASE WHEN checkin_type='work_end' THEN fine_amount ELSE 0 END) as work_end_fines,
-                            COUNT(CASE WHEN checkin_type='work_start' AND time_diff_minutes>0 THEN 1 END) as late_count,
-                            COUNT(CASE WHEN checkin_type='work_end' AND time_diff_minutes<0 THEN 1 END) as early_count
-                        FROM work_records
-                        WHERE chat_id=$1 
-                          AND user_id=ANY($2::bigint[]) 
-                          AND record_date >= $3 
-                          AND record_date < $4
-                        GROUP BY user_id
-                        """,
-                        chat_id,
-                        user_ids,
-                        month_start,
-                        month_end,
+                # ===== 6. 夜班跨天处理 =====
+                # 起止时刻拼接、跨天补一天、按月边界裁剪与求和全部在库内完成；
+                # 只取可能与本月重叠的上班记录（结束最晚在上班日后一天）
+                night_query = self.pool.fetch(
+                    """
+                    SELECT
+                        user_id,
+                        COUNT(*) AS days,
+                        COALESCE(SUM(EXTRACT(EPOCH FROM LEAST(end_ts, $4::date) - GREATEST(start_ts, $3::date)))::bigint, 0) AS seconds
+                    FROM (
+                        SELECT 
+                            wr_start.user_id,
+                            wr_start.record_date + wr_start.checkin_time::time AS start_ts,
+                            wr_end.record_date + wr_end.checkin_time::time
+                                + CASE WHEN wr_end.record_date + wr_end.checkin_time::time
+                                            < wr_start.record_date + wr_start.checkin_time::time
+                                       THEN INTERVAL '1 day' ELSE INTERVAL '0' END AS end_ts
+                        FROM work_records wr_start
+                        JOIN work_records wr_end
+                            ON wr_start.chat_id = wr_end.chat_id 
+                            AND wr_start.user_id = wr_end.user_id
+                            AND wr_start.shift = wr_end.shift
+                            AND wr_start.record_date = wr_end.record_date
+                            AND wr_end.checkin_type = 'work_end'
+                        WHERE wr_start.chat_id = $1 
+                          AND wr_start.user_id = ANY($2::bigint[]) 
+                          AND wr_start.shift = 'night' 
+                          AND wr_start.checkin_type = 'work_start'
+                          AND wr_start.record_date >= $3::date - 1
+                          AND wr_start.record_date < $4::date
+                          AND wr_start.checkin_time ~ '^[0-9]{1,2}:[0-9]{2}$'
+                          AND wr_end.checkin_time ~ '^[0-9]{1,2}:[0-9]{2}$'
+                    ) t
+                    WHERE LEAST(end_ts, $4::date) > GREATEST(start_ts, $3::date)
+                    GROUP BY user_id
+                    """,
+                    chat_id,
+                    user_ids,
+                    month_start,
+                    month_end,
+                )
+
+                # TaskGroup 中任一查询失败或整体超时，其余查询都会被取消并等待结束
+                async with asyncio.TaskGroup() as tg:
+                    activity_task = tg.create_task(activity_query)
+                    work_counts_task = tg.create_task(work_counts_query)
+                    night_task = tg.create_task(night_query)
+                activity_rows = activity_task.result()
+                work_counts_rows = work_counts_task.result()
+                night_rows = night_task.result()
+
+                user_activities = {}
+                for uid, activities in activity_rows:
+                    if isinstance(activities, str):
+                        try:
+                            activities = json.loads(activities)
+                        except:
+                            activities = {}
+                    user_activities[uid] = activities or {}
+
+                user_work_counts = {r["user_id"]: r for r in work_counts_rows}
+
+                user_night_work = {uid: {"days": 0, "hours": 0} for uid in user_ids}
+                for uid, days, seconds in night_rows:
+                    user_night_work[uid] = {"days": days, "hours": seconds}
+
+                # ===== 7. 组装最终结果（按班次分离）=====
+                result = []
+                for uid in user_ids:
+                    nickname = user_nicknames.get(uid, f"用户{uid}")
+                    acts = user_activities.get(uid, {})
+                    work = user_work_counts.get(uid, {})
+
+                    # 白班数据
+                    day_stats = stats_by_user_shift.get((uid, "day"), {})
+                    result.append(
+                        {
+                            "user_id": uid,
+                            "nickname": nickname,
+                            "shift": "day",
+                            "total_activity_count": day_stats.get(
+                                "total_activity_count", 0
+                            ),
+                            "total_accumulated_time": day_stats.get(
+                                "total_accumulated_time", 0
+                            ),
+                            "total_fines": day_stats.get("total_fines", 0),
+                            "overtime_count": day_stats.get(
+                                "total_overtime_count", 0
+                            ),
+                            "total_overtime_time": day_stats.get(
+                                "total_overtime_time", 0
+                            ),
+                            "work_days": day_stats.get("work_days", 0),
+                            "work_hours": day_stats.get("work_hours", 0),
+                            "work_start_count": day_stats.get(
+                                "work_start_count", work.get("work_start_count", 0)
+                            ),
+                            "work_end_count": day_stats.get(
+                                "work_end_count", work.get("work_end_count", 0)
+                            ),
+                            "work_start_fines": day_stats.get(
+                                "work_start_fines", work.get("work_start_fines", 0)
+                            ),
+                            "work_end_fines": day_stats.get(
+                                "work_end_fines", work.get("work_end_fines", 0)
+                            ),
+                            "late_count": day_stats.get(
+                                "late_count", work.get("late_count", 0)
+                            ),
+                            "early_count": day_stats.get(
+                                "early_count", work.get("early_count", 0)
+                            ),
+                            "activities": acts,
+                        }
                     )
-                    user_work_counts = {r["user_id"]: dict(r) for r in work_counts_rows}
 
-                    # ===== 6. 夜班跨天处理 =====
-                    night_rows = await conn.fetch(
-                        """
-                        SELECT 
-                            wr_start.user_id,
-                            wr_start.record_date as start_date,
-                            wr_start.checkin_time as start_time,
-                            wr_end.record_date as end_date,
-                            wr_end.checkin_time as end_time
-                        FROM work_records wr_start
-                        LEFT JOIN work_records wr_end
-                            ON wr_start.chat_id = wr_end.chat_id 
-                            AND wr_start.user_id = wr_end.user_id
-                            AND wr_start.shift = wr_end.shift
-                            AND wr_start.record_date = wr_end.record_date
-                            AND wr_start.checkin_type = 'work_start' 
-                            AND wr_end.checkin_type = 'work_end'
-                        WHERE wr_start.chat_id = $1 
-                          AND wr_start.user_id = ANY($2::bigint[]) 
-                          AND wr_start.shift = 'night' 
-                          AND wr_start.checkin_type = 'work_start'
-                        """,
-                        chat_id,
-                        user_ids,
+                    # 夜班数据
+                    night_stats = stats_by_user_shift.get((uid, "night"), {})
+                    night_work = user_night_work.get(uid, {"days": 0, "hours": 0})
+                    result.append(
+                        {
+                            "user_id": uid,
+                            "nickname": nickname,
+                            "shift": "night",
+                            "total_activity_count": night_stats.get(
+                                "total_activity_count", 0
+                            ),
+                            "total_accumulated_time": night_stats.get(
+                                "total_accumulated_time", 0
+                            ),
+                            "total_fines": night_stats.get("total_fines", 0),
+                            "overtime_count": night_stats.get(
+                                "total_overtime_count", 0
+                            ),
+                            "total_overtime_time": night_stats.get(
+                                "total_overtime_time", 0
+                            ),
+                            "work_days": night_work["days"],
+                            "work_hours": night_work["hours"],
+                            "work_start_count": night_stats.get(
+                                "work_start_count", 0
+                            ),
+                            "work_end_count": night_stats.get("work_end_count", 0),
+                            "work_start_fines": night_stats.get(
+                                "work_start_fines", 0
+                            ),
+                            "work_end_fines": night_stats.get("work_end_fines", 0),
+                            "late_count": night_stats.get("late_count", 0),
+                            "early_count": night_stats.get("early_count", 0),
+                            "activities": acts,
+                        }
                     )
 
-                    user_night_work = {uid: {"days": 0, "hours": 0} for uid in user_ids}
-                    for row in night_rows:
-                        uid = row["user_id"]
-                        if row["end_date"] and row["end_time"]:
-                            try:
-                                start_dt = beijing_tz.localize(
-                                    datetime.combine(
-                                        row["start_date"],
-                                        datetime.strptime(
-                                            row["start_time"], "%H:%M"
-                                        ).time(),
-                                    )
-                                )
-                                end_dt = beijing_tz.localize(
-                                    datetime.combine(
-                                        row["end_date"],
-                                        datetime.strptime(
-                                            row["end_time"], "%H:%M"
-                                        ).time(),
-                                    )
-                                )
-                                if end_dt < start_dt:
-                                    end_dt += timedelta(days=1)
-
-                                work_start = max(start_dt, month_start_dt)
-                                work_end = min(end_dt, month_end_dt)
-                                if work_end > work_start:
-                                    seconds = int(
-                                        (work_end - work_start).total_seconds()
-                                    )
-                                    user_night_work[uid]["hours"] += seconds
-                                    user_night_work[uid]["days"] += 1
-                            except Exception as e:
-                                logger.error(f"夜班计算失败 user={uid}: {e}")
-
-                    # ===== 7. 组装最终结果（按班次分离）=====
-                    result = []
-                    for uid in user_ids:
-                        nickname = user_nicknames.get(uid, f"用户{uid}")
-                        acts = user_activities.get(uid, {})
-                        work = user_work_counts.get(uid, {})
-
-                        # 白班数据
-                        day_stats = stats_by_user_shift.get((uid, "day"), {})
-                        result.append(
-                            {
-                                "user_id": uid,
-                                "nickname": nickname,
-                                "shift": "day",
-                                "total_activity_count": day_stats.get(
-                                    "total_activity_count", 0
-                                ),
-                                "total_accumulated_time": day_stats.get(
-                                    "total_accumulated_time", 0
-                                ),
-                                "total_fines": day_stats.get("total_fines", 0),
-                                "overtime_count": day_stats.get(
-                                    "total_overtime_count", 0
-                                ),
-                                "total_overtime_time": day_stats.get(
-                                    "total_overtime_time", 0
-                                ),
-                                "work_days": day_stats.get("work_days", 0),
-                                "work_hours": day_stats.get("work_hours", 0),
-                                "work_start_count": day_stats.get(
-                                    "work_start_count", work.get("work_start_count", 0)
-                                ),
-                                "work_end_count": day_stats.get(
-                                    "work_end_count", work.get("work_end_count", 0)
-                                ),
-                                "work_start_fines": day_stats.get(
-                                    "work_start_fines", work.get("work_start_fines", 0)
-                                ),
-                                "work_end_fines": day_stats.get(
-                                    "work_end_fines", work.get("work_end_fines", 0)
-                                ),
-                                "late_count": day_stats.get(
-                                    "late_count", work.get("late_count", 0)
-                                ),
-                                "early_count": day_stats.get(
-                                    "early_count", work.get("early_count", 0)
-                                ),
-                                "activities": acts,
-                            }
-                        )
-
-                        # 夜班数据
-                        night_stats = stats_by_user_shift.get((uid, "night"), {})
-                        night_work = user_night_work.get(uid, {"days": 0, "hours": 0})
-                        result.append(
-                            {
-                                "user_id": uid,
-                                "nickname": nickname,
-                                "shift": "night",
-                                "total_activity_count": night_stats.get(
-                                    "total_activity_count", 0
-                                ),
-                                "total_accumulated_time": night_stats.get(
-                                    "total_accumulated_time", 0
-                                ),
-                                "total_fines": night_stats.get("total_fines", 0),
-                                "overtime_count": night_stats.get(
-                                    "total_overtime_count", 0
-                                ),
-                                "total_overtime_time": night_stats.get(
-                                    "total_overtime_time", 0
-                                ),
-                                "work_days": night_work["days"],
-                                "work_hours": night_work["hours"],
-                                "work_start_count": night_stats.get(
-                                    "work_start_count", 0
-                                ),
-                                "work_end_count": night_stats.get("work_end_count", 0),
-                                "work_start_fines": night_stats.get(
-                                    "work_start_fines", 0
-                                ),
-                                "work_end_fines": night_stats.get("work_end_fines", 0),
-                                "late_count": night_stats.get("late_count", 0),
-                                "early_count": night_stats.get("early_count", 0),
-                                "activities": acts,
-                            }
-                        )
-
-                    # 按用户ID和班次排序
-                    result.sort(key=lambda x: (x["user_id"], x["shift"]))
+                # 按用户ID和班次排序
+                result.sort(key=lambda x: (x["user_id"], x["shift"]))
 
-                    logger.info(
-                        f"✅ 月度统计完成\n"
-                        f"   ├─ 年月: {year}年{month}月\n"
-                        f"   ├─ 用户: {len(user_ids)} 人\n"
-                        f"   └─ 记录: {len(result)} 条"
-                    )
-                    return result
+                logger.info(
+                    f"✅ 月度统计完成\n"
+                    f"   ├─ 年月: {year}年{month}月\n"
+                    f"   ├─ 用户: {len(user_ids)} 人\n"
+                    f"   └─ 记录: {len(result)} 条"
+                )
+                return result
 
         except asyncio.TimeoutError:
             logger.error(f"❌ 月度统计超时 ({timeout}s) chat={chat_id}")
@@ -4083,27 +4367,32 @@ class PostgreSQLDatabase:
         else:
             end_date = date(year, month + 1, 1)
 
+        # 先在 work_records 上按用户聚合（idx_work_records_month 覆盖，无需回表），
+        # 再只对聚合结果关联 users 取昵称
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
+        rows = await self.pool.fetch(
+            """
+            WITH agg AS (
                 SELECT 
-                    wr.user_id,
-                    u.nickname,
-                    COUNT(CASE WHEN wr.checkin_type = 'work_start' THEN 1 END) as work_start_count,
-                    COUNT(CASE WHEN wr.checkin_type = 'work_end' THEN 1 END) as work_end_count,
-                    SUM(CASE WHEN wr.checkin_type = 'work_start' THEN wr.fine_amount ELSE 0 END) as work_start_fines,
-                    SUM(CASE WHEN wr.checkin_type = 'work_end' THEN wr.fine_amount ELSE 0 END) as work_end_fines
-                FROM work_records wr
-                JOIN users u ON wr.chat_id = u.chat_id AND wr.user_id = u.user_id
-                WHERE wr.chat_id = $1 AND wr.record_date >= $2 AND wr.record_date < $3
-                GROUP BY wr.user_id, u.nickname
-                """,
-                chat_id,
-                start_date,
-                end_date,
+                    user_id,
+                    COUNT(*) FILTER (WHERE checkin_type = 'work_start') AS work_start_count,
+                    COUNT(*) FILTER (WHERE checkin_type = 'work_end') AS work_end_count,
+                    COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type = 'work_start'), 0) AS work_start_fines,
+                    COALESCE(SUM(fine_amount) FILTER (WHERE checkin_type = 'work_end'), 0) AS work_end_fines
+                FROM work_records
+                WHERE chat_id = $1 AND record_date >= $2 AND record_date < $3
+                GROUP BY user_id
             )
-            return [dict(row) for row in rows]
+            SELECT agg.user_id, u.nickname, agg.work_start_count, agg.work_end_count,
+                   agg.work_start_fines, agg.work_end_fines
+            FROM agg
+            JOIN users u ON u.chat_id = $1 AND u.user_id = agg.user_id
+            """,
+            chat_id,
+            start_date,
+            end_date,
+        )
+        return [dict(row) for row in rows]
 
     async def get_monthly_activity_ranking(
         self, chat_id: int, year: int = None, month: int = None
@@ -4114,33 +4403,60 @@ class PostgreSQLDatabase:
             year = today.year
             month = today.month
 
-        statistic_date = date(year, month, 1)
+        month_start = date(year, month, 1)
+        month_end = date(year + 1, 1, 1) if month == 12 else date(year, month + 1, 1)
         activity_limits = await self.get_activity_limits()
+        activities = list(activity_limits.keys())
 
+        # 所有活动一次查询：按 (活动, 用户) 汇总当月明细，窗口函数在库内按活动取前 10，
+        # 仅对入榜行关联 users 取昵称
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rankings = {}
-            for activity in activity_limits.keys():
-                rows = await conn.fetch(
-                    """
-                    SELECT 
-                        ms.user_id,
-                        u.nickname,
-                        ms.accumulated_time as total_time,
-                        ms.activity_count as total_count
-                    FROM monthly_statistics ms
-                    JOIN users u ON ms.chat_id = u.chat_id AND ms.user_id = u.user_id
-                    WHERE ms.chat_id = $1 AND ms.activity_name = $2 
-                        AND ms.statistic_date = $3
-                    ORDER BY ms.accumulated_time DESC
-                    LIMIT 10
-                    """,
-                    chat_id,
-                    activity,
-                    statistic_date,
-                )
-                rankings[activity] = [dict(row) for row in rows]
-            return rankings
+        rows = await self.pool.fetch(
+            """
+            WITH agg AS (
+                SELECT 
+                    activity_name,
+                    user_id,
+                    SUM(accumulated_time) AS total_time,
+                    SUM(activity_count) AS total_count
+                FROM user_activities
+                WHERE chat_id = $1 
+                  AND activity_date >= $2 
+                  AND activity_date < $3
+                  AND activity_name = ANY($4::text[])
+                GROUP BY activity_name, user_id
+            ),
+            ranked AS (
+                SELECT 
+                    agg.*,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY activity_name ORDER BY total_time DESC
+                    ) AS rn
+                FROM agg
+            )
+            SELECT r.activity_name, r.user_id, u.nickname, r.total_time, r.total_count
+            FROM ranked r
+            JOIN users u ON u.chat_id = $1 AND u.user_id = r.user_id
+            WHERE r.rn <= 10
+            ORDER BY r.activity_name, r.rn
+            """,
+            chat_id,
+            month_start,
+            month_end,
+            activities,
+        )
+
+        rankings = {activity: [] for activity in activities}
+        for activity_name, user_id, nickname, total_time, total_count in rows:
+            rankings[activity_name].append(
+                {
+                    "user_id": user_id,
+                    "nickname": nickname,
+                    "total_time": total_time,
+                    "total_count": total_count,
+                }
+            )
+        return rankings
 
     async def get_user_late_early_counts(
         self, chat_id: int, user_id: int, year: int, month: int
@@ -4218,9 +4534,8 @@ class PostgreSQLDatabase:
                 now,
             )
 
-            cache_key = f"shift_state:{chat_id}:{user_id}:{shift}"
-            self._cache.pop(cache_key, None)
-            self._cache_ttl.pop(cache_key, None)
+            cache_key = ("shift_state", chat_id, user_id, shift)
+            self._pop_cached(cache_key)
             return True
 
         except Exception as e:
@@ -4246,9 +4561,8 @@ class PostgreSQLDatabase:
                 shift,
             )
 
-            cache_key = f"shift_state:{chat_id}:{user_id}:{shift}"
-            self._cache.pop(cache_key, None)
-            self._cache_ttl.pop(cache_key, None)
+            cache_key = ("shift_state", chat_id, user_id, shift)
+            self._pop_cached(cache_key)
             return True
 
         except Exception as e:
@@ -4262,7 +4576,7 @@ class PostgreSQLDatabase:
         shift: str,
     ) -> Optional[Dict]:
         """获取用户班次状态"""
-        cache_key = f"shift_state:{chat_id}:{user_id}:{shift}"
+        cache_key = ("shift_state", chat_id, user_id, shift)
         cached = self._get_cached(cache_key)
         if cached is not None:
             return cached
@@ -4337,37 +4651,31 @@ class PostgreSQLDatabase:
             now = self.get_beijing_time()
             expired_time = now - timedelta(hours=16)
 
-            async with self.pool.acquire() as conn:
-                rows = await conn.fetch(
-                    """
-                    SELECT chat_id, user_id, shift
-                    FROM group_shift_state
-                    WHERE shift_start_time < $1
-                    """,
-                    expired_time,
-                )
-
-                result = await conn.execute(
-                    """
-                    DELETE FROM group_shift_state
-                    WHERE shift_start_time < $1
-                    """,
-                    expired_time,
-                )
+            # 删除与取回被删行合并为一条语句，不再先 SELECT 同一谓词再 DELETE 扫两遍
+            rows = await self.pool.fetch(
+                """
+                DELETE FROM group_shift_state
+                WHERE shift_start_time < $1
+                RETURNING chat_id, user_id, shift
+                """,
+                expired_time,
+            )
 
-                deleted = 0
-                if result and result.startswith("DELETE"):
-                    deleted = int(result.split()[-1])
+            deleted = len(rows)
 
-                if deleted > 0:
-                    logger.info(f"🧹 清理了 {deleted} 个过期的用户班次状态")
+            if deleted > 0:
+                logger.info(f"🧹 清理了 {deleted} 个过期的用户班次状态")
 
-                    for row in rows:
-                        cache_key = f"shift_state:{row['chat_id']}:{row['user_id']}:{row['shift']}"
-                        self._cache.pop(cache_key, None)
-                        self._cache_ttl.pop(cache_key, None)
+                for row in rows:
+                    cache_key = (
+                        "shift_state",
+                        row["chat_id"],
+                        row["user_id"],
+                        row["shift"],
+                    )
+                    self._pop_cached(cache_key)
 
-                return deleted
+            return deleted
 
         except Exception as e:
             logger.error(f"清理过期班次状态失败: {e}")
@@ -4377,19 +4685,18 @@ class PostgreSQLDatabase:
     async def get_user_active_shift(self, chat_id: int, user_id: int) -> Optional[Dict]:
         """获取用户当前活跃的班次（任意班次）"""
         try:
-            async with self.pool.acquire() as conn:
-                row = await conn.fetchrow(
-                    """
-                    SELECT shift, record_date, shift_start_time
-                    FROM group_shift_state
-                    WHERE chat_id = $1 AND user_id = $2
-                    ORDER BY shift_start_time DESC
-                    LIMIT 1
-                    """,
-                    chat_id,
-                    user_id,
-                )
-                return dict(row) if row else None
+            row = await self.pool.fetchrow(
+                """
+                SELECT shift, record_date, shift_start_time
+                FROM group_shift_state
+                WHERE chat_id = $1 AND user_id = $2
+                ORDER BY shift_start_time DESC
+                LIMIT 1
+                """,
+                chat_id,
+                user_id,
+            )
+            return dict(row) if row else None
         except Exception as e:
             logger.error(f"获取用户活跃班次失败: {e}")
             return None
@@ -4397,16 +4704,15 @@ class PostgreSQLDatabase:
     async def count_active_users_in_shift(self, chat_id: int, shift: str) -> int:
         """统计指定班次中的活跃用户数"""
         try:
-            async with self.pool.acquire() as conn:
-                count = await conn.fetchval(
-                    """
-                    SELECT COUNT(*) FROM group_shift_state
-                    WHERE chat_id = $1 AND shift = $2
-                    """,
-                    chat_id,
-                    shift,
-                )
-                return count or 0
+            count = await self.pool.fetchval(
+                """
+                SELECT COUNT(*) FROM group_shift_state
+                WHERE chat_id = $1 AND shift = $2
+                """,
+                chat_id,
+                shift,
+            )
+            return count or 0
         except Exception as e:
             logger.error(f"统计班次活跃用户失败: {e}")
             return 0
@@ -4433,7 +4739,8 @@ class PostgreSQLDatabase:
             day_end if enabled else None,
             chat_id,
         )
-        self._cache.pop(f"group:{chat_id}", None)
+        self._pop_cached(("group", chat_id))
+        self._business_anchor_cache.pop(chat_id, None)
 
     async def update_shift_grace_window(
         self, chat_id: int, grace_before: int, grace_after: int
@@ -4452,7 +4759,8 @@ class PostgreSQLDatabase:
             grace_after,
             chat_id,
         )
-        self._cache.pop(f"group:{chat_id}", None)
+        self._pop_cached(("group", chat_id))
+        self._business_anchor_cache.pop(chat_id, None)
 
     async def update_workend_grace_window(
         self, chat_id: int, grace_before: int, grace_after: int
@@ -4471,7 +4779,7 @@ class PostgreSQLDatabase:
             grace_after,
             chat_id,
         )
-        self._cache.pop(f"group:{chat_id}", None)
+        self._pop_cached(("group", chat_id))
 
     async def get_shift_config(self, chat_id: int) -> Dict:
         """获取班次配置（默认双班模式）"""
@@ -4743,7 +5051,7 @@ class PostgreSQLDatabase:
 
         if record_date is not None:
             if shift == "night" and checkin_type == "work_end":
-                business_date = record_date + timedelta(days=1)
+                business_date = record_date + _ONE_DAY
                 logger.debug(
                     f"📅 [业务日期-状态模型-夜班下班] "
                     f"chat_id={chat_id}, "
@@ -4763,7 +5071,7 @@ class PostgreSQLDatabase:
 
         if shift_detail in ("night_last", "night_tonight", "day"):
             if shift_detail == "night_last":
-                business_date = today - timedelta(days=1)
+                business_date = today - _ONE_DAY
             else:
                 business_date = today
 
@@ -4777,28 +5085,35 @@ class PostgreSQLDatabase:
             )
             return business_date
 
-        shift_config = await self.get_shift_config(chat_id)
-        day_start = shift_config.get("day_start", "09:00")
-        grace_before = shift_config.get("grace_before", 120)
-
-        day_start_time = datetime.strptime(day_start, "%H:%M").time()
-        day_start_dt = datetime.combine(today, day_start_time).replace(
-            tzinfo=current_dt.tzinfo
-        )
-
-        earliest_day_time = day_start_dt - timedelta(minutes=grace_before)
+        # 最早可上班时刻 = 白班开始 - 提前宽容，以当日分钟数缓存，纯整数比较
+        shift_config = None
+        anchor = self._business_anchor_cache.get(chat_id)
+        if anchor is not None and time.monotonic() < anchor[0]:
+            earliest_minutes = anchor[1]
+        else:
+            shift_config = await self.get_shift_config(chat_id)
+            day_start = shift_config.get("day_start", "09:00")
+            grace_before = shift_config.get("grace_before", 120)
+            start_hour, start_minute = map(int, day_start.split(":"))
+            earliest_minutes = start_hour * 60 + start_minute - grace_before
+            self._business_anchor_cache[chat_id] = (
+                time.monotonic() + 300,
+                earliest_minutes,
+            )
 
-        if current_dt >= earliest_day_time:
+        if current_dt.hour * 60 + current_dt.minute >= earliest_minutes:
             logger.debug(
                 f"📅 [提前上班判定] "
                 f"chat={chat_id}, "
                 f"time={current_dt.strftime('%H:%M')}, "
-                f"earliest={earliest_day_time.strftime('%H:%M')}, "
+                f"earliest={earliest_minutes // 60 % 24:02d}:{earliest_minutes % 60:02d}, "
                 f"result={today}"
             )
             return today
 
         if shift and checkin_type:
+            if shift_config is None:
+                shift_config = await self.get_shift_config(chat_id)
             window_info = (
                 self.calculate_shift_window(
                     shift_config=shift_config,
@@ -4811,7 +5126,7 @@ class PostgreSQLDatabase:
             current_shift_detail = window_info.get("current_shift")
 
             if current_shift_detail == "night_last":
-                business_date = today - timedelta(days=1)
+                business_date = today - _ONE_DAY
             elif current_shift_detail in ("night_tonight", "day"):
                 business_date = today
             else:
@@ -5063,18 +5378,38 @@ class PostgreSQLDatabase:
             return "night_last"
 
     # ========== 数据清理 ==========
-    def _parse_row_count(self, result_str: str) -> int:
-        """解析 PostgreSQL DELETE 结果中的行数"""
-        try:
-            # asyncpg 返回的格式通常是 "DELETE 100"
-            if result_str and result_str.startswith("DELETE"):
-                parts = result_str.split()
-                if len(parts) == 2:
-                    return int(parts[1])
-        except (ValueError, IndexError, AttributeError):
-            # 捕获可能的解析异常，确保维护逻辑不会因为日志解析失败而中断
-            pass
-        return 0
+    # 分批清理时单条 DELETE 的最大行数
+    _CLEANUP_BATCH_SIZE = 5000
+
+    async def _delete_before_in_batches(
+        self, conn, table: str, col: str, cutoff_date: date, order_by: str = "id"
+    ) -> int:
+        """分批删除 col < cutoff_date 的行，返回删除总数
+
+        默认按主键顺序取批：仅适用于日期列写入后不再变化的只追加表（记录、日统计、日志），
+        此时自增 id 与日期同序，过期行集中在 id 低端，每批沿主键索引扫到够数即止；
+        日期列会被反复更新的表（如 users.last_updated）须传 order_by=col，按日期列本身取批。
+        每批各自提交，单条语句短小，不会因整表删除撞上语句超时而全部回滚，也不会一次产生大量 WAL
+        """
+        total = 0
+        while True:
+            result = await conn.execute(
+                f"""
+                DELETE FROM {table}
+                WHERE id IN (
+                    SELECT id FROM {table}
+                    WHERE {col} < $1
+                    ORDER BY {order_by}
+                    LIMIT $2
+                )
+                """,
+                cutoff_date,
+                self._CLEANUP_BATCH_SIZE,
+            )
+            batch = _tag_rowcount(result)
+            total += batch
+            if batch < self._CLEANUP_BATCH_SIZE:
+                return total
 
     async def cleanup_old_data(self, days: int = 30) -> int:
         """清理旧数据 - 最终极致稳定版"""
@@ -5099,15 +5434,12 @@ class PostgreSQLDatabase:
 
                 # 2. 采用单条执行模式，而非大事务
                 # 这样做的好处是：删掉一个表就即时生效一个，减少长事务对数据库 Undo Log 的压力
+                # 3. 每张表按主键顺序分批删除，见 _delete_before_in_batches
                 for table, col in tables:
                     try:
-                        # 执行删除操作
-                        result = await conn.execute(
-                            f"DELETE FROM {table} WHERE {col} < $1", cutoff_date
+                        count = await self._delete_before_in_batches(
+                            conn, table, col, cutoff_date
                         )
-
-                        # 解析受影响的行数
-                        count = self._parse_row_count(result)
                         total_deleted += count
 
                         if count > 0:
@@ -5178,12 +5510,7 @@ class PostgreSQLDatabase:
                     cutoff_date,
                 )
 
-                deleted_count = 0
-                if result and result.startswith("DELETE"):
-                    try:
-                        deleted_count = int(result.split()[-1])
-                    except (ValueError, IndexError):
-                        pass
+                deleted_count = _tag_rowcount(result)
 
                 logger.info(
                     f"✅ 月度数据清理完成\n"
@@ -5207,9 +5534,7 @@ class PostgreSQLDatabase:
             result = await conn.execute(
                 "DELETE FROM monthly_statistics WHERE statistic_date = $1", target_date
             )
-            return (
-                int(result.split()[-1]) if result and result.startswith("DELETE") else 0
-            )
+            return _tag_rowcount(result)
 
     async def cleanup_inactive_users(self, days: int = 30) -> int:
         """清理长期未活动用户及其记录（安全版）"""
@@ -5226,89 +5551,97 @@ class PostgreSQLDatabase:
                 # 使用事务保证清理过程的原子性，防止出现“删了记录但没删用户”的情况
                 async with conn.transaction():
 
-                    # ===== 2. 找出要删除的用户 =====
+                    # ===== 2. 单条 CTE 完成筛选与删除 =====
                     # 判定标准：last_updated 过期，且在所有业务表中近期都没有活动记录
-                    users_to_delete = await conn.fetch(
+                    # 按 (chat_id, user_id) 精确删除，避免误删该用户在其他群组的数据
+                    counts = await conn.fetchrow(
                         """
-                        SELECT u.chat_id, u.user_id, u.nickname
-                        FROM users u
-                        WHERE u.last_updated < $1
-                        AND NOT EXISTS (
-                            SELECT 1 FROM daily_statistics ds 
-                            WHERE ds.chat_id = u.chat_id 
-                            AND ds.user_id = u.user_id
-                            AND ds.record_date > $2
-                        )
-                        AND NOT EXISTS (
-                            SELECT 1 FROM work_records wr 
-                            WHERE wr.chat_id = u.chat_id 
-                            AND wr.user_id = u.user_id
-                            AND wr.record_date > $2
-                        )
-                        AND NOT EXISTS (
-                            SELECT 1 FROM user_activities ua 
-                            WHERE ua.chat_id = u.chat_id 
-                            AND ua.user_id = u.user_id
-                            AND ua.activity_date > $2
-                        )
-                        AND NOT EXISTS (
-                            SELECT 1 FROM monthly_statistics ms 
-                            WHERE ms.chat_id = u.chat_id 
-                            AND ms.user_id = u.user_id
+                        WITH victims AS (
+                            SELECT u.chat_id, u.user_id
+                            FROM users u
+                            WHERE u.last_updated < $1
+                            AND NOT EXISTS (
+                                SELECT 1 FROM daily_statistics ds 
+                                WHERE ds.chat_id = u.chat_id 
+                                AND ds.user_id = u.user_id
+                                AND ds.record_date > $2
+                            )
+                            AND NOT EXISTS (
+                                SELECT 1 FROM work_records wr 
+                                WHERE wr.chat_id = u.chat_id 
+                                AND wr.user_id = u.user_id
+                                AND wr.record_date > $2
+                            )
+                            AND NOT EXISTS (
+                                SELECT 1 FROM user_activities ua 
+                                WHERE ua.chat_id = u.chat_id 
+                                AND ua.user_id = u.user_id
+                                AND ua.activity_date > $2
+                            )
+                            AND NOT EXISTS (
+                                SELECT 1 FROM monthly_statistics ms 
+                                WHERE ms.chat_id = u.chat_id 
+                                AND ms.user_id = u.user_id
+                            )
+                        ),
+                        ua AS (
+                            DELETE FROM user_activities t USING victims v
+                            WHERE t.chat_id = v.chat_id AND t.user_id = v.user_id
+                            RETURNING 1
+                        ),
+                        wr AS (
+                            DELETE FROM work_records t USING victims v
+                            WHERE t.chat_id = v.chat_id AND t.user_id = v.user_id
+                            RETURNING 1
+                        ),
+                        ds AS (
+                            DELETE FROM daily_statistics t USING victims v
+                            WHERE t.chat_id = v.chat_id AND t.user_id = v.user_id
+                            RETURNING 1
+                        ),
+                        du AS (
+                            DELETE FROM users t USING victims v
+                            WHERE t.chat_id = v.chat_id AND t.user_id = v.user_id
+                            RETURNING t.chat_id, t.user_id
                         )
+                        SELECT
+                            d.chat_ids,
+                            d.user_ids,
+                            (SELECT COUNT(*) FROM ua) AS ua_count,
+                            (SELECT COUNT(*) FROM wr) AS wr_count,
+                            (SELECT COUNT(*) FROM ds) AS ds_count
+                        FROM (
+                            -- 同一次聚合中生成两个数组，保证下标一一对应
+                            SELECT array_agg(chat_id) AS chat_ids, array_agg(user_id) AS user_ids
+                            FROM du
+                        ) d
                         """,
                         cutoff_date,
                         recent_threshold,
                     )
 
-                    if not users_to_delete:
+                    # 只返回一行：被删用户的 (chat_id, user_id) 以两个数组带回，无用户时为 NULL
+                    chat_ids = counts["chat_ids"] or []
+                    user_ids = counts["user_ids"] or []
+                    user_count = len(user_ids)
+                    if user_count == 0:
                         logger.info("✅ 没有需要清理的用户")
                         return 0
 
-                    user_ids = [u["user_id"] for u in users_to_delete]
-                    chat_ids = list(set([u["chat_id"] for u in users_to_delete]))
-
-                    logger.info(
-                        f"📊 发现 {len(users_to_delete)} 个可清理的用户，"
-                        f"分布在 {len(chat_ids)} 个群组"
-                    )
-
-                    # ===== 3. 批量删除相关记录 =====
-                    # 使用 ANY($1::bigint[]) 配合 List 传入，比循环 DELETE 快得多
-                    ua_result = await conn.execute(
-                        "DELETE FROM user_activities WHERE user_id = ANY($1::bigint[])",
-                        user_ids,
-                    )
-                    ua_count = self._parse_sql_result(ua_result)
-
-                    wr_result = await conn.execute(
-                        "DELETE FROM work_records WHERE user_id = ANY($1::bigint[])",
-                        user_ids,
-                    )
-                    wr_count = self._parse_sql_result(wr_result)
-
-                    ds_result = await conn.execute(
-                        "DELETE FROM daily_statistics WHERE user_id = ANY($1::bigint[])",
-                        user_ids,
-                    )
-                    ds_count = self._parse_sql_result(ds_result)
-
-                    user_result = await conn.execute(
-                        "DELETE FROM users WHERE user_id = ANY($1::bigint[])",
-                        user_ids,
-                    )
-                    user_count = self._parse_sql_result(user_result)
+                    ua_count = int(counts["ua_count"])
+                    wr_count = int(counts["wr_count"])
+                    ds_count = int(counts["ds_count"])
+                    chat_count = len(set(chat_ids))
 
-                    # ===== 4. 清理内存缓存 =====
-                    for user in users_to_delete:
-                        cache_key = f"user:{user['chat_id']}:{user['user_id']}"
-                        self._cache.pop(cache_key, None)
-                        self._cache_ttl.pop(cache_key, None)
+                    # ===== 3. 清理内存缓存 =====
+                    # 只移除被删用户对应的缓存键
+                    for chat_id, user_id in zip(chat_ids, user_ids):
+                        self._pop_cached(("user", chat_id, user_id))
 
-                    # ===== 5. 记录结果 =====
+                    # ===== 4. 记录结果 =====
                     total_deleted = ua_count + wr_count + ds_count + user_count
                     logger.info(
-                        f"✅ 清理完成:\n"
+                        f"✅ 清理完成（{chat_count} 个群组）:\n"
                         f"    ├─ 删除用户: {user_count} 个\n"
                         f"    ├─ 删除活动记录: {ua_count} 条\n"
                         f"    ├─ 删除工作记录: {wr_count} 条\n"
@@ -5358,16 +5691,15 @@ class PostgreSQLDatabase:
     async def is_reset_completed(self, chat_id: int, target_date: date) -> bool:
         """检查重置是否已完成"""
         try:
-            async with self.pool.acquire() as conn:
-                result = await conn.fetchval(
-                    """
-                    SELECT 1 FROM reset_logs
-                    WHERE chat_id = $1 AND reset_date = $2
-                """,
-                    chat_id,
-                    target_date,
-                )
-                return result is not None
+            result = await self.pool.fetchval(
+                """
+                SELECT 1 FROM reset_logs
+                WHERE chat_id = $1 AND reset_date = $2
+            """,
+                chat_id,
+                target_date,
+            )
+            return result is not None
         except Exception as e:
             logger.error(f"❌ 检查重置标记失败: {e}")
             return False
@@ -5394,12 +5726,7 @@ class PostgreSQLDatabase:
                 )
 
                 # 3. 解析结果：从 asyncpg 返回的 'DELETE N' 字符串中提取删除数量
-                deleted = 0
-                if result and result.startswith("DELETE"):
-                    try:
-                        deleted = int(result.split()[-1])
-                    except (ValueError, IndexError):
-                        pass
+                deleted = _tag_rowcount(result)
 
                 # 仅在有实际删除时记录日志，避免维护循环产生过多的冗余日志
                 if deleted > 0:
@@ -5431,44 +5758,37 @@ class PostgreSQLDatabase:
                 activity,
                 max_users,
             )
-        self._cache.pop(f"activity_limit:{activity}", None)
+        self._pop_cached("all_activity_limits")
 
     async def get_activity_user_limit(self, activity: str) -> int:
-        """获取活动人数限制"""
-        cache_key = f"activity_limit:{activity}"
-        cached = self._get_cached(cache_key)
-        if cached is not None:
-            return cached
-
-        self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                "SELECT max_users FROM activity_user_limits WHERE activity_name = $1",
-                activity,
-            )
-            limit = row["max_users"] if row else 0
-            self._set_cached(cache_key, limit, 60)
-            return limit
+        """获取活动人数限制（从全部限制的缓存中取，未设置返回 0）"""
+        limits = await self.get_all_activity_limits()
+        return limits.get(activity, 0)
 
     async def get_current_activity_users(self, chat_id: int, activity: str) -> int:
         """获取当前正在进行指定活动的用户数量"""
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            count = await conn.fetchval(
-                "SELECT COUNT(*) FROM users WHERE chat_id = $1 AND current_activity = $2",
-                chat_id,
-                activity,
-            )
-            return count or 0
+        count = await self.pool.fetchval(
+            "SELECT COUNT(*) FROM users WHERE chat_id = $1 AND current_activity = $2",
+            chat_id,
+            activity,
+        )
+        return count or 0
 
     async def get_all_activity_limits(self) -> Dict[str, int]:
-        """获取所有活动的人数限制"""
+        """获取所有活动的人数限制（带缓存，设置/移除时失效）"""
+        cache_key = "all_activity_limits"
+        cached = self._get_cached(cache_key)
+        if cached is not None:
+            return cached
+
         self._ensure_pool_initialized()
-        async with self.pool.acquire() as conn:
-            rows = await conn.fetch(
-                "SELECT activity_name, max_users FROM activity_user_limits"
-            )
-            return {row["activity_name"]: row["max_users"] for row in rows}
+        rows = await self.pool.fetch(
+            "SELECT activity_name, max_users FROM activity_user_limits"
+        )
+        limits = {row["activity_name"]: row["max_users"] for row in rows}
+        self._set_cached(cache_key, limits, 300)
+        return limits
 
     async def remove_activity_user_limit(self, activity: str):
         """移除活动人数限制"""
@@ -5477,7 +5797,7 @@ class PostgreSQLDatabase:
             await conn.execute(
                 "DELETE FROM activity_user_limits WHERE activity_name = $1", activity
             )
-        self._cache.pop(f"activity_limit:{activity}", None)
+        self._pop_cached("all_activity_limits")
 
     async def force_reset_all_users_in_group(
         self, chat_id: int, target_date: date = None
@@ -5489,47 +5809,35 @@ class PostgreSQLDatabase:
         next_day = target_date + timedelta(days=1)
 
         async with self.pool.acquire() as conn:
-            async with conn.transaction():
-                await conn.execute(
-                    """
-                    DELETE FROM user_activities 
-                    WHERE chat_id = $1 AND activity_date = $2
-                """,
-                    chat_id,
-                    target_date,
+            # 两天的活动明细删除与用户表重置合并为一条语句
+            await conn.execute(
+                """
+                WITH d AS (
+                    DELETE FROM user_activities
+                    WHERE chat_id = $1 AND activity_date IN ($2, $3)
+                    RETURNING 1
                 )
-
-                await conn.execute(
-                    """
-                    DELETE FROM user_activities 
-                    WHERE chat_id = $1 AND activity_date = $2
+                UPDATE users 
+                SET total_accumulated_time = 0, 
+                    total_activity_count = 0, 
+                    total_fines = 0,
+                    last_updated = $2
+                WHERE chat_id = $1
                 """,
-                    chat_id,
-                    next_day,
-                )
+                chat_id,
+                target_date,
+                next_day,
+            )
 
-                await conn.execute(
-                    """
-                    UPDATE users 
-                    SET total_accumulated_time = 0, 
-                        total_activity_count = 0, 
-                        total_fines = 0,
-                        last_updated = $2
-                    WHERE chat_id = $1
-                """,
-                    chat_id,
-                    target_date,
-                )
+            # 群组/用户/班次状态缓存经索引一次清除，无需扫描全部缓存键
+            self._invalidate_chat_cache(chat_id)
 
             keys_to_remove = [
-                f"group:{chat_id}",
                 f"rank:{chat_id}",
                 f"group_config:{chat_id}",
             ]
             for key in keys_to_remove:
-                self._cache.pop(key, None)
-                if key in self._cache_ttl:
-                    del self._cache_ttl[key]
+                self._pop_cached(key)
 
             logger.info(
                 f"✅ 已强制重置群组 {chat_id} (清理日期: {target_date} 及 {next_day})"
@@ -5541,17 +5849,7 @@ class PostgreSQLDatabase:
         """将秒数格式化为小时:分钟:秒的字符串"""
         if not seconds:
             return "0秒"
-
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        secs = seconds % 60
-
-        if hours > 0:
-            return f"{hours}小时{minutes}分{secs}秒"
-        elif minutes > 0:
-            return f"{minutes}分{secs}秒"
-        else:
-            return f"{secs}秒"
+        return _format_seconds_to_hms(int(seconds))
 
     @staticmethod
     def format_time_for_csv(seconds: int) -> str:
@@ -5568,15 +5866,24 @@ class PostgreSQLDatabase:
         else:
             return f"{minutes}分{secs}秒"
 
+    # 探活成功后的缓存时长（秒），期内重复调用不再占用连接做 SELECT 1
+    _HEALTH_TTL = 5.0
+
     async def connection_health_check(self) -> bool:
-        """快速连接健康检查"""
+        """快速连接健康检查（成功结果缓存 _HEALTH_TTL 秒）"""
         if not self.pool:
             return False
 
+        if time.monotonic() - self._last_healthy_ts < self._HEALTH_TTL:
+            return True
+
         try:
             async with self.pool.acquire() as conn:
                 result = await conn.fetchval("SELECT 1")
-                return result == 1
+            if result == 1:
+                self._last_healthy_ts = time.monotonic()
+                return True
+            return False
         except Exception as e:
             logger.debug(f"数据库连接健康检查失败: {e}")
             return False
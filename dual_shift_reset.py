@@ -7,7 +7,7 @@ from datetime import datetime, timedelta, date
 from typing import Dict, Optional, Any, List
 from performance import global_cache
 
-from database import db
+from database import db, _tag_rowcount
 
 
 # ========== 新增导入 ==========
@@ -394,19 +394,12 @@ async def _dual_shift_hard_reset(
                         business_today,
                     )
                 )
-                deleted_count = _parse_delete_count(result)
+                deleted_count = _tag_rowcount(result)
 
                 if deleted_count > 0:
                     logger.info(f"✅ 已清除 {deleted_count} 个过期班次状态")
 
-                    keys_to_remove = [
-                        key
-                        for key in db._cache.keys()
-                        if key.startswith(f"shift_state:{chat_id}:")
-                    ]
-                    for key in keys_to_remove:
-                        db._cache.pop(key, None)
-                        db._cache_ttl.pop(key, None)
+                    db._invalidate_chat_cache(chat_id, "shift_state")
                 else:
                     logger.info("✅ 没有需要清除的班次状态")
 
@@ -486,7 +479,7 @@ async def _get_activity_configs_batch(activities: List[str]) -> Dict[str, Dict]:
     返回格式: {
         '活动名': {
             'time_limit_seconds': int,
-            'fine_rates': Dict[str, int]
+            'fine_schedule': (分段元组, 罚款元组)
         }
     }
     """
@@ -504,7 +497,7 @@ async def _get_activity_configs_batch(activities: List[str]) -> Dict[str, Dict]:
         time_limit_min = all_limits.get(activity, {}).get("time_limit", 0)
         result[activity] = {
             "time_limit_seconds": time_limit_min * 60,
-            "fine_rates": all_fines.get(activity, {}),
+            "fine_schedule": db.normalize_fine_rates(all_fines.get(activity, {})),
         }
 
     logger.debug(f"📊 批量加载活动配置: {len(result)} 个活动: {list(result.keys())}")
@@ -675,29 +668,15 @@ async def _force_end_single_activity_optimized(
         # 使用预加载的配置
         config = activity_configs.get(activity, {})
         time_limit_seconds = config.get("time_limit_seconds", 0)
-        fine_rates = config.get("fine_rates", {})
+        fine_schedule = config.get("fine_schedule", ((), ()))
 
         is_overtime = elapsed > time_limit_seconds
         overtime_seconds = max(0, elapsed - time_limit_seconds)
         overtime_minutes = overtime_seconds / 60
 
         fine_amount = 0
-        if is_overtime and overtime_seconds > 0 and fine_rates:
-            segments = []
-            for k in fine_rates.keys():
-                try:
-                    v = int(str(k).lower().replace("min", ""))
-                    segments.append(v)
-                except:
-                    pass
-            segments.sort()
-            for s in segments:
-                if overtime_minutes <= s:
-                    fine_amount = fine_rates.get(str(s), fine_rates.get(f"{s}min", 0))
-                    break
-            if fine_amount == 0 and segments:
-                m = segments[-1]
-                fine_amount = fine_rates.get(str(m), fine_rates.get(f"{m}min", 0))
+        if is_overtime and overtime_seconds > 0:
+            fine_amount = db.lookup_fine(fine_schedule, overtime_minutes)
 
         result["fine"] = fine_amount
         result["is_overtime"] = is_overtime
@@ -1205,13 +1184,20 @@ async def _execute_work_end_operations_fixed(
                 row["shift"],
             )
 
-        # 4. 如果有罚款，更新月度统计
+        # 4. 如果有罚款，月度罚款与用户总罚款在同一语句内写入
         if fine_amount > 0:
             # 计算统计月份
             statistic_date = stats_record_date.replace(day=1)
 
             await conn.execute(
                 """
+                WITH u AS (
+                    UPDATE users
+                    SET total_fines = total_fines + $5,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE chat_id = $1 AND user_id = $2
+                    RETURNING 1
+                )
                 INSERT INTO monthly_statistics 
                 (chat_id, user_id, statistic_date, shift, work_end_fines, updated_at)
                 VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
@@ -1227,25 +1213,10 @@ async def _execute_work_end_operations_fixed(
                 fine_amount,
             )
 
-        # 5. 更新用户总罚款
-        if fine_amount > 0:
-            await conn.execute(
-                """
-                UPDATE users
-                SET total_fines = total_fines + $1,
-                    updated_at = CURRENT_TIMESTAMP
-                WHERE chat_id = $2 AND user_id = $3
-                """,
-                fine_amount,
-                chat_id,
-                row["user_id"],
-            )
-
-        # 6. 清理缓存
-        cache_key = f"user:{chat_id}:{row['user_id']}"
+        # 5. 清理缓存
+        cache_key = ("user", chat_id, row["user_id"])
         if hasattr(db, "_cache"):
-            db._cache.pop(cache_key, None)
-            db._cache_ttl.pop(cache_key, None)
+            db._pop_cached(cache_key)
 
         logger.debug(
             f"📊 [统计更新] 用户{row['user_id']} {row['shift']}班次 "
@@ -1600,7 +1571,7 @@ async def _cleanup_old_data(
                     chat_id,
                     target_date,
                 )
-                stats["user_activities"] = _parse_delete_count(result)
+                stats["user_activities"] = _tag_rowcount(result)
 
                 result = await conn.execute(
                     """
@@ -1610,7 +1581,7 @@ async def _cleanup_old_data(
                     chat_id,
                     target_date,
                 )
-                stats["work_records"] = _parse_delete_count(result)
+                stats["work_records"] = _tag_rowcount(result)
 
                 result = await conn.execute(
                     """
@@ -1620,7 +1591,7 @@ async def _cleanup_old_data(
                     chat_id,
                     target_date,
                 )
-                stats["daily_statistics"] = _parse_delete_count(result)
+                stats["daily_statistics"] = _tag_rowcount(result)
 
                 result = await conn.execute(
                     """
@@ -1636,7 +1607,7 @@ async def _cleanup_old_data(
                     business_today,
                     target_date,
                 )
-                stats["users_reset"] = _parse_update_count(result)
+                stats["users_reset"] = _tag_rowcount(result, "UPDATE")
 
         total_deleted = (
             stats["user_activities"] + stats["work_records"] + stats["daily_statistics"]
@@ -1699,33 +1670,6 @@ async def _send_reset_notification(
         logger.warning(f"   ⚠️ 发送重置通知失败: {e}")
 
 
-# ========== 8. 辅助函数 ==========
-def _parse_delete_count(result: str) -> int:
-    """解析 DELETE 语句返回的行数"""
-    if not result or not isinstance(result, str):
-        return 0
-    try:
-        parts = result.split()
-        if len(parts) >= 2 and parts[0] == "DELETE":
-            return int(parts[-1])
-    except (ValueError, IndexError):
-        pass
-    return 0
-
-
-def _parse_update_count(result: str) -> int:
-    """解析 UPDATE 语句返回的行数"""
-    if not result or not isinstance(result, str):
-        return 0
-    try:
-        parts = result.split()
-        if len(parts) >= 2 and parts[0] == "UPDATE":
-            return int(parts[-1])
-    except (ValueError, IndexError):
-        pass
-    return 0
-
-
 # ========== 9. 恢复班次状态 ==========
 async def recover_shift_states():
     """系统启动时恢复所有用户的班次状态"""
@@ -1745,41 +1689,43 @@ async def recover_shift_states():
                     return 0
 
                 async with db.pool.acquire() as conn:
-                    rows = await conn.fetch(
-                        """
-                        SELECT 
-                            wr.user_id, 
-                            wr.shift, 
-                            wr.record_date,
-                            MIN(wr.created_at) as earliest_time
-                        FROM work_records wr
-                        WHERE wr.chat_id = $1
-                          AND wr.checkin_type = 'work_start'
-                          AND NOT EXISTS (
-                              SELECT 1 FROM work_records wr2
-                              WHERE wr2.chat_id = wr.chat_id
-                                AND wr2.user_id = wr.user_id
-                                AND wr2.record_date = wr.record_date
-                                AND wr2.shift = wr.shift
-                                AND wr2.checkin_type = 'work_end'
-                          )
-                        GROUP BY wr.user_id, wr.shift, wr.record_date
-                        """,
-                        chat_id,
-                    )
-
-                    for row in rows:
-                        await db.set_user_shift_state(
-                            chat_id=chat_id,
-                            user_id=row["user_id"],
-                            shift=row["shift"],
-                            record_date=row["record_date"],
-                        )
-                        recovered_count += 1
-                        logger.info(
-                            f"✅ 恢复用户班次状态: 群组={chat_id}, "
-                            f"用户={row['user_id']}, 班次={row['shift']}"
-                        )
+                    # 未配对的上班记录没有日期上界、随历史累积，用游标分批拉取，
+                    # 边取边恢复，不把全部结果一次性物化在内存里（游标须在事务内使用）
+                    async with conn.transaction():
+                        async for row in conn.cursor(
+                            """
+                            SELECT 
+                                wr.user_id, 
+                                wr.shift, 
+                                wr.record_date,
+                                MIN(wr.created_at) as earliest_time
+                            FROM work_records wr
+                            WHERE wr.chat_id = $1
+                              AND wr.checkin_type = 'work_start'
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM work_records wr2
+                                  WHERE wr2.chat_id = wr.chat_id
+                                    AND wr2.user_id = wr.user_id
+                                    AND wr2.record_date = wr.record_date
+                                    AND wr2.shift = wr.shift
+                                    AND wr2.checkin_type = 'work_end'
+                              )
+                            GROUP BY wr.user_id, wr.shift, wr.record_date
+                            """,
+                            chat_id,
+                            prefetch=500,
+                        ):
+                            await db.set_user_shift_state(
+                                chat_id=chat_id,
+                                user_id=row["user_id"],
+                                shift=row["shift"],
+                                record_date=row["record_date"],
+                            )
+                            recovered_count += 1
+                            logger.info(
+                                f"✅ 恢复用户班次状态: 群组={chat_id}, "
+                                f"用户={row['user_id']}, 班次={row['shift']}"
+                            )
 
             except Exception as e:
                 logger.error(f"❌ 恢复群组 {chat_id} 班次状态失败: {e}")
@@ -3,11 +3,9 @@ import logging
 import sys
 import os
 import time
-import aiofiles
 import csv
 import json
 import re
-import gc
 import aiohttp
 import traceback
 from functools import wraps
@@ -31,7 +29,7 @@ logging.getLogger("aiohttp").setLevel(logging.WARNING)
 logging.getLogger("asyncio").setLevel(logging.WARNING)
 
 from config import Config, beijing_tz
-from database import db
+from database import db, _tag_rowcount
 from performance import (
     performance_monitor,
     task_manager,
@@ -76,7 +74,7 @@ from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
-    FSInputFile,
+    BufferedInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     Message,
@@ -104,7 +102,7 @@ dp = None
 
 start_time = time.time()
 
-active_back_processing: Dict[str, bool] = {}
+active_back_processing: Dict[tuple, float] = {}
 
 
 # ========== 日志中间件 ==========
@@ -328,9 +326,12 @@ async def generate_monthly_report(chat_id: int, year: int = None, month: int = N
         year = today.year
         month = today.month
 
-    monthly_stats = await db.get_monthly_statistics(chat_id, year, month)
-    work_stats = await db.get_monthly_work_statistics(chat_id, year, month)
-    activity_ranking = await db.get_monthly_activity_ranking(chat_id, year, month)
+    # 三项月度数据互不依赖，各自从连接池取连接并发查询
+    monthly_stats, work_stats, activity_ranking = await asyncio.gather(
+        db.get_monthly_statistics(chat_id, year, month),
+        db.get_monthly_work_statistics(chat_id, year, month),
+        db.get_monthly_activity_ranking(chat_id, year, month),
+    )
 
     if not monthly_stats and not work_stats:
         return None
@@ -541,7 +542,7 @@ async def recover_expired_activities():
 
         for chat_id in all_groups:
             try:
-                group_members = await db.get_group_members(chat_id)
+                group_members = await db.get_group_members(chat_id, active_only=True)
                 for user_data in group_members:
                     if user_data.get("current_activity") and user_data.get(
                         "activity_start_time"
@@ -820,42 +821,31 @@ async def can_perform_activities(
 
 
 # ========== 键盘生成 ==========
-async def get_main_keyboard(
-    chat_id: int = None, show_admin: bool = False
-) -> ReplyKeyboardMarkup:
-    """获取主回复键盘"""
-    logger.debug(f"🔄 生成键盘 - chat_id={chat_id}, show_admin={show_admin}")
+# 主键盘只由 (活动名序列, 是否启用上下班, 是否显示管理员) 决定，按该组合缓存成品；
+# 活动增删后名称序列改变即自然换键，无需额外失效逻辑
+_MAIN_KEYBOARD_CACHE_MAX = 64
+_main_keyboard_cache: Dict[tuple, ReplyKeyboardMarkup] = {}
 
-    try:
-        activity_limits = await db.get_activity_limits_cached()
-    except Exception as e:
-        logger.error(f"获取活动配置失败: {e}")
-        activity_limits = await db.get_activity_limits_cached()
 
+def _build_main_keyboard(
+    activities: tuple, has_work: bool, show_admin: bool
+) -> ReplyKeyboardMarkup:
+    """按活动列表与开关构建主回复键盘"""
     dynamic_buttons = []
     current_row = []
 
-    for act in activity_limits.keys():
+    for act in activities:
         current_row.append(KeyboardButton(text=act))
         if len(current_row) >= 3:
             dynamic_buttons.append(current_row)
             current_row = []
 
-    # 添加详细日志
-    if chat_id:
-        work_hours = await db.get_group_work_time(chat_id)
-        has_work = await db.has_work_hours_enabled(chat_id)
-        logger.debug(f"📊 群组 {chat_id} 工作时间: {work_hours}, 是否启用: {has_work}")
-
-        if has_work:
-            logger.info(f"✅ 将添加上班/下班按钮到键盘")
-            current_row.append(KeyboardButton(text="🟢 上班"))
-            current_row.append(KeyboardButton(text="🔴 下班"))
-            if len(current_row) >= 3:
-                dynamic_buttons.append(current_row)
-                current_row = []
-        else:
-            logger.debug(f"❌ 不添加上班/下班按钮")
+    if has_work:
+        current_row.append(KeyboardButton(text="🟢 上班"))
+        current_row.append(KeyboardButton(text="🔴 下班"))
+        if len(current_row) >= 3:
+            dynamic_buttons.append(current_row)
+            current_row = []
 
     if current_row:
         dynamic_buttons.append(current_row)
@@ -887,20 +877,46 @@ async def get_main_keyboard(
     )
 
 
+async def get_main_keyboard(
+    chat_id: int = None, show_admin: bool = False
+) -> ReplyKeyboardMarkup:
+    """获取主回复键盘"""
+    try:
+        activity_limits = await db.get_activity_limits_cached()
+    except Exception as e:
+        logger.error(f"获取活动配置失败: {e}")
+        activity_limits = await db.get_activity_limits_cached()
+
+    has_work = bool(chat_id) and await db.has_work_hours_enabled(chat_id)
+
+    key = (tuple(activity_limits), has_work, bool(show_admin))
+    keyboard = _main_keyboard_cache.get(key)
+    if keyboard is None:
+        logger.debug(
+            f"🔄 生成键盘 - chat_id={chat_id}, show_admin={show_admin}, 上下班按钮={has_work}"
+        )
+        if len(_main_keyboard_cache) >= _MAIN_KEYBOARD_CACHE_MAX:
+            _main_keyboard_cache.clear()
+        keyboard = _main_keyboard_cache[key] = _build_main_keyboard(*key)
+    return keyboard
+
+
+# 管理员键盘完全静态，导入时构建一次
+_ADMIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="👑 管理员面板"),
+            KeyboardButton(text="📤 导出数据"),
+        ],
+        [KeyboardButton(text="🔙 返回主菜单")],
+    ],
+    resize_keyboard=True,
+)
+
+
 def get_admin_keyboard() -> ReplyKeyboardMarkup:
     """管理员专用键盘"""
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="👑 管理员面板"),
-                KeyboardButton(text="📤 导出数据"),
-            ],
-            [KeyboardButton(text="🔙 返回主菜单")],
-        ],
-        resize_keyboard=True,
-    )
-    logger.debug("生成管理员键盘")
-    return keyboard
+    return _ADMIN_KEYBOARD
 
 
 # ========== 活动定时提醒 ==========
@@ -943,7 +959,8 @@ async def activity_timer(
         _cache_lock = asyncio.Lock()
 
         async def send_group_message(text: str, kb=None):
-            msg_key = f"{chat_id}:{uid}:{text}"
+            # 去重表只属于本定时器（chat_id/uid 固定），直接以消息文本为键
+            msg_key = text
             now = time.time()
 
             async with _cache_lock:
@@ -1465,7 +1482,7 @@ async def _process_back_locked(
 ):
     """线程安全的回座逻辑"""
     start_time = time.time()
-    key = f"{chat_id}:{uid}"
+    key = (chat_id, uid)
 
     if key in active_back_processing:
         lock_time = active_back_processing.get(key)
@@ -2749,106 +2766,39 @@ async def _check_shift_work_record(
             chat_id=chat_id, current_dt=now, shift=shift, checkin_type=checkin_type
         )
 
-        async with db.pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT 1 FROM work_records 
-                WHERE chat_id = $1 
-                  AND user_id = $2 
-                  AND checkin_type = $3 
-                  AND shift = $4
-                  AND record_date = $5
-                LIMIT 1
-                """,
-                chat_id,
-                user_id,
-                checkin_type,
-                shift,
-                actual_business_date,
-            )
-
-            if row:
-                logger.debug(
-                    f"✅ [{trace_id}] 找到打卡记录(业务日期): "
-                    f"type={checkin_type}, shift={shift}, date={actual_business_date}"
-                )
-                return True
+        # 候选业务日期一次查询：实际业务日期、传入日期，夜班再加上各自的前一天
+        candidate_dates = [actual_business_date, business_date]
+        if shift == "night":
+            candidate_dates += [
+                business_date - timedelta(days=1),
+                actual_business_date - timedelta(days=1),
+            ]
 
-            row = await conn.fetchrow(
+        async with db.pool.acquire() as conn:
+            matched_date = await conn.fetchval(
                 """
-                SELECT 1 FROM work_records 
+                SELECT record_date FROM work_records 
                 WHERE chat_id = $1 
                   AND user_id = $2 
                   AND checkin_type = $3 
                   AND shift = $4
-                  AND record_date = $5
+                  AND record_date = ANY($5::date[])
                 LIMIT 1
                 """,
                 chat_id,
                 user_id,
                 checkin_type,
                 shift,
-                business_date,
+                list(dict.fromkeys(candidate_dates)),
             )
 
-            if row:
+            if matched_date is not None:
                 logger.debug(
-                    f"✅ [{trace_id}] 找到打卡记录(传入日期): "
-                    f"type={checkin_type}, shift={shift}, date={business_date}"
+                    f"✅ [{trace_id}] 找到打卡记录: "
+                    f"type={checkin_type}, shift={shift}, date={matched_date}"
                 )
                 return True
 
-            if shift == "night":
-                previous_date = business_date - timedelta(days=1)
-                row = await conn.fetchrow(
-                    """
-                    SELECT 1 FROM work_records 
-                    WHERE chat_id = $1 
-                      AND user_id = $2 
-                      AND checkin_type = $3 
-                      AND shift = $4
-                      AND record_date = $5
-                    LIMIT 1
-                    """,
-                    chat_id,
-                    user_id,
-                    checkin_type,
-                    shift,
-                    previous_date,
-                )
-
-                if row:
-                    logger.debug(
-                        f"🌙 [{trace_id}] 找到夜班记录(前一天): "
-                        f"type={checkin_type}, date={previous_date}"
-                    )
-                    return True
-
-                actual_previous = actual_business_date - timedelta(days=1)
-                row = await conn.fetchrow(
-                    """
-                    SELECT 1 FROM work_records 
-                    WHERE chat_id = $1 
-                      AND user_id = $2 
-                      AND checkin_type = $3 
-                      AND shift = $4
-                      AND record_date = $5
-                    LIMIT 1
-                    """,
-                    chat_id,
-                    user_id,
-                    checkin_type,
-                    shift,
-                    actual_previous,
-                )
-
-                if row:
-                    logger.debug(
-                        f"🌙 [{trace_id}] 找到夜班记录(前一天实际日期): "
-                        f"type={checkin_type}, date={actual_previous}"
-                    )
-                    return True
-
             window_info = db.calculate_shift_window(
                 shift_config=shift_config, checkin_type=checkin_type, now=now
             )
@@ -2876,6 +2826,8 @@ async def _check_shift_work_record(
                 if target_end.tzinfo is None:
                     target_end = target_end.replace(tzinfo=now.tzinfo)
 
+                # 时区换算放在参数一侧（上海无夏令时，换算单调），
+                # created_at 保持裸列以走 idx_work_records_night 范围扫描
                 row = await conn.fetchrow(
                     """
                     SELECT 1 FROM work_records 
@@ -2883,8 +2835,8 @@ async def _check_shift_work_record(
                       AND user_id = $2 
                       AND checkin_type = $3 
                       AND shift = $4
-                      AND created_at AT TIME ZONE 'Asia/Shanghai' >= $5::timestamp
-                      AND created_at AT TIME ZONE 'Asia/Shanghai' <= $6::timestamp
+                      AND created_at >= $5::timestamp::timestamptz AT TIME ZONE 'Asia/Shanghai'
+                      AND created_at <= $6::timestamp::timestamptz AT TIME ZONE 'Asia/Shanghai'
                     LIMIT 1
                     """,
                     chat_id,
@@ -3645,7 +3597,7 @@ async def cmd_setdualmode(message: types.Message):
                         chat_id,
                         business_date,
                     )
-                    deleted_count = _parse_delete_count(delete_result)
+                    deleted_count = _tag_rowcount(delete_result)
 
                     active_count = (
                         await conn.fetchval(
@@ -3665,21 +3617,9 @@ async def cmd_setdualmode(message: types.Message):
 
             if deleted_count > 0:
                 business_date_str = str(business_date)
-                keys_to_remove = []
-
-                for key in list(db._cache.keys()):
-                    if not key.startswith(f"shift_state:{chat_id}:"):
-                        continue
-
-                    cache_key = key
-                    if cache_key in db._cache_ttl:
-                        keys_to_remove.append(cache_key)
-
-                for key in keys_to_remove:
-                    db._cache.pop(key, None)
-                    db._cache_ttl.pop(key, None)
+                removed_count = db._invalidate_chat_cache(chat_id, "shift_state")
 
-                logger.info(f"✅ 已清理 {len(keys_to_remove)} 个历史缓存")
+                logger.info(f"✅ 已清理 {removed_count} 个历史缓存")
 
             await message.answer(
                 f"✅ 双班模式已开启\n\n"
@@ -3709,7 +3649,7 @@ async def cmd_setdualmode(message: types.Message):
                         chat_id,
                         business_date,
                     )
-                    deleted_count = _parse_delete_count(delete_result)
+                    deleted_count = _tag_rowcount(delete_result)
 
                     active_count = (
                         await conn.fetchval(
@@ -3729,21 +3669,9 @@ async def cmd_setdualmode(message: types.Message):
 
             if deleted_count > 0:
                 business_date_str = str(business_date)
-                keys_to_remove = []
+                removed_count = db._invalidate_chat_cache(chat_id, "shift_state")
 
-                for key in list(db._cache.keys()):
-                    if not key.startswith(f"shift_state:{chat_id}:"):
-                        continue
-
-                    cache_key = key
-                    if cache_key in db._cache_ttl:
-                        keys_to_remove.append(cache_key)
-
-                for key in keys_to_remove:
-                    db._cache.pop(key, None)
-                    db._cache_ttl.pop(key, None)
-
-                logger.info(f"✅ 已清理 {len(keys_to_remove)} 个历史缓存")
+                logger.info(f"✅ 已清理 {removed_count} 个历史缓存")
 
             if active_count > 0:
                 await message.answer(
@@ -3780,19 +3708,6 @@ async def cmd_setdualmode(message: types.Message):
         )
 
 
-def _parse_delete_count(result: str) -> int:
-    """解析 DELETE 语句返回的行数"""
-    if not result or not isinstance(result, str):
-        return 0
-    try:
-        parts = result.split()
-        if len(parts) >= 2 and parts[0] == "DELETE":
-            return int(parts[-1])
-    except (ValueError, IndexError):
-        pass
-    return 0
-
-
 @admin_required
 @rate_limit(rate=3, per=30)
 async def cmd_setshiftgrace(message: types.Message):
@@ -3969,11 +3884,7 @@ async def cmd_cleanup_monthly(message: types.Message):
         try:
             async with db.pool.acquire() as conn:
                 result = await conn.execute("DELETE FROM monthly_statistics")
-                deleted_count = (
-                    int(result.split()[-1])
-                    if result and result.startswith("DELETE")
-                    else 0
-                )
+                deleted_count = _tag_rowcount(result)
 
             await message.answer(
                 f"🗑️ <b>已清理所有月度统计数据</b>\n"
@@ -4147,30 +4058,17 @@ async def cmd_cleanup_inactive(message: types.Message):
     cutoff_date = (get_beijing_time() - timedelta(days=days)).date()
 
     try:
+        # 分批删除，每批独立提交，避免大表一次性删除长时间占用锁和产生 WAL 峰值
         async with db.pool.acquire() as conn:
-            result_users = await conn.execute(
-                "DELETE FROM users WHERE last_updated < $1", cutoff_date
+            # users.last_updated 每日都会被改写，与 id 顺序无关，按日期列本身取批
+            deleted_users = await db._delete_before_in_batches(
+                conn, "users", "last_updated", cutoff_date, order_by="last_updated"
             )
-            deleted_users = (
-                int(result_users.split()[-1])
-                if result_users.startswith("DELETE")
-                else 0
+            deleted_activities = await db._delete_before_in_batches(
+                conn, "user_activities", "activity_date", cutoff_date
             )
-
-            result_activities = await conn.execute(
-                "DELETE FROM user_activities WHERE activity_date < $1", cutoff_date
-            )
-            deleted_activities = (
-                int(result_activities.split()[-1])
-                if result_activities.startswith("DELETE")
-                else 0
-            )
-
-            result_work = await conn.execute(
-                "DELETE FROM work_records WHERE record_date < $1", cutoff_date
-            )
-            deleted_work_records = (
-                int(result_work.split()[-1]) if result_work.startswith("DELETE") else 0
+            deleted_work_records = await db._delete_before_in_batches(
+                conn, "work_records", "record_date", cutoff_date
             )
 
         total_deleted = deleted_users + deleted_activities + deleted_work_records
@@ -4621,13 +4519,11 @@ async def cmd_setworktime(message: types.Message):
 
         # ===== 新增：强制刷新缓存 =====
         # 清除群组缓存，确保下次获取最新配置
-        cache_key = f"work_time:{chat_id}"
-        db._cache.pop(cache_key, None)
-        db._cache_ttl.pop(cache_key, None)
+        cache_key = ("work_time", chat_id)
+        db._pop_cached(cache_key)
 
         # 清除群组主缓存
-        db._cache.pop(f"group:{chat_id}", None)
-        db._cache_ttl.pop(f"group:{chat_id}", None)
+        db._pop_cached(("group", chat_id))
 
         logger.info(f"✅ 已清除工作时间缓存: {chat_id}")
         # ===== 新增结束 =====
@@ -4780,9 +4676,7 @@ async def cmd_delwork_clear(message: types.Message):
             result = await db.execute_with_retry(
                 "清除工作记录", "DELETE FROM work_records WHERE chat_id = $1", chat_id
             )
-            records_cleared = (
-                int(result.split()[-1]) if result and result.startswith("DELETE") else 0
-            )
+            records_cleared = _tag_rowcount(result)
         except Exception as e:
             logger.warning(f"清除工作记录时出现异常: {e}")
 
@@ -4809,7 +4703,7 @@ async def cmd_delwork_clear(message: types.Message):
             logger.warning(f"清理月度工作统计时出现异常: {e}")
 
         await db.force_refresh_activity_cache()
-        db._cache.pop(f"group:{chat_id}", None)
+        db._pop_cached(("group", chat_id))
 
         success_msg = (
             f"✅ <b>上下班功能已移除</b>\n\n"
@@ -5328,9 +5222,7 @@ async def cmd_setfines_all(message: types.Message):
             )
             return
 
-        for act in activity_limits.keys():
-            for time_segment, amount in segments.items():
-                await db.update_fine_config(act, str(time_segment), amount)
+        await db.update_fine_configs_bulk(list(activity_limits.keys()), segments)
 
         segments_text = " ".join(
             [f"<code>{t}</code>:<code>{f}</code>" for t, f in segments.items()]
@@ -6610,9 +6502,39 @@ async def show_history(message: types.Message, shift: str = None):
             logger.error(f"获取换班周期信息失败: {e}")
     # ===== 获取换班周期信息结束 =====
 
-    has_records = False
+    if shift == "night":
+        now = db.get_beijing_time()
+        # 如果是凌晨（0-12点），查询前一天；如果是下午/晚上，查询当天
+        if now.hour < 12:
+            query_date = business_date - timedelta(days=1)
+            logger.info(
+                f"🌙 [我的记录-夜班] 凌晨查询前一天: "
+                f"业务日期={business_date}, 查询日期={query_date}"
+            )
+        else:
+            query_date = business_date
+            logger.info(
+                f"🌙 [我的记录-夜班] 正常查询当天: "
+                f"业务日期={business_date}, 查询日期={query_date}"
+            )
+    elif current_time_decimal < day_start_decimal:
+        query_date = business_date - timedelta(days=1)
+        logger.info(
+            f"🌙 [我的记录-{'白班' if shift else '全部'}] 凌晨查询前一天: "
+            f"当前时间={current_hour:02d}:{current_minute:02d}, "
+            f"白班开始={day_start_str}, 查询日期={query_date}"
+        )
+    else:
+        query_date = business_date
+        logger.info(f"☀️ [我的记录-{'白班' if shift else '全部'}] 正常查询当天: {query_date}")
+
+    # 上下班记录与活动明细/罚款互不依赖，分别在两个连接上并发查询
+    work_records, my_record = await asyncio.gather(
+        db.get_work_records_by_shift(chat_id, uid, shift),
+        db.fetch_my_record(chat_id, uid, query_date, shift),
+    )
 
-    work_records = await db.get_work_records_by_shift(chat_id, uid, shift)
+    has_records = False
 
     if work_records:
         text += "🕒 <b>上下班记录</b>\n"
@@ -6651,87 +6573,15 @@ async def show_history(message: types.Message, shift: str = None):
 
     activity_limits = await db.get_activity_limits_cached()
 
-    async with db.pool.acquire() as conn:
-        if shift:
-            if shift == "night":
-                now = db.get_beijing_time()
-                # 如果是凌晨（0-12点），查询前一天；如果是下午/晚上，查询当天
-                if now.hour < 12:
-                    query_date = business_date - timedelta(days=1)
-                    logger.info(
-                        f"🌙 [我的记录-夜班] 凌晨查询前一天: "
-                        f"业务日期={business_date}, 查询日期={query_date}"
-                    )
-                else:
-                    query_date = business_date
-                    logger.info(
-                        f"🌙 [我的记录-夜班] 正常查询当天: "
-                        f"业务日期={business_date}, 查询日期={query_date}"
-                    )
-            else:
-                if current_time_decimal < day_start_decimal:
-                    query_date = business_date - timedelta(days=1)
-                    logger.info(
-                        f"🌙 [我的记录-白班] 凌晨查询前一天白班: "
-                        f"当前时间={current_hour:02d}:{current_minute:02d}, "
-                        f"白班开始={day_start_str}, 查询日期={query_date}"
-                    )
-                else:
-                    query_date = business_date
-                    logger.info(f"☀️ [我的记录-白班] 正常查询当天: {query_date}")
+    rows = my_record["activities"]
+    fine_total = my_record["fine_total"]
 
-            rows = await conn.fetch(
-                """
-                SELECT activity_name, activity_count, accumulated_time, shift
-                FROM user_activities
-                WHERE chat_id = $1 AND user_id = $2 
-                  AND activity_date = $3 AND shift = $4
-                """,
-                chat_id,
-                uid,
-                query_date,
-                shift,
-            )
-            if is_handover and cycle_number == 2 and shift and cycle_start_time:
-                logger.info(f"🔄 [周期2过滤] 用户 {uid} 只显示周期2开始后的活动")
-                # 简化处理：周期2刚开始时显示空
-                # 如果需要精确过滤，需要修改表结构或添加关联查询
-                rows = []
-                logger.info(f"🔄 [周期2] 用户 {uid} 周期2刚开始，显示空记录")
-        else:
-            if current_time_decimal < day_start_decimal:
-                query_date = business_date - timedelta(days=1)
-                logger.debug(
-                    f"🌙 [我的记录-全部] 凌晨查询前一天所有数据: "
-                    f"当前时间={current_hour:02d}:{current_minute:02d}, "
-                    f"白班开始={day_start_str}, 查询日期={query_date}"
-                )
-
-                rows = await conn.fetch(
-                    """
-                    SELECT activity_name, activity_count, accumulated_time, shift
-                    FROM user_activities
-                    WHERE chat_id = $1 AND user_id = $2 
-                      AND activity_date = $3
-                    """,
-                    chat_id,
-                    uid,
-                    query_date,
-                )
-            else:
-                logger.info(f"☀️ [我的记录-全部] 正常查询当天: {business_date}")
-
-                rows = await conn.fetch(
-                    """
-                    SELECT activity_name, activity_count, accumulated_time, shift
-                    FROM user_activities
-                    WHERE chat_id = $1 AND user_id = $2 
-                      AND activity_date = $3
-                    """,
-                    chat_id,
-                    uid,
-                    business_date,
-                )
+    if is_handover and cycle_number == 2 and shift and cycle_start_time:
+        logger.info(f"🔄 [周期2过滤] 用户 {uid} 只显示周期2开始后的活动")
+        # 简化处理：周期2刚开始时显示空
+        # 如果需要精确过滤，需要修改表结构或添加关联查询
+        rows = []
+        logger.info(f"🔄 [周期2] 用户 {uid} 周期2刚开始，显示空记录")
 
     activities_by_shift = {"day": {}, "night": {}}
 
@@ -6813,78 +6663,6 @@ async def show_history(message: types.Message, shift: str = None):
             f"• 总活动次数：<code>{total_count_all}</code> 次\n"
         )
 
-    async with db.pool.acquire() as conn:
-        if shift:
-            # 罚款统计使用与活动记录相同的日期逻辑
-            if shift == "night":
-                now = db.get_beijing_time()
-                # 罚款统计使用与活动记录相同的日期逻辑
-                if now.hour < 12:
-                    fine_query_date = business_date - timedelta(days=1)
-                    logger.info(
-                        f"🌙 [罚款统计-夜班] 凌晨查询前一天: "
-                        f"业务日期={business_date}, 罚款查询日期={fine_query_date}"
-                    )
-                else:
-                    fine_query_date = business_date
-                    logger.info(
-                        f"🌙 [罚款统计-夜班] 正常查询当天: "
-                        f"业务日期={business_date}, 罚款查询日期={fine_query_date}"
-                    )
-            else:  # day
-                if current_time_decimal < day_start_decimal:
-                    fine_query_date = business_date - timedelta(days=1)
-                    logger.info(
-                        f"🌙 [罚款统计-白班] 凌晨查询前一天: "
-                        f"当前时间={current_hour:02d}:{current_minute:02d}, "
-                        f"罚款查询日期={fine_query_date}"
-                    )
-                else:
-                    fine_query_date = business_date
-                    logger.info(f"☀️ [罚款统计-白班] 正常查询当天: {fine_query_date}")
-
-            fine_total = (
-                await conn.fetchval(
-                    """
-                    SELECT COALESCE(fine_amount, 0)
-                    FROM daily_statistics
-                    WHERE chat_id = $1 
-                      AND user_id = $2 
-                      AND record_date = $3 
-                      AND shift = $4
-                    """,
-                    chat_id,
-                    uid,
-                    fine_query_date,
-                    shift,
-                )
-                or 0
-            )
-        else:
-            # 全部班次罚款统计（保持不变）
-            if current_time_decimal < day_start_decimal:
-                fine_query_date = business_date - timedelta(days=1)
-                logger.info(f"🌙 [罚款统计-全部] 凌晨查询前一天: {fine_query_date}")
-            else:
-                fine_query_date = business_date
-                logger.info(f"☀️ [罚款统计-全部] 正常查询当天: {fine_query_date}")
-
-            fine_total = (
-                await conn.fetchval(
-                    """
-                    SELECT COALESCE(SUM(fine_amount), 0)
-                    FROM daily_statistics
-                    WHERE chat_id = $1 
-                      AND user_id = $2 
-                      AND record_date = $3
-                    """,
-                    chat_id,
-                    uid,
-                    fine_query_date,
-                )
-                or 0
-            )
-
     if fine_total > 0:
         if shift:
             shift_text = "白班" if shift == "day" else "夜班"
@@ -6986,164 +6764,76 @@ async def show_rank(message: types.Message, shift: str = None):
         except Exception as e:
             logger.error(f"获取换班周期信息失败: {e}")
 
-    for act in activity_limits.keys():
-        try:
-            if shift:
-                if shift == "night":
-                    now = db.get_beijing_time()
-                    # 如果是凌晨（0-12点），查询前一天；如果是下午/晚上，查询当天
-                    if now.hour < 12:
-                        query_date = business_date - timedelta(days=1)
-                        logger.info(
-                            f"🌙 [排行榜-夜班] 凌晨查询前一天: "
-                            f"业务日期={business_date}, 查询日期={query_date}"
-                        )
-                    else:
-                        query_date = business_date
-                        logger.info(
-                            f"🌙 [排行榜-夜班] 正常查询当天: "
-                            f"业务日期={business_date}, 查询日期={query_date}"
-                        )
-                else:
-                    if current_time_decimal < day_start_decimal:
-                        query_date = business_date - timedelta(days=1)
-                        logger.info(
-                            f"🌙 [排行榜-白班] 凌晨查询前一天白班: "
-                            f"当前时间={current_hour:02d}:{current_minute:02d}, "
-                            f"白班开始={day_start_str}, 查询日期={query_date}"
-                        )
-                    else:
-                        query_date = business_date
-                        logger.info(f"☀️ [排行榜-白班] 正常查询当天: {query_date}")
-
-                query = """
-                    SELECT 
-                        ua.user_id,
-                        u.nickname,
-                        SUM(ua.accumulated_time) AS total_time,
-                        SUM(ua.activity_count) AS total_count,
-                        CASE 
-                            WHEN u.current_activity = $1 THEN TRUE 
-                            ELSE FALSE 
-                        END AS is_active
-                    FROM user_activities ua
-                    LEFT JOIN users u 
-                        ON ua.chat_id = u.chat_id 
-                        AND ua.user_id = u.user_id
-                    WHERE ua.chat_id = $2
-                      AND ua.activity_date = $3
-                      AND ua.activity_name = $4
-                      AND ua.shift = $5
-                    GROUP BY ua.user_id, u.nickname, u.current_activity
-                    HAVING SUM(ua.accumulated_time) > 0 
-                        OR u.current_activity = $1
-                    ORDER BY 
-                        is_active DESC,
-                        total_time DESC
-                    LIMIT 10
-                """
-                params = [act, chat_id, query_date, act, shift]
-            else:
-                if current_time_decimal < day_start_decimal:
-                    query_date = business_date - timedelta(days=1)
-                    logger.debug(
-                        f"🌙 [排行榜-全部] 凌晨查询前一天所有数据: "
-                        f"当前时间={current_hour:02d}:{current_minute:02d}, "
-                        f"白班开始={day_start_str}, 查询日期={query_date}"
-                    )
-
-                    query = """
-                        SELECT 
-                            ua.user_id,
-                            u.nickname,
-                            SUM(ua.accumulated_time) AS total_time,
-                            SUM(ua.activity_count) AS total_count,
-                            CASE 
-                                WHEN u.current_activity = $1 
-                                THEN TRUE 
-                                ELSE FALSE 
-                            END AS is_active
-                        FROM user_activities ua
-                        LEFT JOIN users u 
-                            ON ua.chat_id = u.chat_id 
-                            AND ua.user_id = u.user_id
-                        WHERE ua.chat_id = $2
-                          AND ua.activity_date = $3
-                          AND ua.activity_name = $4
-                        GROUP BY ua.user_id, u.nickname, u.current_activity
-                        HAVING SUM(ua.accumulated_time) > 0 OR u.current_activity = $1
-                        ORDER BY total_time DESC
-                        LIMIT 10
-                    """
-                    params = [act, chat_id, query_date, act]
-                else:
-                    logger.debug(f"☀️ [排行榜-全部] 正常查询当天: {business_date}")
-
-                    query = """
-                            SELECT 
-                                ua.user_id,
-                                u.nickname,
-                                SUM(ua.accumulated_time) AS total_time,
-                                SUM(ua.activity_count) AS total_count,
-                                CASE 
-                                    WHEN u.current_activity = $1 
-                                    THEN TRUE 
-                                    ELSE FALSE 
-                                END AS is_active
-                            FROM user_activities ua
-                            LEFT JOIN users u 
-                                ON ua.chat_id = u.chat_id 
-                                AND ua.user_id = u.user_id
-                            WHERE ua.chat_id = $2
-                              AND ua.activity_date = $3
-                              AND ua.activity_name = $4
-                            GROUP BY ua.user_id, u.nickname, u.current_activity
-                            HAVING SUM(ua.accumulated_time) > 0 OR u.current_activity = $1
-                            ORDER BY total_time DESC
-                            LIMIT 10
-                    """
-                    params = [act, chat_id, business_date, act]
-
-            rows = await db.execute_with_retry(
-                "获取活动排行榜", query, *params, fetch=True
+    if shift == "night":
+        now = db.get_beijing_time()
+        # 如果是凌晨（0-12点），查询前一天；如果是下午/晚上，查询当天
+        if now.hour < 12:
+            query_date = business_date - timedelta(days=1)
+            logger.info(
+                f"🌙 [排行榜-夜班] 凌晨查询前一天: "
+                f"业务日期={business_date}, 查询日期={query_date}"
+            )
+        else:
+            query_date = business_date
+            logger.info(
+                f"🌙 [排行榜-夜班] 正常查询当天: "
+                f"业务日期={business_date}, 查询日期={query_date}"
             )
-            if is_handover and cycle_number == 2 and shift and cycle_start_time:
-                logger.info(f"🏆 [周期2过滤] 只显示周期2开始后的活动")
-                # 简化处理：周期2刚开始时排行榜为空
-                rows = []
-                logger.info(f"🏆 [周期2] 排行榜显示空")
+    elif current_time_decimal < day_start_decimal:
+        query_date = business_date - timedelta(days=1)
+        logger.info(
+            f"🌙 [排行榜-{'白班' if shift else '全部'}] 凌晨查询前一天: "
+            f"当前时间={current_hour:02d}:{current_minute:02d}, "
+            f"白班开始={day_start_str}, 查询日期={query_date}"
+        )
+    else:
+        query_date = business_date
+        logger.info(f"☀️ [排行榜-{'白班' if shift else '全部'}] 正常查询当天: {query_date}")
 
-            if not rows:
-                continue
+    # 所有活动的排行一次查询取回
+    try:
+        rankings = await db.get_activity_rankings(
+            chat_id, query_date, list(activity_limits.keys()), shift
+        )
+    except Exception as e:
+        logger.error(f"查询活动排行榜失败: {e}")
+        rankings = {}
 
-            found_any_data = True
-            rank_text += f"📈 <code>{act}</code>：\n"
+    if is_handover and cycle_number == 2 and shift and cycle_start_time:
+        logger.info(f"🏆 [周期2过滤] 只显示周期2开始后的活动")
+        # 简化处理：周期2刚开始时排行榜为空
+        rankings = {}
+        logger.info(f"🏆 [周期2] 排行榜显示空")
 
-            for i, row in enumerate(rows, 1):
-                user_id = row["user_id"]
-                nickname = row["nickname"] or f"用户{user_id}"
-                total_time = row["total_time"] or 0
-                total_count = row["total_count"] or 0
-                is_active = row["is_active"]
+    for act in activity_limits.keys():
+        rows = rankings.get(act)
+        if not rows:
+            continue
 
-                if is_active:
-                    rank_text += (
-                        f"  <code>{i}.</code> 🟡 "
-                        f"{MessageFormatter.format_user_link(user_id, nickname)} - 进行中\n"
-                    )
-                elif total_time > 0:
-                    time_str = MessageFormatter.format_time(int(total_time))
-                    rank_text += (
-                        f"  <code>{i}.</code> 🟢 "
-                        f"{MessageFormatter.format_user_link(user_id, nickname)} "
-                        f"- {time_str} ({total_count}次)\n"
-                    )
+        found_any_data = True
+        rank_text += f"📈 <code>{act}</code>：\n"
 
-            rank_text += "\n"
+        for i, row in enumerate(rows, 1):
+            user_id = row["user_id"]
+            nickname = row["nickname"] or f"用户{user_id}"
+            total_time = row["total_time"] or 0
+            total_count = row["total_count"] or 0
+            is_active = row["is_active"]
 
-        except Exception as e:
-            logger.error(f"查询活动 {act} 排行榜失败: {e}")
-            continue
+            if is_active:
+                rank_text += (
+                    f"  <code>{i}.</code> 🟡 "
+                    f"{MessageFormatter.format_user_link(user_id, nickname)} - 进行中\n"
+                )
+            elif total_time > 0:
+                time_str = MessageFormatter.format_time(int(total_time))
+                rank_text += (
+                    f"  <code>{i}.</code> 🟢 "
+                    f"{MessageFormatter.format_user_link(user_id, nickname)} "
+                    f"- {time_str} ({total_count}次)\n"
+                )
+
+        rank_text += "\n"
 
     if not found_any_data:
         if shift:
@@ -7455,7 +7145,6 @@ async def export_and_push_csv(
         operation_id = f"export_{local_chat_id}_{int(start_time)}"
         logger.info(f"🚀 [{operation_id}] 开始导出群组 {local_chat_id} 的数据...")
 
-        temp_file = None
         group_stats = []
         activity_limits = Config.DEFAULT_ACTIVITY_LIMITS.copy()
 
@@ -7479,13 +7168,6 @@ async def export_and_push_csv(
                 except (ValueError, TypeError):
                     return default
 
-            def safe_format_time(seconds):
-                """安全格式化时间"""
-                try:
-                    return MessageFormatter.format_time_for_csv(safe_int(seconds))
-                except Exception:
-                    return "0分0秒"
-
             def format_shift_for_export(shift: str) -> str:
                 """格式化班次为中文"""
                 if not shift:
@@ -7506,7 +7188,8 @@ async def export_and_push_csv(
                     if num_value <= 0:
                         return "-"
                     if is_time:
-                        return safe_format_time(num_value)
+                        # num_value 已是正整数，直接走按值缓存的格式化，不再二次转换
+                        return MessageFormatter.format_time_for_csv(num_value)
                     return str(num_value)
                 except (ValueError, TypeError):
                     if not value or str(value).strip() == "":
@@ -7929,49 +7612,16 @@ async def export_and_push_csv(
                 group_stats=group_stats, all_activities=all_activities, headers=headers
             )
 
-            # ===== 写入临时文件（异步写入 + fallback）=====
-            temp_file = f"temp_{operation_id}_{current_file_name}"
-
-            async def write_file_async():
-                """异步写入文件，失败时降级为同步写入"""
-                try:
-                    async with aiofiles.open(temp_file, "wb") as f:
-                        await f.write(excel_buffer.getvalue())
-                    return True
-                except Exception as e:
-                    logger.error(f"❌ [{operation_id}] 异步写入文件失败: {e}")
-                    try:
-                        with open(temp_file, "wb") as f:
-                            f.write(excel_buffer.getvalue())
-                        return True
-                    except Exception as sync_e:
-                        logger.error(
-                            f"❌ [{operation_id}] 同步写入文件也失败: {sync_e}"
-                        )
-                        return False
-
-            async def get_chat_title_async():
-                """异步获取群组标题"""
-                try:
-                    chat_info = await bot_manager.bot.get_chat(local_chat_id)
-                    return chat_info.title or f"群组 {local_chat_id}"
-                except Exception as e:
-                    logger.warning(f"⚠️ [{operation_id}] 获取群组标题失败: {e}")
-                    return f"群组 {local_chat_id}"
-
-            # 并发执行：写入文件 + 获取群组标题
-            write_result, chat_title = await asyncio.gather(
-                write_file_async(), get_chat_title_async()
-            )
+            # ===== 获取群组标题 =====
+            try:
+                chat_info = await bot_manager.bot.get_chat(local_chat_id)
+                chat_title = chat_info.title or f"群组 {local_chat_id}"
+            except Exception as e:
+                logger.warning(f"⚠️ [{operation_id}] 获取群组标题失败: {e}")
+                chat_title = f"群组 {local_chat_id}"
 
             watchdog.feed()
 
-            if not write_result:
-                await bot_manager.send_message_with_retry(
-                    local_chat_id, f"❌ 导出失败: 文件写入失败"
-                )
-                return False
-
             # ===== 发送文件 =====
             display_date = working_target_date.strftime("%Y年%m月%d日")
             dashed_line = getattr(
@@ -7990,7 +7640,10 @@ async def export_and_push_csv(
                 f"🎨 完全无活动记录的行已标注淡红色背景"
             )
 
-            input_file = FSInputFile(temp_file, filename=current_file_name)
+            # 工作簿已在内存中，直接按字节上传，不再落盘写临时文件、事后再删除
+            input_file = BufferedInputFile(
+                excel_buffer.getvalue(), filename=current_file_name
+            )
             send_to_group_success = False
 
             if local_push_file:
@@ -8026,14 +7679,6 @@ async def export_and_push_csv(
                 except Exception as e:
                     logger.warning(f"⚠️ [{operation_id}] 推送到通知服务失败: {e}")
 
-            # 清理临时文件
-            async def cleanup_background():
-                await asyncio.sleep(2)
-                if temp_file and os.path.exists(temp_file):
-                    os.remove(temp_file)
-
-            asyncio.create_task(cleanup_background())
-
             duration = time.time() - start_time
             logger.info(
                 f"✅ [{operation_id}] 数据导出完成\n"
@@ -8055,12 +7700,6 @@ async def export_and_push_csv(
             except:
                 pass
 
-            if temp_file and os.path.exists(temp_file):
-                try:
-                    os.remove(temp_file)
-                except:
-                    pass
-
             return False
 
     try:
@@ -8103,24 +7742,7 @@ async def daily_reset_task():
         logger.error("❌ 数据库初始化超时，重置任务退出")
         return
 
-    # 创建重置日志表（如果不存在）
-    try:
-        async with db.pool.acquire() as conn:
-            await conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS reset_logs (
-                    id SERIAL PRIMARY KEY,
-                    chat_id BIGINT NOT NULL,
-                    mode VARCHAR(10) NOT NULL,
-                    reset_date DATE NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
-                    UNIQUE(chat_id, mode, reset_date)
-                )
-            """
-            )
-            logger.info("✅ 重置日志表已确认")
-    except Exception as e:
-        logger.error(f"创建重置日志表失败: {e}")
+    # reset_logs 表由 db 初始化（_create_tables）统一创建，这里不再重复执行 DDL
 
     sem = asyncio.Semaphore(10)
     TASK_TIMEOUT = 300
@@ -8132,14 +7754,11 @@ async def daily_reset_task():
         async with sem:
             try:
                 async with asyncio.timeout(TASK_TIMEOUT):
-                    group_data = await db.get_group_cached(chat_id)
-                    if not group_data:
+                    reset_cfg = await db.get_reset_config(chat_id)
+                    if not reset_cfg:
                         return
 
-                    reset_hour = group_data.get("reset_hour", Config.DAILY_RESET_HOUR)
-                    reset_minute = group_data.get(
-                        "reset_minute", Config.DAILY_RESET_MINUTE
-                    )
+                    reset_hour, reset_minute = reset_cfg
 
                     await process_dual_mode_reset(
                         chat_id, now, reset_hour, reset_minute
@@ -8859,15 +8478,8 @@ async def keepalive_loop():
                             f"⚠️ 检测到长时间锁 ({len(long_locks)}) : {long_locks[:5]}"
                         )
 
-                # =========================
-                # 5 垃圾回收
-                # =========================
-                try:
-                    collected = gc.collect()
-                    if collected > 0:
-                        logger.debug(f"🧹 GC回收对象: {collected}")
-                except Exception:
-                    pass
+                # 不在保活循环里强制全量 GC：gc.collect() 要遍历整个堆，
+                # 周期回收已由 memory_cleanup_task → performance_optimizer.memory_cleanup 负责
 
             except asyncio.CancelledError:
                 logger.info("🛑 保活循环已取消")
@@ -5,12 +5,13 @@ import logging
 import gc
 import psutil
 
+from collections import OrderedDict
 from datetime import datetime, timedelta, date
 from typing import Dict, Any, List, Optional, Tuple
 from config import Config, beijing_tz
-from functools import wraps
+from functools import lru_cache, wraps
 from aiogram import types
-from database import db
+from database import db, _format_seconds_to_hms
 from performance import global_cache, task_manager
 from datetime import time as dt_time
 
@@ -18,6 +19,22 @@ from datetime import time as dt_time
 logger = logging.getLogger("GroupCheckInBot")
 
 
+@lru_cache(maxsize=4096)
+def _format_csv_seconds(seconds: int) -> str:
+    """CSV 时长格式化（导出时同一秒数大量重复，按值缓存）"""
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours > 0:
+        return f"{hours}时{minutes}分{secs}秒"
+    return f"{minutes}分{secs}秒"
+
+
+# 用户名中需剔除的 HTML 特殊字符，一次 translate 完成
+_HTML_STRIP_TABLE = str.maketrans("", "", '<>&"')
+_DASHED_LINE = "<code>--------------------------</code>"
+
+
 class MessageFormatter:
     """消息格式化工具类"""
 
@@ -26,50 +43,28 @@ class MessageFormatter:
         """格式化时间显示"""
         if seconds is None:
             return "0秒"
-
-        m, s = divmod(seconds, 60)
-        h, m = divmod(m, 60)
-
-        if h > 0:
-            return f"{h}小时{m}分{s}秒"
-        elif m > 0:
-            return f"{m}分{s}秒"
-        else:
-            return f"{s}秒"
+        # 统一转为 int：浮点秒数既会打散缓存，也会格式化出小数
+        return _format_seconds_to_hms(int(seconds))
 
     @staticmethod
     def format_time_for_csv(seconds: int) -> str:
         """为CSV导出格式化时间显示"""
-        if seconds is None:
+        if not seconds:
             return "0分0秒"
-
-        hours = seconds // 3600
-        minutes = (seconds % 3600) // 60
-        secs = seconds % 60
-
-        if hours > 0:
-            return f"{hours}时{minutes}分{secs}秒"
-        else:
-            return f"{minutes}分{secs}秒"
+        return _format_csv_seconds(int(seconds))
 
     @staticmethod
     def format_user_link(user_id: int, user_name: str) -> str:
         """格式化用户链接"""
         if not user_name:
             user_name = f"用户{user_id}"
-        clean_name = (
-            str(user_name)
-            .replace("<", "")
-            .replace(">", "")
-            .replace("&", "")
-            .replace('"', "")
-        )
+        clean_name = str(user_name).translate(_HTML_STRIP_TABLE)
         return f'<a href="tg://user?id={user_id}">{clean_name}</a>'
 
     @staticmethod
     def create_dashed_line() -> str:
         """创建短虚线分割线"""
-        return MessageFormatter.format_copyable_text("--------------------------")
+        return _DASHED_LINE
 
     @staticmethod
     def format_copyable_text(text: str) -> str:
@@ -88,35 +83,35 @@ class MessageFormatter:
         shift: str = None,
     ) -> str:
         """格式化打卡消息"""
+        # 高频消息：<code> 包装直接内联，片段收集后一次 join
+        user_link = MessageFormatter.format_user_link(user_id, user_name)
+        act = f"<code>{activity}</code>"
 
-        first_line = f"👤 用户：{MessageFormatter.format_user_link(user_id, user_name)}"
-        dashed_line = MessageFormatter.create_dashed_line()
-
-        message = (
-            f"{first_line}\n"
-            f"✅ 打卡成功：{MessageFormatter.format_copyable_text(activity)} - {MessageFormatter.format_copyable_text(time_str)}\n"
-        )
+        parts = [
+            f"👤 用户：{user_link}\n",
+            f"✅ 打卡成功：{act} - <code>{time_str}</code>\n",
+        ]
 
         if shift:
             shift_text = "白班" if shift == "day" else "夜班"
-            message += f"📊 班次：{MessageFormatter.format_copyable_text(shift_text)}\n"
+            parts.append(f"📊 班次：<code>{shift_text}</code>\n")
 
-        message += (
-            f"▫️ 本次活动类型：{MessageFormatter.format_copyable_text(activity)}\n"
-            f"⏰ 单次时长限制：{MessageFormatter.format_copyable_text(str(time_limit))}分钟 \n"
-            f"📈 今日{MessageFormatter.format_copyable_text(activity)}次数：第 {MessageFormatter.format_copyable_text(str(count))} 次（上限 {MessageFormatter.format_copyable_text(str(max_times))} 次）\n"
+        parts.append(f"▫️ 本次活动类型：{act}\n")
+        parts.append(f"⏰ 单次时长限制：<code>{time_limit}</code>分钟 \n")
+        parts.append(
+            f"📈 今日{act}次数：第 <code>{count}</code> 次（上限 <code>{max_times}</code> 次）\n"
         )
 
         if count >= max_times:
-            message += f"🚨 警告：本次结束后，您今日的{MessageFormatter.format_copyable_text(activity)}次数将达到上限，请留意！\n"
+            parts.append(f"🚨 警告：本次结束后，您今日的{act}次数将达到上限，请留意！\n")
 
-        message += (
-            f"{dashed_line}\n"
+        parts.append(
+            f"{_DASHED_LINE}\n"
             f"💡 操作提示\n"
             f"活动结束后请及时点击 👉【✅ 回座】👈按钮。"
         )
 
-        return message
+        return "".join(parts)
 
     @staticmethod
     def format_back_message(
@@ -134,49 +129,42 @@ class MessageFormatter:
         fine_amount: int = 0,
     ) -> str:
         """格式化回座消息"""
-        first_line = f"👤 用户：{MessageFormatter.format_user_link(user_id, user_name)}"
-        dashed_line = MessageFormatter.create_dashed_line()
-
+        user_link = MessageFormatter.format_user_link(user_id, user_name)
         today_count = activity_counts.get(activity, 0)
 
-        message = (
-            f"{first_line}\n"
-            f"✅ 回座打卡：{MessageFormatter.format_copyable_text(time_str)}\n"
-            f"{dashed_line}\n"
+        parts = [
+            f"👤 用户：{user_link}\n"
+            f"✅ 回座打卡：<code>{time_str}</code>\n"
+            f"{_DASHED_LINE}\n"
             f"📍 活动记录\n"
-            f"▫️ 活动类型：{MessageFormatter.format_copyable_text(activity)}\n"
-            f"▫️ 本次耗时：{MessageFormatter.format_copyable_text(elapsed_time)} ⏰\n"
-            f"▫️ 累计时长：{MessageFormatter.format_copyable_text(total_activity_time)}\n"
-            f"▫️ 今日次数：{MessageFormatter.format_copyable_text(str(today_count))}次\n"
-        )
+            f"▫️ 活动类型：<code>{activity}</code>\n"
+            f"▫️ 本次耗时：<code>{elapsed_time}</code> ⏰\n"
+            f"▫️ 累计时长：<code>{total_activity_time}</code>\n"
+            f"▫️ 今日次数：<code>{today_count}</code>次\n"
+        ]
 
         if is_overtime:
             overtime_time = MessageFormatter.format_time(int(overtime_seconds))
-            message += f"\n⚠️ 超时提醒\n"
-            message += f"▫️ 超时时长：{MessageFormatter.format_copyable_text(overtime_time)} 🚨\n"
+            parts.append(f"\n⚠️ 超时提醒\n")
+            parts.append(f"▫️ 超时时长：<code>{overtime_time}</code> 🚨\n")
             if fine_amount > 0:
-                message += f"▫️ 罚款金额：{MessageFormatter.format_copyable_text(str(fine_amount))} 泰铢 💸\n"
+                parts.append(f"▫️ 罚款金额：<code>{fine_amount}</code> 泰铢 💸\n")
 
-        message += f"{dashed_line}\n"
-        message += f"📊 今日总计\n"
-        message += f"▫️ 活动详情\n"
+        parts.append(f"{_DASHED_LINE}\n📊 今日总计\n▫️ 活动详情\n")
 
         for act, count in activity_counts.items():
             if count > 0:
-                message += f"   ➤ {MessageFormatter.format_copyable_text(act)}：{MessageFormatter.format_copyable_text(str(count))} 次 📝\n"
+                parts.append(f"   ➤ <code>{act}</code>：<code>{count}</code> 次 📝\n")
 
-        message += f"▫️ 总活动次数：{MessageFormatter.format_copyable_text(str(total_count))}次\n"
-        message += f"▫️ 总活动时长：{MessageFormatter.format_copyable_text(total_time)}"
+        parts.append(f"▫️ 总活动次数：<code>{total_count}</code>次\n")
+        parts.append(f"▫️ 总活动时长：<code>{total_time}</code>")
 
-        return message
+        return "".join(parts)
 
     @staticmethod
     def format_duration(seconds: int) -> str:
-        seconds = int(seconds)
-
-        h = seconds // 3600
-        m = (seconds % 3600) // 60
-        s = seconds % 60
+        m, s = divmod(int(seconds), 60)
+        h, m = divmod(m, 60)
 
         parts = []
 
@@ -197,43 +185,7 @@ class MessageFormatter:
 
 async def calculate_fine(activity: str, overtime_minutes: float) -> int:
     """计算罚款金额"""
-    fine_rates = await db.get_fine_rates_for_activity(activity)
-    if not fine_rates:
-        return 0
-
-    segments = []
-    for time_key in fine_rates.keys():
-        try:
-            if isinstance(time_key, str) and "min" in time_key.lower():
-                time_value = int(time_key.lower().replace("min", "").strip())
-            else:
-                time_value = int(time_key)
-            segments.append(time_value)
-        except (ValueError, TypeError):
-            continue
-
-    if not segments:
-        return 0
-
-    segments.sort()
-
-    applicable_fine = 0
-    for segment in segments:
-        if overtime_minutes <= segment:
-            original_key = str(segment)
-            if original_key not in fine_rates:
-                original_key = f"{segment}min"
-            applicable_fine = fine_rates.get(original_key, 0)
-            break
-
-    if applicable_fine == 0 and segments:
-        max_segment = segments[-1]
-        original_key = str(max_segment)
-        if original_key not in fine_rates:
-            original_key = f"{max_segment}min"
-        applicable_fine = fine_rates.get(original_key, 0)
-
-    return applicable_fine
+    return await db.calculate_fine_for_activity(activity, overtime_minutes)
 
 
 class NotificationService:
@@ -253,7 +205,7 @@ class NotificationService:
             logger.warning("NotificationService: bot_manager 和 bot 都未初始化")
             return False
 
-        notification_key = f"{chat_id}:{hash(text)}"
+        notification_key = (chat_id, hash(text))
         current_time = time.time()
         if (
             notification_key in self._last_notification_time
@@ -499,8 +451,9 @@ class UserLockManager:
     """用户锁管理器 - 实用版（适合10个群组）"""
 
     def __init__(self):
-        self._locks: Dict[str, asyncio.Lock] = {}
-        self._access_times: Dict[str, float] = {}
+        # 以 (chat_id, uid) 元组为键、按最近使用排序的 LRU，超过 _max_locks 时淘汰最久未用的空闲锁
+        self._locks: "OrderedDict[Tuple[int, int], asyncio.Lock]" = OrderedDict()
+        self._access_times: Dict[Tuple[int, int], float] = {}
         self._lock = asyncio.Lock()
         self._cleanup_interval = 3600
         self._last_cleanup = time.time()
@@ -517,59 +470,40 @@ class UserLockManager:
 
     async def get_lock(self, chat_id: int, uid: int) -> asyncio.Lock:
         """获取用户级锁"""
-        key = f"{chat_id}-{uid}"
+        # 查找与创建之间没有 await，在事件循环内天然原子，无需再加管理锁
+        key = (chat_id, uid)
+        now = time.time()
 
-        # 快速路径
         lock = self._locks.get(key)
         if lock is not None:
             self._stats["hits"] += 1
-            if hash(key) % 10 == 0:
-                asyncio.create_task(self._touch_lock(key))
+            self._locks.move_to_end(key)
+            self._access_times[key] = now
             return lock
 
         self._stats["misses"] += 1
+        lock = self._locks[key] = asyncio.Lock()
+        self._access_times[key] = now
+        if len(self._locks) > self._max_locks:
+            self._evict_idle()
+        return lock
+
+    def _evict_idle(self, count: int = 100):
+        """按 LRU 顺序移除最久未用的空闲锁（最多 count 个）"""
+        victims = []
+        for key, lock in self._locks.items():
+            if not lock.locked():
+                victims.append(key)
+                if len(victims) >= count:
+                    break
 
-        # 慢速路径
-        async with self._lock:
-            if key not in self._locks:
-                if len(self._locks) >= self._max_locks:
-                    await self._simple_cleanup()
-                self._locks[key] = asyncio.Lock()
-
-            self._access_times[key] = time.time()
-            return self._locks[key]
-
-    async def _touch_lock(self, key: str):
-        """更新访问时间"""
-        try:
-            async with self._lock:
-                if key in self._locks:
-                    self._access_times[key] = time.time()
-        except Exception:
-            pass
-
-    async def _simple_cleanup(self):
-        """简单的清理：移除最旧的100个非活动锁"""
-        now = time.time()
-        async with self._lock:
-            in_use = {k for k, v in self._locks.items() if v.locked()}
-
-            inactive = [
-                (k, self._access_times.get(k, 0))
-                for k in self._locks.keys()
-                if k not in in_use
-            ]
-            inactive.sort(key=lambda x: x[1])
-
-            removed = 0
-            for key, _ in inactive[:100]:
-                self._locks.pop(key, None)
-                self._access_times.pop(key, None)
-                removed += 1
+        for key in victims:
+            self._locks.pop(key, None)
+            self._access_times.pop(key, None)
 
-            if removed:
-                self._stats["cleanups"] += removed
-                logger.info(f"🧹 清理了 {removed} 个旧锁")
+        if victims:
+            self._stats["cleanups"] += len(victims)
+            logger.info(f"🧹 清理了 {len(victims)} 个旧锁")
 
     def _start_cleanup_task(self):
         """启动后台清理（内部方法）"""